@@ -7,3 +7,8 @@ admin.site.register(UpstreamedPatch)
 admin.site.register(RangeDiff)
 admin.site.register(RangeDiffPatch)
 admin.site.register(PR)
+admin.site.register(DiffJob)
+admin.site.register(Task)
+admin.site.register(LocalJob)
+admin.site.register(JobProgress)
+admin.site.register(RangeDiffSummary)
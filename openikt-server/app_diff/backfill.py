@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Backfill the columns added to the diff models, run once after migrating:
+    Repository.lts_base
+                    the jammy trees were known to be based on v5.15 by
+                    their urls before it was added, the patches of the
+                    5.15 stable updates are excluded from their quiltdiffs
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+if not "DJANGO_SETTINGS_MODULE" in os.environ:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+    import django
+    django.setup()
+
+from app_diff.models import *
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_lts_base(dry_run=False):
+    # same check as the one replaced by lts_base, on the url of the repo
+    n = 0
+    for repo in Repository.objects.filter(lts_base__isnull=True):
+        if repo.url().find('jammy') < 0:
+            continue
+        logger.info("Set lts_base of %s to v5.15" % repo.url())
+        if not dry_run:
+            repo.lts_base = 'v5.15'
+            repo.save(update_fields=['lts_base'])
+        n += 1
+    logger.info("Backfilled lts_base of %i repos" % n)
+
+def main(args):
+    backfill_lts_base(args.dry_run)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog=sys.argv[0])
+    parser.add_argument('--dry-run', '-n', action='store_true',
+                        help="Only print the repos to backfill")
+    return parser
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    args = get_parser().parse_args()
+    main(args)
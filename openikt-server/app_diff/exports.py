@@ -0,0 +1,402 @@
+"""
+exports of the diffs, written row by row with bounded memory
+
+A diff doesn't change once it's imported, so its exports are generated
+once per content version by the gen_export task of task_worker.py and
+served from the files:
+    <EXPORT_ROOT>/<kind>/<diff id>/<content version>.<format>
+the content version is the completed date of the diff, the files of
+the previous versions are removed when a new one is generated.
+"""
+
+import io
+import os
+import re
+import csv
+import json
+import tempfile
+from itertools import groupby
+from operator import attrgetter
+from django.db.models import Case, When, Value, IntegerField
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, \
+                        StreamingHttpResponse
+from lib.ourxlsx import NewXlsx
+from .models import RangeDiff, RangeDiffPatch, Task
+from app_ii.models import ImageDiff, ImageDiffPKG
+
+EXPORT_ROOT = os.environ.get('OPENIKT_EXPORT_ROOT', '/tmp/openikt-exports')
+# rows fetched per round trip of the server-side cursor
+CHUNK_SIZE = 2000
+# content types of the export formats
+FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+# sheets of the quiltdiff workbook in order:
+#   (patch type, sheet name, both commits, created even if empty)
+QUILTDIFF_SHEETS = (
+    (RangeDiffPatch.TYPE_REMOVED, 'only ref A', False, True),
+    (RangeDiffPatch.TYPE_NEW, 'only ref B', False, True),
+    (RangeDiffPatch.TYPE_UPDATED, 'both', True, True),
+    (RangeDiffPatch.TYPE_SAME, 'same', False, False),
+    (RangeDiffPatch.TYPE_CMCO, 'commit message change only', False, False),
+)
+
+
+def rangediff_patches(rangediff_id):
+    """patches of the rangediff with the joins the rows need"""
+    return RangeDiffPatch.objects.filter(rangediff_id=rangediff_id).select_related(
+             'cmt_a', 'cmt_b', 'pr').defer(
+             'cmt_a__files', 'cmt_a__trailers',
+             'cmt_b__files', 'cmt_b__trailers')
+
+def quiltdiff_patches(rangediff_id):
+    """patches of the rangediff in the order of the sheets, by one query"""
+    sheet = Case(*[ When(patchtype=ptype, then=Value(i)) \
+                      for i, (ptype, _, _, _) in enumerate(QUILTDIFF_SHEETS) ],
+                 output_field=IntegerField())
+    return rangediff_patches(rangediff_id).annotate(
+             sheet=sheet).order_by('sheet', 'pr', 'id')
+
+def imagediff_pkgs(imgdiff_id):
+    return ImageDiffPKG.objects.filter(imgdiff_id=imgdiff_id).select_related(
+             'pkg_a', 'pkg_b').order_by('pkgtype', 'name', 'id')
+
+
+def patch_columns(both):
+    """(title, width) of the columns of a patch sheet"""
+    commits = [ ('Commit(A)', 60), ('Commit(B)', 60) ] if both \
+                else [ ('Commit', 60) ]
+    return [ ('Subject', 80) ] + commits + [
+        ('Upstreamed Version', 30),
+        ('Pull Request', 40),
+        ('Author Email', 30),
+        ('Submitter Email', 30),
+        ('Size(insert)', 20),
+        ('Size(delete)', 20),
+    ]
+
+
+def patch_row(rdp, both):
+    ups_obj = rdp.cmt_b or rdp.cmt_a
+    commits = [ ups_obj.commit ]
+    if both:
+        commit_a = rdp.cmt_a.commit if rdp.cmt_a and \
+                     rdp.patchtype == RangeDiffPatch.TYPE_UPDATED else ''
+        commits = [ commit_a, ups_obj.commit ]
+    return [ ups_obj.subject ] + commits + [
+        ups_obj.upstreamed_in or '',
+        rdp.pr.url if rdp.pr else '',
+        ups_obj.author,
+        ups_obj.author,
+        ups_obj.insert_size,
+        ups_obj.delete_size,
+    ]
+
+
+def quiltdiff_refs(rangediff):
+    """the summary sheet of the quiltdiff workbook"""
+    return {"ref A": rangediff.ref_a, "ref B": rangediff.ref_b}
+
+def write_quiltdiff_xlsx(fileobj, rangediff_id, refs):
+    """
+    write the quiltdiff workbook into fileobj
+
+    The workbook is written in the constant_memory mode, each row is
+    flushed once it's written, so the memory doesn't grow with the
+    number of the patches.
+
+    refs: dict of the summary sheet, e.g. {"ref A": ..., "ref B": ...}
+    """
+    wb = NewXlsx(
+        filename=fileobj,
+        options={
+            # global settings
+            'string_to_number': True,
+            'constant_memory': True,
+            'default_format_properties': {
+                'font_name': 'Calibri',
+                'font_size': 12,
+                'align': 'left',
+                'valign': 'vcenter',
+                'text_wrap': False,
+            }
+        }
+    )
+    # format cell style
+    title_style = wb.add_format(
+        {'bold': True,
+         'font_size': 12,
+         'align': 'left',
+         'bg_color': '#F0F8FF',
+         }
+    )
+    explanat = wb.add_worksheet(name='Summary')
+    wb.write_table(explanat, [ ('Summary', 80) ],
+                   ([ "%s:%s" % (k, v) ] for k, v in refs.items()),
+                   title_style)
+
+    groups = groupby(quiltdiff_patches(rangediff_id).iterator(
+                       chunk_size=CHUNK_SIZE), key=attrgetter('patchtype'))
+    group = next(groups, None)
+    for ptype, name, both, always in QUILTDIFF_SHEETS:
+        matched = group is not None and group[0] == ptype
+        if not matched and not always:
+            continue
+        rdps = group[1] if matched else ()
+        sheet = wb.add_worksheet(name=name)
+        wb.write_table(sheet, patch_columns(both),
+                       (patch_row(rdp, both) for rdp in rdps), title_style)
+        if matched:
+            # the group is consumed by write_table()
+            group = next(groups, None)
+    wb.close()
+
+
+# fields of the records of the csv and json exports
+PATCH_FIELDS = ('patchtype', 'subject', 'commit_a', 'commit_b',
+                'upstreamed_in', 'pr', 'author', 'insert_size', 'delete_size')
+PKG_FIELDS = ('pkgtype', 'name', 'pkg_a', 'version_a', 'pkg_b', 'version_b')
+
+def patch_record(rdp):
+    ups_obj = rdp.cmt_b or rdp.cmt_a
+    # cmt_a isn't imported if commit a is the same as commit b
+    commit_a = rdp.cmt_a.commit if rdp.cmt_a else None
+    if not commit_a and rdp.patchtype != RangeDiffPatch.TYPE_NEW:
+        commit_a = rdp.cmt_b.commit
+    return {
+        'patchtype': rdp.get_patchtype_display(),
+        'subject': ups_obj.subject,
+        'commit_a': commit_a,
+        'commit_b': rdp.cmt_b.commit if rdp.cmt_b else None,
+        'upstreamed_in': ups_obj.upstreamed_in,
+        'pr': rdp.pr.url if rdp.pr else None,
+        'author': ups_obj.author,
+        'insert_size': ups_obj.insert_size,
+        'delete_size': ups_obj.delete_size,
+    }
+
+def pkg_record(p):
+    return {
+        'pkgtype': p.get_pkgtype_display(),
+        'name': p.name,
+        'pkg_a': p.pkg_a.name if p.pkg_a else None,
+        'version_a': p.pkg_a.version if p.pkg_a else None,
+        'pkg_b': p.pkg_b.name if p.pkg_b else None,
+        'version_b': p.pkg_b.version if p.pkg_b else None,
+    }
+
+def patch_records(rangediff_id, types=None):
+    """types: patch types of the records, all if None"""
+    rdps = rangediff_patches(rangediff_id).order_by('patchtype', 'pr', 'id')
+    if types:
+        rdps = rdps.filter(patchtype__in=types)
+    for rdp in rdps.iterator(chunk_size=CHUNK_SIZE):
+        yield patch_record(rdp)
+
+def pkg_records(imgdiff_id, types=None):
+    """types: package types of the records, all if None"""
+    pkgs = imagediff_pkgs(imgdiff_id)
+    if types:
+        pkgs = pkgs.filter(pkgtype__in=types)
+    for p in pkgs.iterator(chunk_size=CHUNK_SIZE):
+        yield pkg_record(p)
+
+# dict: mapping export kind to the fields and the generator of the records
+RECORDS = {
+    'rangediff': (PATCH_FIELDS, patch_records),
+    'imagediff': (PKG_FIELDS, pkg_records),
+}
+
+
+def stream_csv(fields, records, batch=500):
+    """csv text of the records, yielded by batch of rows"""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fields)
+    writer.writeheader()
+    # the header is sent before the first rows are fetched
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    for i, r in enumerate(records, 1):
+        writer.writerow(r)
+        if i % batch == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def stream_ndjson(fields, records, batch=500):
+    """newline-delimited json of the records, yielded by batch of rows"""
+    lines = []
+    for r in records:
+        lines.append(json.dumps(r, default=str))
+        if len(lines) == batch:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+# dict: mapping stream format to the content type and the generator
+STREAMS = {
+    'csv': ('text/csv', stream_csv),
+    'ndjson': ('application/x-ndjson', stream_ndjson),
+}
+
+
+def write_csv(fileobj, fields, records):
+    text = io.TextIOWrapper(fileobj, encoding='utf-8', newline='')
+    writer = csv.DictWriter(text, fields)
+    writer.writeheader()
+    writer.writerows(records)
+    text.flush()
+    # fileobj is left open
+    text.detach()
+
+def write_json(fileobj, records):
+    """a json array written record by record"""
+    sep = b'[\n'
+    for r in records:
+        fileobj.write(sep + json.dumps(r, default=str).encode())
+        sep = b',\n'
+    fileobj.write(b'[]\n' if sep == b'[\n' else b'\n]\n')
+
+def write_records_xlsx(fileobj, sheet_name, fields, records):
+    wb = NewXlsx(filename=fileobj, options={'constant_memory': True})
+    title_style = wb.add_format({'bold': True, 'bg_color': '#F0F8FF'})
+    sheet = wb.add_worksheet(name=sheet_name)
+    wb.write_table(sheet, [ (f, 30) for f in fields ],
+                   ([ r[f] for f in fields ] for r in records), title_style)
+    wb.close()
+
+
+# dict: mapping export kind to the model of the diff and the writers of
+#   the formats, called with (file object, diff)
+EXPORTS = {
+    'rangediff': (RangeDiff, {
+        'xlsx': lambda f, d: write_quiltdiff_xlsx(f, d.id, quiltdiff_refs(d)),
+        'csv': lambda f, d: write_csv(f, PATCH_FIELDS, patch_records(d.id)),
+        'json': lambda f, d: write_json(f, patch_records(d.id)),
+    }),
+    'imagediff': (ImageDiff, {
+        'xlsx': lambda f, d: write_records_xlsx(f, 'packages', PKG_FIELDS,
+                                                pkg_records(d.id)),
+        'csv': lambda f, d: write_csv(f, PKG_FIELDS, pkg_records(d.id)),
+        'json': lambda f, d: write_json(f, pkg_records(d.id)),
+    }),
+}
+
+def get_diff(kind, diff_id):
+    if kind not in EXPORTS or not str(diff_id).isdigit():
+        return None
+    return EXPORTS[kind][0].objects.filter(id=diff_id).first()
+
+def export_version(diff):
+    """
+    content version of the diff, None if it's being imported
+    the image diffs compared before completed_date was added are
+    backfilled by app_ii/backfill.py
+    """
+    date = diff.completed_date
+    return date.strftime("%Y%m%d%H%M%S%f") if date else None
+
+def export_path(kind, diff_id, version, fmt):
+    return os.path.join(EXPORT_ROOT, kind, str(diff_id),
+                        "%s.%s" % (version, fmt))
+
+def gen_export(kind, diff_id, fmt):
+    """
+    generate the export of the current content version of the diff
+    returns: path of the export
+    """
+    model, writers = EXPORTS[kind]
+    diff = model.objects.get(id=diff_id)
+    version = export_version(diff)
+    assert version, "%s %s isn't completed" % (kind, diff_id)
+    path = export_path(kind, diff_id, version, fmt)
+    if os.path.exists(path):
+        return path
+    export_dir = os.path.dirname(path)
+    os.makedirs(export_dir, exist_ok=True)
+    # the file is renamed once it's complete, a partial one is never served
+    fd, tmp_path = tempfile.mkstemp(dir=export_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writers[fmt](f, diff)
+        diff.refresh_from_db()
+        if export_version(diff) != version:
+            raise RuntimeError("%s %s is changed while exporting" % \
+                                 (kind, diff_id))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for fl in os.listdir(export_dir):
+        if fl.endswith(".%s" % fmt) and fl != os.path.basename(path):
+            os.remove(os.path.join(export_dir, fl))
+    return path
+
+def enqueue_export(kind, diff_id, fmt):
+    """the gen_export task of the export, the pending one is reused"""
+    params = {'kind': kind, 'id': int(diff_id), 'format': fmt}
+    task = Task.objects.filter(kind='gen_export', params=params,
+                               status__in=(Task.STATUS_QUEUED,
+                                           Task.STATUS_RUNNING)).first()
+    return task or Task.enqueue('gen_export', params)
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def iter_file(f, length, block_size=65536):
+    with f:
+        while length > 0:
+            data = f.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+def export_response(request, path, filename):
+    """
+    response of the export file with ETag, a single byte range is served
+    partially for the resumed downloads
+    """
+    st = os.stat(path)
+    # the file of a content version never changes
+    etag = '"%s"' % os.path.relpath(path, EXPORT_ROOT).replace(os.sep, '-')
+    if etag in [ t.strip() for t in \
+                   request.META.get('HTTP_IF_NONE_MATCH', '').split(',') ]:
+        resp = HttpResponseNotModified()
+        resp['ETag'] = etag
+        return resp
+    content_type = FORMATS[os.path.splitext(path)[1][1:]]
+    m = RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if m and any(m.groups()) and (not if_range or if_range == etag):
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), st.st_size - 1) if m.group(2) \
+                    else st.st_size - 1
+        else:
+            # the last n bytes
+            start = max(st.st_size - int(m.group(2)), 0)
+            end = st.st_size - 1
+        if start > end:
+            resp = HttpResponse(status=416)
+            resp['Content-Range'] = "bytes */%i" % st.st_size
+            return resp
+        f = open(path, 'rb')
+        f.seek(start)
+        resp = StreamingHttpResponse(iter_file(f, end - start + 1),
+                                     status=206, content_type=content_type)
+        resp['Content-Range'] = "bytes %i-%i/%i" % (start, end, st.st_size)
+        resp['Content-Length'] = str(end - start + 1)
+        resp['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    else:
+        resp = FileResponse(open(path, 'rb'), as_attachment=True,
+                            filename=filename, content_type=content_type)
+    resp['ETag'] = etag
+    resp['Accept-Ranges'] = 'bytes'
+    return resp
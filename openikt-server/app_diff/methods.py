@@ -1,6 +1,10 @@
 """app method file"""
 
+import json
+import base64
 import hashlib
+from functools import reduce
+from django.db.models import Q
 
 
 def format_resp(
@@ -32,3 +36,47 @@ def email_display(email):
     nhash = hashlib.sha224(email.encode("utf-8")).hexdigest()[:32]
     color = f"#{str(nhash)[:6]}"
     return [" ".join(new_name), color, email]
+
+
+def encode_cursor(values):
+    """Encode the sort key values of the last row into a page cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    """Decode a page cursor of size sort key values, None for the first page
+
+    ValueError is raised if the cursor is malformed
+    """
+    if not cursor:
+        return None
+    # binascii.Error, UnicodeDecodeError and JSONDecodeError are ValueError
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list) or len(values) != size or \
+       not all(v is None or isinstance(v, (str, int, float)) for v in values):
+        raise ValueError("Invalid cursor: %s" % cursor)
+    return values
+
+
+def keyset_filter(fields, values):
+    """Filter the rows after the cursor values in the ascending order of fields
+
+    The NULLs are sorted after the other values as postgresql does, e.g.
+    for fields (patchtype, pr_id, id) and values (2, 7, 100):
+        patchtype > 2 OR
+        patchtype = 2 AND (pr_id > 7 OR pr_id IS NULL) OR
+        patchtype = 2 AND pr_id = 7 AND id > 100
+    """
+    conds = []
+    equal = Q()
+    for field, value in zip(fields, values):
+        if value is None:
+            # nothing but NULL sorts after NULL
+            equal &= Q(**{f"{field}__isnull": True})
+            continue
+        after = Q(**{f"{field}__gt": value}) | Q(**{f"{field}__isnull": True})
+        conds.append(equal & after)
+        equal &= Q(**{field: value})
+    if not conds:
+        return Q(pk__in=[])
+    return reduce(lambda a, b: a | b, conds)
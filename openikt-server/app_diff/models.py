@@ -6,17 +6,20 @@ import logging
 from difflib import SequenceMatcher
 from datetime import timezone as dttz
 from datetime import datetime, timedelta
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from argparse import ArgumentTypeError
 from django.db.models import JSONField
 from django.contrib.postgres.fields import ArrayField
 from django.db.models import Q, CharField, TextField, ForeignKey, IntegerField, \
                              DateTimeField, BooleanField, OneToOneField, \
-                             ManyToManyField, BigIntegerField, Model
-from django.db.models.functions import Cast
+                             ManyToManyField, BigIntegerField, Model, \
+                             UniqueConstraint, Count
+from django.db.models.functions import Cast, Coalesce, StrIndex, Substr
 from django.db.models.expressions import F, Value, Func
 
 from lib.gitutils import parse_commit
+from lib.utils import hash_str
 
 
 class Repository(Model):
@@ -31,6 +34,9 @@ class Repository(Model):
     project = CharField(max_length=255, null=True)
     external = BooleanField(default=False)
     name = CharField(max_length=64, null=True, blank=True)
+    # the LTS kernel which the tree is based on, e.g. v5.15. The patches
+    # of its stable updates are excluded from quiltdiff
+    lts_base = CharField(max_length=64, null=True, blank=True)
 
     def __str__(self) -> str:
         return "%s://%s/%s" % (self.protocol, self.host, self.project)
@@ -166,10 +172,31 @@ class RangeDiff(Model):
     difftype = IntegerField(choices=TYPE_CHOICES, default=TYPE_GITDIFF)
     diff = TextField(null=True, blank=True)
     created_date = DateTimeField(null=True, blank=True)
+    # set when all the patches are imported
+    completed_date = DateTimeField(null=True, blank=True)
+    # stage timers and counters of the job, see lib.jobstats
+    stats = JSONField(null=True, blank=True)
 
     class Meta:
         unique_together = ('repo_a', 'repo_b', 'refsha_a', 'refsha_b')
 
+    @staticmethod
+    def find_diff(url_a, sha_a, url_b, sha_b, difftype, base_a=None, base_b=None):
+        """find the completed diff of the same repos, ref shas and diff type"""
+        query = Q(refsha_a=sha_a, refsha_b=sha_b, difftype=difftype,
+                  completed_date__isnull=False)
+        if base_a:
+            query &= Q(base_a=base_a)
+        if base_b:
+            query &= Q(base_b=base_b)
+        rdiffs = RangeDiff.objects.select_related("repo_a", "repo_b").filter(query)
+        for rdiff in rdiffs:
+            repo_a = rdiff.repo_a or rdiff.repo_b
+            repo_b = rdiff.repo_b or rdiff.repo_a
+            if repo_a.url() == url_a and repo_b.url() == url_b:
+                return rdiff
+        return None
+
 
 class RangeDiffPatch(Model):
     TYPE_NEW = 1
@@ -193,12 +220,248 @@ class RangeDiffPatch(Model):
     patchtype = IntegerField(choices=TYPE_CHOICES, default=TYPE_NEW)
     pr = ForeignKey(PR, on_delete=models.CASCADE, null=True, blank=True)
 
+    class Meta:
+        # keyset pagination of the patches of a diff, see
+        # QuiltDiffDetailView
+        indexes = [
+            models.Index(fields=['rangediff', 'patchtype', 'pr', 'id'],
+                         name='rangediffpatch_keyset_idx'),
+        ]
+
     def __str__(self):
         return "%s: %s --> %s" % (self.get_patchtype_display(),
                                   self.cmt_a.commit if self.cmt_a else '-'*40,
                                   self.cmt_b.commit if self.cmt_b else '-'*40)
 
 
+class RangeDiffSummary(Model):
+    """
+    Patch counts of a rangediff by patch type, refreshed at the end of
+    import_rdiff() instead of counting the patches per web request
+    """
+    rangediff = ForeignKey(RangeDiff, on_delete=models.CASCADE,
+                           related_name='summaries')
+    patchtype = IntegerField(choices=RangeDiffPatch.TYPE_CHOICES)
+    count = IntegerField(default=0)
+    # patches of which commit a or b is upstreamed
+    upstreamed = IntegerField(default=0)
+    # dict: mapping author email domain to number of patches
+    domains = JSONField(default=dict)
+    updated_date = DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('rangediff', 'patchtype')
+
+    def __str__(self):
+        return "%s: %i(%i upstreamed)" % (self.get_patchtype_display(),
+                                          self.count, self.upstreamed)
+
+    @classmethod
+    def refresh(cls, rangediff_id):
+        """count the patches of the rangediff by one grouped query"""
+        author = Coalesce('cmt_b__author', 'cmt_a__author')
+        rows = RangeDiffPatch.objects.filter(rangediff_id=rangediff_id).annotate(
+                 domain=Substr(author, StrIndex(author, Value('@')) + 1)).values(
+                 'patchtype', 'domain').annotate(
+                 n=Count('id'),
+                 ups=Count('id', filter=Q(cmt_a__upstreamed_in__isnull=False) |
+                                        Q(cmt_b__upstreamed_in__isnull=False))
+               ).order_by()
+        # dict: mapping patch type to summary
+        summaries = {}
+        for r in rows:
+            if r['patchtype'] not in summaries:
+                summaries[r['patchtype']] = cls(rangediff_id=rangediff_id,
+                                                patchtype=r['patchtype'])
+            summary = summaries[r['patchtype']]
+            summary.count += r['n']
+            summary.upstreamed += r['ups']
+            summary.domains[r['domain'] or ''] = r['n']
+        with transaction.atomic():
+            cls.objects.filter(rangediff_id=rangediff_id).delete()
+            cls.objects.bulk_create(summaries.values())
+        return list(summaries.values())
+
+
+class DiffJob(Model):
+    STATUS_TRIGGERED = 1
+    STATUS_DONE = 2
+    STATUS_FAILED = 3
+    STATUS_CHOICES = (
+        (STATUS_TRIGGERED, "triggered"),
+        (STATUS_DONE, "done"),
+        (STATUS_FAILED, "failed"),
+    )
+    # a triggered job is considered as lost after the timeout
+    TIMEOUT = timedelta(hours=12)
+
+    # hash of the repos, ref shas and diff type, see gen_key()
+    key = CharField(max_length=64, db_index=True)
+    difftype = IntegerField(choices=RangeDiff.TYPE_CHOICES,
+                            default=RangeDiff.TYPE_GITDIFF)
+    # job parameters
+    params = JSONField(null=True, blank=True)
+    status = IntegerField(choices=STATUS_CHOICES, default=STATUS_TRIGGERED)
+    rangediff = ForeignKey(RangeDiff, on_delete=models.SET_NULL,
+                           null=True, blank=True)
+    created_date = DateTimeField(auto_now_add=True)
+    updated_date = DateTimeField(auto_now=True)
+
+    class Meta:
+        # only one job is running for the identical diff requests
+        constraints = [
+            UniqueConstraint(fields=['key'],
+                             condition=Q(status=1),
+                             name='unique_triggered_diffjob'),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.get_status_display(), self.key)
+
+    @staticmethod
+    def gen_key(url_a, sha_a, url_b, sha_b, difftype, base_a=None,
+                base_b=None):
+        '''
+        Generate the key of a diff request, the identical requests
+        have the same key. The diffs of the same refs on different bases
+        are different requests
+
+        :returns: sha256 hex digest
+        :rtype: str
+        '''
+        url_a = re.sub(r'(\/|\.git)$', '', url_a or url_b)
+        url_b = re.sub(r'(\/|\.git)$', '', url_b)
+        key = "%s:%s:%s:%s:%i" % (url_a, sha_a or '', url_b, sha_b,
+                                  int(difftype))
+        # the keys without the bases are unchanged
+        if base_a or base_b:
+            key += ":%s:%s" % (re.sub(r'^origin\/', '', base_a or ''),
+                               re.sub(r'^origin\/', '', base_b or ''))
+        return hash_str(key, 0)
+
+
+class LTSPatchSet(Model):
+    # stable branch, e.g. v5.15
+    branch = CharField(max_length=16, unique=True)
+    # the range base..tag of the stable repo
+    base = CharField(max_length=64)
+    tag = CharField(max_length=64)
+    # dict: mapping patch id to commit
+    pids = JSONField(default=dict)
+    updated_date = DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s..%s(%i)" % (self.base, self.tag, len(self.pids))
+
+
+class Task(Model):
+    """
+    Task of the DB-backed queue, e.g. triggering a jenkins job or sending
+    an email out of the web request, run by app_diff/task_worker.py
+    """
+    STATUS_QUEUED = 1
+    STATUS_RUNNING = 2
+    STATUS_DONE = 3
+    STATUS_FAILED = 4
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "queued"),
+        (STATUS_RUNNING, "running"),
+        (STATUS_DONE, "done"),
+        (STATUS_FAILED, "failed"),
+    )
+    # a running task is considered as lost after the timeout, e.g. the
+    # worker is killed
+    TIMEOUT = timedelta(minutes=30)
+
+    # handler of the task, see task_worker.HANDLERS
+    kind = CharField(max_length=64)
+    params = JSONField(default=dict)
+    status = IntegerField(choices=STATUS_CHOICES, default=STATUS_QUEUED,
+                          db_index=True)
+    attempts = IntegerField(default=0)
+    max_attempts = IntegerField(default=3)
+    # not run before, for the retry backoff
+    run_after = DateTimeField(default=timezone.now)
+    result = JSONField(null=True, blank=True)
+    error = TextField(null=True, blank=True)
+    created_date = DateTimeField(auto_now_add=True)
+    updated_date = DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "#%i %s: %s" % (self.id, self.kind, self.get_status_display())
+
+    @classmethod
+    def enqueue(cls, kind, params, max_attempts=3):
+        return cls.objects.create(kind=kind, params=params,
+                                  max_attempts=max_attempts)
+
+
+class JobProgress(Model):
+    """
+    Progress of a diff job reported by rangediff_gen.py, polled by web,
+    see lib.jobstats.PROGRESS
+    """
+    # key of the diff job, see DiffJob.gen_key()
+    key = CharField(max_length=64, unique=True)
+    # e.g. diff, quiltdiff, import, save, done, failed
+    stage = CharField(max_length=32)
+    # items of the stage processed and the total, 0 if unknown
+    done = IntegerField(default=0)
+    total = IntegerField(default=0)
+    stage_started = DateTimeField()
+    updated_date = DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s: %s %i/%i" % (self.key, self.stage, self.done, self.total)
+
+    def eta(self):
+        """estimated seconds to finish the stage, None if unknown"""
+        if not self.total or not self.done:
+            return None
+        elapsed = (self.updated_date - self.stage_started).total_seconds()
+        return int(elapsed * (self.total - self.done) / self.done)
+
+
+class LocalJob(Model):
+    """
+    Build of a job run by the local executor on the app host instead of
+    jenkins, see lib/localwrapper.py
+    """
+    STATUS_QUEUED = 1
+    STATUS_RUNNING = 2
+    STATUS_SUCCESS = 3
+    STATUS_FAILURE = 4
+    STATUS_ABORTED = 5
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "queued"),
+        (STATUS_RUNNING, "running"),
+        (STATUS_SUCCESS, "SUCCESS"),
+        (STATUS_FAILURE, "FAILURE"),
+        (STATUS_ABORTED, "ABORTED"),
+    )
+
+    # job name, see localwrapper.JOBS
+    name = CharField(max_length=64)
+    # job parameters
+    params = JSONField(default=dict)
+    status = IntegerField(choices=STATUS_CHOICES, default=STATUS_QUEUED,
+                          db_index=True)
+    # pid of the pool process running the job
+    pid = IntegerField(null=True, blank=True)
+    created_date = DateTimeField(auto_now_add=True)
+    started_date = DateTimeField(null=True, blank=True)
+    finished_date = DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s #%i: %s" % (self.name, self.id, self.get_status_display())
+
+    def result(self):
+        """jenkins-like build result, None if not finished"""
+        if self.status in (self.STATUS_QUEUED, self.STATUS_RUNNING):
+            return None
+        return self.get_status_display()
+
+
 class KorgPatch(Model):
     commit = CharField(max_length=64)
     payload_hash = CharField(max_length=64)
@@ -8,6 +8,7 @@ import time
 import logging
 import argparse
 from datetime import datetime, timedelta
+from datetime import timezone as dttz
 from django.utils import timezone
 from django.db.models import F, Q
 from django.db import transaction
@@ -19,13 +20,24 @@ if not "DJANGO_SETTINGS_MODULE" in os.environ:
 
 from app_diff.models import *
 from lib.pushd import pushd
+from lib.jobstats import STATS, PROGRESS
 from lib.gitutils import gen_rangediff, parse_rangediff, find_mergebase, \
                          find_upstreamed_tag, prepare_repo, is_intel_patch, \
                          find_parent_merge_commit, gen_quiltdiff, \
-                         gen_repo_path, get_patchid, get_upstream_tags
+                         gen_repo_path, get_patchids, get_upstream_tags, \
+                         is_ancestor, peek_repo
 
 logger = logging.getLogger(__name__)
 
+# RangeDiff.difftype of the --diff-type
+DIFF_TYPES = {
+    'rangediff': RangeDiff.TYPE_GITDIFF,
+    # same classification as rangediff by the in-process engine
+    'pyrangediff': RangeDiff.TYPE_GITDIFF,
+    'quiltdiff': RangeDiff.TYPE_QUILTDIFF,
+    'quilt': RangeDiff.TYPE_QUILT,
+}
+
 
 # find pr info by parent merge commit
 def find_pr_by_pmc(git_cmt, djm_repo, ref):
@@ -116,6 +128,7 @@ def gen_quilt(url_b, ref_b, ref_a=None, repo_path=None):
 
     return (ref_dict, ((), (), (), quilts, (),))
 
+@STATS.timed()
 def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                  chk_upstream=False, no_bulk_create=False, no_upstream_scan=False):
     # refer to korg repos to find the upstream status of the patch
@@ -172,11 +185,16 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
     prqs = PR.objects.filter(repo_id__in=repo_ids)
     pr_dict = { pr.url: pr for pr in prqs }
     rdiff_patches = []
+    # the imported patches found upstreamed, they are shared by the
+    # other rangediffs
+    ups_changed = []
+    PROGRESS.stage('import', sum(len(pl) for pl in rd_out))
     for rd_out_idx, pl in enumerate(rd_out):
         pl_len = len(pl)
         logger.info("handling patch list #%i, len: %i" % (rd_out_idx, pl_len))
         for i, diff_data in enumerate(pl):
-            logger.debug(diff_data[:-1])
+            PROGRESS.step()
+            logger.debug(diff_data)
             is_intel = False
             # commit a
             ca = diff_data[1]
@@ -208,6 +226,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                     pr = None
                     ckey = "%i:%s" % (djmrepo_b.id, cb)
                     if ckey in up_dict:
+                        STATS.incr('cache.upstreamed_patch.hit')
                         # django model object
                         djmob = up_dict[ckey]
                         if not djmob.upstreamed_in and chk_upstream:
@@ -216,6 +235,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                             if up_in:
                                 djmob.upstreamed_in = up_in
                                 djmob.save()
+                                ups_changed.append(djmob.id)
                         pr = djmob.pr_set.first()
                     else:
                         if no_upstream_scan:
@@ -225,6 +245,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                                       find_upstreamed_tag(cob, git_srepo, ks_pids)
                         djmob = UpstreamedPatch.import_patch(cob, up_in, djmrepo_b.id)
                         djmob.save()
+                        STATS.incr('db.upstreamedpatch')
                         logger.info("    imported commit b")
                         prno, prurl = find_pr(cob, djmob.repo, rangediff.refsha_b)
                         if prno:
@@ -234,6 +255,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                             else:
                                 pr = PR(prno=prno, url=prurl, repo_id=djmrepo_b.id)
                                 pr.save()
+                                STATS.incr('db.pr')
                                 logger.info("    imported pr")
                                 pr_dict[prurl] = pr
                             pr.commits.add(djmob)
@@ -242,6 +264,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                 if ca and ca != cb:
                     ckey = "%i:%s" % (djmrepo_a.id, ca)
                     if ckey in up_dict:
+                        STATS.incr('cache.upstreamed_patch.hit')
                         # django model object
                         djmoa = up_dict[ckey]
                         if not djmoa.upstreamed_in and chk_upstream:
@@ -250,6 +273,7 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                             if up_in:
                                 djmoa.upstreamed_in = up_in
                                 djmoa.save()
+                                ups_changed.append(djmoa.id)
                     else:
                         if no_upstream_scan:
                             up_in = None
@@ -258,20 +282,35 @@ def import_rdiff(repo_a, repo_b, rangediff, rd_out, intel_only=False,
                                       find_upstreamed_tag(coa, git_srepo, ks_pids)
                         djmoa = UpstreamedPatch.import_patch(coa, up_in, djmrepo_a.id)
                         djmoa.save()
+                        STATS.incr('db.upstreamedpatch')
                         logger.info("    imported commit a")
                     rdp.cmt_a_id = djmoa.id
 
                 rdiff_patches.append(rdp)
                 if no_bulk_create:
                     rdp.save()
+                    STATS.incr('db.rangediffpatch')
                 logger.info("    add rangediff patch")
 
+    PROGRESS.stage('save', len(rdiff_patches))
     with transaction.atomic():
         if not no_bulk_create and rdiff_patches:
             RangeDiffPatch.objects.bulk_create(rdiff_patches)
+            STATS.incr('db.rangediffpatch', len(rdiff_patches))
         else:
             logger.info("No rangediff patch imported")
+    # the kept patches of the incremental diff are counted as well
+    RangeDiffSummary.refresh(rangediff.id)
+    if ups_changed:
+        # the upstreamed counts of the other rangediffs of the patches
+        rdqs = RangeDiffPatch.objects.filter(
+                 Q(cmt_a_id__in=ups_changed) | Q(cmt_b_id__in=ups_changed)).exclude(
+                 rangediff_id=rangediff.id).values_list(
+                 'rangediff_id', flat=True).distinct()
+        for rdiff_id in rdqs:
+            RangeDiffSummary.refresh(rdiff_id)
 
+@STATS.timed()
 def get_lts_pids(base):
     kmv_re = re.compile(r'^(v?\d+\.\d+)(?:\.\d+){0,1}(-rc\d+|)(-rt\d+|)(-dontuse|-rebase|-patches|)')
     m = kmv_re.search(base)
@@ -283,19 +322,200 @@ def get_lts_pids(base):
     # get the latest stable update kernel version
     tags = get_upstream_tags(git_srepo, out_type=dict)
     latest_tag = tags[kmv][-1]
-    pids = {}
-    out = git_srepo.git.rev_list("--no-merges", "%s..%s" % (base, latest_tag))
-    for rev in out.splitlines():
-        pid = get_patchid(rev, git_srepo)
-        pids[pid] = rev
+    # the patch ids of the stable branch are persisted and only the
+    # commits of the new stable tags are scanned. The row is locked, the
+    # concurrent jobs of the same branch wait for the one scanning it
+    with transaction.atomic():
+        ltsps, _ = LTSPatchSet.objects.select_for_update().get_or_create(
+                     branch=kmv, defaults={'base': base, 'tag': ''})
+        if ltsps.base == base and ltsps.tag == latest_tag:
+            logger.info("Reuse the patch ids of %s" % ltsps)
+            STATS.incr('cache.lts_pids.hit')
+            return ltsps.pids
+        if ltsps.base == base and ltsps.tag and \
+           is_ancestor(ltsps.tag, latest_tag, git_srepo):
+            pids = ltsps.pids
+            rev_range = "%s..%s" % (ltsps.tag, latest_tag)
+        else:
+            pids = {}
+            rev_range = "%s..%s" % (base, latest_tag)
+        logger.info("Get the patch ids of %s" % rev_range)
+        for rev, pid in get_patchids(rev_range, git_srepo).items():
+            pids[pid] = rev
+        ltsps.base = base
+        ltsps.tag = latest_tag
+        ltsps.pids = pids
+        ltsps.save()
     return pids
 
+# find the latest rangediff of the same repos and start ref, which could
+# be reused by the incremental diff
+def find_prev_rdiff(djmrepo_a, djmrepo_b, ref_a, difftype):
+    rdqs = RangeDiff.objects.filter(repo_a=djmrepo_a,
+                                    repo_b_id=djmrepo_b.id,
+                                    ref_a=ref_a,
+                                    difftype=difftype,
+                                    refsha_b__isnull=False)
+    return rdqs.order_by('-created_date').first()
+
+# merge the diff of the changed commits(i.e. prev.refsha_b..refsha_b) with
+# the patches of the previous rangediff
+#
+# returns: (kept patches of the previous rangediff, diffs to import)
+@STATS.timed()
+def merge_incremental(prev_rdps, diffs):
+    # sha of commit a in the range-diff output may be abbreviated, index
+    # the full shas by a prefix for looking up
+    pfx_len = 7
+    def lookup(rev, sha_idx):
+        for sha in sha_idx.get(rev[:pfx_len], []):
+            if sha.startswith(rev):
+                return sha
+        return None
+
+    # commit a(full sha) which is already matched by a commit b
+    claimed_a = {}
+    # removed patches keyed by commit a(full sha)
+    removed_a = {}
+    for rdp in prev_rdps:
+        if rdp.patchtype == RangeDiffPatch.TYPE_REMOVED:
+            removed_a[rdp.cmt_a.commit] = rdp
+        elif rdp.patchtype != RangeDiffPatch.TYPE_NEW:
+            # cmt_a is not imported if commit a is the same as commit b
+            ca = rdp.cmt_a.commit if rdp.cmt_a else rdp.cmt_b.commit
+            claimed_a[ca] = rdp
+    sha_idx = {}
+    for sha in list(claimed_a.keys()) + list(removed_a.keys()):
+        sha_idx.setdefault(sha[:pfx_len], []).append(sha)
+
+    same, cmco, updated, new, removed = diffs
+    rv = [[], [], [], list(new), []]
+    for rd_out_idx, pl in enumerate((same, cmco, updated,)):
+        for diff_data in pl:
+            ca = lookup(diff_data[1], sha_idx)
+            if ca in claimed_a:
+                # commit a has been matched by an unchanged commit b, so
+                # this commit b is a duplicate, treat it as a new one
+                rv[3].append((diff_data[0], None,) + tuple(diff_data[2:]))
+                continue
+            if ca in removed_a:
+                # the removed commit a is matched by a new commit b now
+                del removed_a[ca]
+            rv[rd_out_idx].append(diff_data)
+    for diff_data in removed:
+        ca = lookup(diff_data[1], sha_idx)
+        # the removed patch has been recorded in the previous rangediff
+        if not ca:
+            rv[4].append(diff_data)
+
+    kept_ids = { rdp.id for rdp in claimed_a.values() }
+    kept_ids.update(rdp.id for rdp in removed_a.values())
+    kept_rdps = [ rdp for rdp in prev_rdps \
+                    if rdp.patchtype == RangeDiffPatch.TYPE_NEW or \
+                       rdp.id in kept_ids ]
+    return (kept_rdps, rv,)
+
+# mark the diff job triggered by web done, see TriggerDiffJob
+def finish_diff_job(rdiff, url_a, url_b, ref_a, base_a=None, base_b=None):
+    rdiff.completed_date = timezone.now()
+    rdiff.stats = STATS.summary()
+    rdiff.save(update_fields=['completed_date', 'stats'])
+    # dump the stats into file
+    stats_fl = os.path.join(os.environ.get("WORKSPACE"), "stats.json")
+    logger.info("Job stats: %s" % json.dumps(rdiff.stats))
+    with open(stats_fl, 'w') as f:
+        json.dump(rdiff.stats, f, indent=2)
+    # the bases of the request rather than the resolved ones of the diff
+    key = DiffJob.gen_key(url_a, rdiff.refsha_a if ref_a else None,
+                          url_b, rdiff.refsha_b, rdiff.difftype,
+                          base_a, base_b)
+    DiffJob.objects.filter(key=key, status=DiffJob.STATUS_TRIGGERED).update(
+      status=DiffJob.STATUS_DONE, rangediff_id=rdiff.id)
+    # the export of the diff is ready before it's downloaded
+    Task.enqueue('gen_export', {'kind': 'rangediff', 'id': rdiff.id,
+                                'format': 'xlsx'})
+    PROGRESS.stage('done')
+
+# key of the diff job triggered by web, see DiffJob.gen_key()
+def diff_job_key(args):
+    # same urls as TriggerDiffJob
+    url_a = re.sub('(\/|\.git)$', '', args.repo_url_from or args.repo_url_to)
+    url_b = re.sub('(\/|\.git)$', '', args.repo_url_to)
+    sha_a = None
+    if args.ref_from:
+        sha_a = peek_repo(re.sub('^origin\/', '', args.ref_from), url_a)[1]
+    sha_b = peek_repo(re.sub('^origin\/', '', args.ref_to), url_b)[1]
+    return DiffJob.gen_key(url_a, sha_a, url_b, sha_b,
+                           DIFF_TYPES[args.diff_type],
+                           args.base_from, args.base_to)
+
+# mark the diff job triggered by web failed, so the identical request could
+# trigger a new one
+def fail_diff_job(args):
+    PROGRESS.stage('failed')
+    DiffJob.objects.filter(key=diff_job_key(args),
+                           status=DiffJob.STATUS_TRIGGERED).update(
+      status=DiffJob.STATUS_FAILED)
+
+# write the progress of the diff job into the DB for web
+def progress_sink(key):
+    def sink(state):
+        JobProgress.objects.update_or_create(key=key, defaults={
+            'stage': state['stage'],
+            'done': state['done'],
+            'total': state['total'],
+            'stage_started': datetime.fromtimestamp(state['started'],
+                                                    tz=dttz.utc),
+        })
+    return sink
+
+@STATS.timed()
+def gen_diffs(diff_type, url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
+              intel_only=False, check_base=True, lts_a=None, lts_b=None,
+              jobs=0, since_b=None):
+    if diff_type in ('rangediff', 'pyrangediff'):
+        engine = 'python' if diff_type == 'pyrangediff' else 'git'
+        ref_dict, diffs = gen_rangediff(url_a,
+                                        url_b,
+                                        ref_a,
+                                        ref_b,
+                                        base_a,
+                                        base_b,
+                                        check_base=check_base,
+                                        workers=jobs,
+                                        engine=engine,
+                                        since_b=since_b)[:3]
+    elif diff_type == 'quiltdiff':
+        # exclude the patches of the stable updates for LTS based trees
+        epids_a = get_lts_pids(lts_a) if lts_a else None
+        if lts_b and lts_b == lts_a:
+            epids_b = epids_a
+        else:
+            epids_b = get_lts_pids(lts_b) if lts_b else None
+        ref_dict, diffs = gen_quiltdiff(url_a,
+                                        url_b,
+                                        ref_a,
+                                        ref_b,
+                                        base_a,
+                                        base_b,
+                                        check_base=check_base,
+                                        intel_only=intel_only,
+                                        epids_a=epids_a,
+                                        epids_b=epids_b,
+                                        since_b=since_b)
+    else:
+        ref_dict, diffs = gen_quilt(url_b,
+                                    ref_b,
+                                    ref_a)
+    return (ref_dict, diffs,)
+
 def main(args):
     logger.info("Repo url(start ref): %s" % args.repo_url_from)
     logger.info("Repo url(end ref): %s" % args.repo_url_to)
     logger.info("Start ref: %s, base=%s" % (args.ref_from, args.base_from))
     logger.info("End ref: %s, base=%s" % (args.ref_to, args.base_to))
     logger.info("Type: %s" % args.diff_type)
+    PROGRESS.sink = progress_sink(diff_job_key(args))
 
     repo_qs = Repository.objects.all()
     repo_url_from = None
@@ -329,8 +549,31 @@ def main(args):
     else:
         rdqs.filter(repo_a__isnull=True)
     rdiff = rdqs.first()
+    # the previous rangediff for the incremental diff
+    prev = None
+    if args.incremental:
+        assert args.diff_type != 'quilt', \
+               "Incremental diff is not supported for type quilt"
+        prev = find_prev_rdiff(djmrepo_a, djmrepo_b, ref_a,
+                               DIFF_TYPES[args.diff_type])
+        if prev:
+            logger.info("Found the previous rangediff #%i: %s(%s)" % \
+                          (prev.id, prev.ref_b, prev.refsha_b))
+            if rdiff and rdiff.id == prev.id:
+                reftype, sha = peek_repo(ref_b, repo_url_to)
+                if sha == prev.refsha_b:
+                    logger.info("The rangediff is up to date, skipped")
+                    finish_diff_job(rdiff, repo_url_from or repo_url_to,
+                                    repo_url_to, ref_a, base_a, base_b)
+                    return
+        else:
+            logger.info("No previous rangediff found, generate a full diff")
     if rdiff:
-        if args.overwrite:
+        if prev:
+            logger.info("The rangediff already exists, going to update it")
+            if prev.id != rdiff.id:
+                RangeDiffPatch.objects.filter(rangediff_id=rdiff.id).delete()
+        elif args.overwrite:
             logger.info("The rangediff already exists, going to overwrite it")
             RangeDiffPatch.objects.filter(rangediff_id=rdiff.id).delete()
         else:
@@ -341,58 +584,69 @@ def main(args):
                           repo_a=djmrepo_a,
                           repo_b_id=djmrepo_b.id)
 
-    if args.diff_type == 'rangediff':
-        ref_dict, diffs = gen_rangediff(repo_url_from or repo_url_to,
-                                        repo_url_to,
-                                        ref_a,
-                                        ref_b,
-                                        base_a,
-                                        base_b)[:3]
+    diff_args = (args.diff_type,
+                 repo_url_from or repo_url_to,
+                 repo_url_to,
+                 ref_a,
+                 ref_b,
+                 base_a)
+    diff_kwargs = {
+        'intel_only': args.intel_only==True,
+        'lts_a': (djmrepo_a or djmrepo_b).lts_base,
+        'lts_b': djmrepo_b.lts_base,
+        'jobs': args.jobs,
+    }
+    if prev:
+        # the cheap checks before cloning, range a must be the same as the
+        # one of the previous rangediff. The baseline of the same ref sha
+        # is the same if base a isn't given
+        url_a = repo_url_from or repo_url_to
+        sha_a = peek_repo(ref_a, url_a)[1]
+        basesha_a = peek_repo(base_a, url_a)[1] if base_a else prev.basesha_a
+        if sha_a != prev.refsha_a or basesha_a != prev.basesha_a:
+            logger.info("Start ref is changed, fall back to a full diff")
+            prev = None
+            if rdiff.id:
+                RangeDiffPatch.objects.filter(rangediff_id=rdiff.id).delete()
+    PROGRESS.stage('diff')
+    # only diff the commits changed since the previous refsha_b, unless
+    # ref b isn't fast-forward from it
+    ref_dict, diffs = gen_diffs(*diff_args,
+                                base_b=base_b,
+                                since_b=prev.refsha_b if prev else None,
+                                **diff_kwargs)
+    if prev and not ref_dict['b']['since']:
+        logger.info("End ref is not fast-forward, fall back to a full diff")
+        prev = None
+        if rdiff.id:
+            RangeDiffPatch.objects.filter(rangediff_id=rdiff.id).delete()
+    if args.diff_type in ('rangediff', 'pyrangediff'):
         rdiff.diff = ref_dict['diff']
+        if prev:
+            # the diff text of the changed commits only, the patches are
+            # merged with the previous rangediff below
+            rdiff.diff = "# incremental: %s..%s of %s, merged with the " \
+                         "rangediff #%i\n%s" % \
+                           (prev.refsha_b, ref_dict['b']['sha'], ref_b,
+                            prev.id, rdiff.diff)
         # write the raw diff into file
         diff_fl = os.path.join(os.environ.get("WORKSPACE"), "diff.txt")
         logger.info("Dump the raw rangediff output to %s" % diff_fl)
         with open(diff_fl, 'w') as f:
             f.write(rdiff.diff)
-    elif args.diff_type == 'quiltdiff':
-        pids515 = None
-        epids_a = None
-        epids_b = None
-        if repo_url_from.find('jammy') >= 0:
-            pids515 = get_lts_pids('v5.15')
-            epids_a = pids515
-        if repo_url_to.find('jammy') >= 0:
-            epids_b = pids515 or get_lts_pids('v5.15')
-        ref_dict, diffs = gen_quiltdiff(repo_url_from or repo_url_to,
-                                        repo_url_to,
-                                        ref_a,
-                                        ref_b,
-                                        base_a,
-                                        base_b,
-                                        intel_only=args.intel_only==True,
-                                        epids_a=epids_a,
-                                        epids_b=epids_b)
-    else:
-        ref_dict, diffs = gen_quilt(repo_url_to,
-                                    ref_b,
-                                    ref_a)
 
     repo_a = ref_dict['a']['repo']
     repo_b = ref_dict['b']['repo']
     # update rangediff variables
     rdiff.created_date = timezone.now()
+    rdiff.completed_date = None
     rdiff.refsha_a = ref_dict['a']['sha']
     rdiff.refsha_b = ref_dict['b']['sha']
     rdiff.base_a = ref_dict['a']['base']
     rdiff.base_b = ref_dict['b']['base']
     rdiff.basesha_a = ref_dict['a']['basesha']
     rdiff.basesha_b = ref_dict['b']['basesha']
-    dtype_dict = {
-        'rangediff': RangeDiff.TYPE_GITDIFF,
-        'quiltdiff': RangeDiff.TYPE_QUILTDIFF,
-        'quilt': RangeDiff.TYPE_QUILT,
-    }
-    rdiff.difftype = dtype_dict[args.diff_type]
+    rdiff.difftype = DIFF_TYPES[args.diff_type]
     # update rangediff in database
     try:
         rdiff.save()
@@ -403,6 +657,23 @@ def main(args):
         rdiff.diff = None
         rdiff.save()
 
+    if prev:
+        prev_rdps = RangeDiffPatch.objects.select_related(
+                      'cmt_a', 'cmt_b').filter(rangediff_id=prev.id)
+        kept_rdps, diffs = merge_incremental(list(prev_rdps), diffs)
+        logger.info("Reuse %i patches of the previous rangediff" % \
+                      len(kept_rdps))
+        with transaction.atomic():
+            if prev.id == rdiff.id:
+                RangeDiffPatch.objects.filter(rangediff_id=rdiff.id).exclude(
+                  id__in=[ rdp.id for rdp in kept_rdps ]).delete()
+            else:
+                for rdp in kept_rdps:
+                    rdp.id = None
+                    rdp.rangediff_id = rdiff.id
+                RangeDiffPatch.objects.bulk_create(kept_rdps)
+                STATS.incr('db.rangediffpatch', len(kept_rdps))
+
     logger.info("Import the rangediff patches ...")
     import_rdiff(repo_a,
                  repo_b,
@@ -412,12 +683,11 @@ def main(args):
                  args.check_upstream==True,
                  args.no_bulk_create==True,
                  args.no_upstream_scan==True)
+    finish_diff_job(rdiff, repo_url_from or repo_url_to, repo_url_to, ref_a,
+                    base_a, base_b)
 
 
-if __name__ == '__main__':
-    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
-    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
-
+def get_parser():
     parser = argparse.ArgumentParser(prog=sys.argv[0])
     parser.add_argument('--repo-url-from', '-f', action='store',
                         help="Repository url of start ref")
@@ -438,13 +708,30 @@ if __name__ == '__main__':
     parser.add_argument('--check-upstream', '-u', action='store_true',
                         help="Check upstream status for patches already imported")
     parser.add_argument('--diff-type', '-T', default='rangediff',
-                        choices=['rangediff', 'quiltdiff', 'quilt'],
+                        choices=list(DIFF_TYPES),
                         help="Use text diff instead of git-range-diff")
     parser.add_argument('--no-bulk-create', '-B', action='store_true',
                         help="Don't use bulk_create to avoid memory alloc issue")
     parser.add_argument('--no-upstream-scan', '-U', action='store_true',
                         help="Don't scan upstream repos to associate the tag")
-    args = parser.parse_args()
+    parser.add_argument('--incremental', '-I', action='store_true',
+                        help="Reuse the previous diff of the same start ref and "
+                             "only diff the commits changed since then")
+    parser.add_argument('--jobs', '-j', type=int, default=0,
+                        help="Pre-match the patches by patch id and run "
+                             "git-range-diff on the rest in N parallel jobs")
+    return parser
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    args = get_parser().parse_args()
     
     assert os.environ.get("WORKSPACE")
-    main(args)
+    try:
+        main(args)
+    except Exception:
+        fail_diff_job(args)
+        raise
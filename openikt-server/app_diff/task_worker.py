@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import traceback
+from datetime import timedelta
+from django.utils import timezone
+from django.db.models import Q
+from django.db import connection, transaction, IntegrityError
+
+if not "DJANGO_SETTINGS_MODULE" in os.environ:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+    import django
+    django.setup()
+
+from app_diff.models import Task, DiffJob, RangeDiff
+from app_diff.exports import gen_export
+from lib.jobwrapper import BUILD_SERVERS, JOB_SERVER, new_job_wrapper
+from lib.localwrapper import LocalExecutor
+from lib.jenkinswrapper import BuildMonitor
+from lib.email import send_email
+from lib.gitutils import peek_repo, INVALID_REPO, NOT_EXIST
+
+logger = logging.getLogger(__name__)
+
+
+# task kind: trigger_job
+#   params: {
+#       'server': build server name, see lib.jobwrapper.BUILD_SERVERS,
+#       'name': job name,
+#       'group': job group,
+#       'data': job parameters,
+#       'diff_job_id': the DiffJob marked failed if the job can't be triggered,
+#       'notify': { 'user_email', 'msg' }, the msg is formatted by job_url
+#   }
+def run_trigger_job(task):
+    params = task.params
+    job = new_job_wrapper(params['server'])
+    if not job.trigger_job(name=params['name'], group=params.get('group'),
+                           data=params.get('data')):
+        raise RuntimeError("Trigger job %s failed" % params['name'])
+    notify = params.get('notify')
+    if notify:
+        Task.enqueue('send_email', {
+            'user_email': notify['user_email'],
+            'msg': notify['msg'].format(job_url=job.job_url_base),
+        })
+    return {'job_url': job.job_url_base, 'queue_id': job.queue_id}
+
+# task kind: request_diff
+#   params: { 'data': the diff request, see app_diff.views.TriggerDiffJob }
+#   result: { 'diffId' } of the completed identical diff, or { 'jobId' } of
+#           the diff job triggered or already running, or { 'error', 'detail' }
+def run_request_diff(task):
+    data = task.params['data']
+    # resolve the refs to shas, the identical requests share one diff
+    url_a = re.sub(r'(\/|\.git)$', '', data['repo_from'] or data['repo_to'])
+    url_b = re.sub(r'(\/|\.git)$', '', data['repo_to'])
+    difftype = int(data['diff_type'])
+    sha_a = None
+    if data['ref_from']:
+        reftype, sha_a = peek_repo(data['ref_from'], url_a)
+        if reftype in (INVALID_REPO, NOT_EXIST,):
+            return {'error': "Ref Not Found", 'detail': data['ref_from']}
+    reftype, sha_b = peek_repo(data['ref_to'], url_b)
+    if reftype in (INVALID_REPO, NOT_EXIST,):
+        return {'error': "Ref Not Found", 'detail': data['ref_to']}
+    rdiff = RangeDiff.find_diff(url_a, sha_a, url_b, sha_b, difftype,
+                                data['base_from'], data['base_to'])
+    if rdiff:
+        return {'diffId': rdiff.id}
+
+    key = DiffJob.gen_key(url_a, sha_a, url_b, sha_b, difftype,
+                          data['base_from'], data['base_to'])
+    # the triggered job might be lost, e.g. the jenkins job is aborted
+    DiffJob.objects.filter(
+        key=key, status=DiffJob.STATUS_TRIGGERED,
+        created_date__lt=timezone.now() - DiffJob.TIMEOUT).update(
+          status=DiffJob.STATUS_FAILED)
+    try:
+        with transaction.atomic():
+            diff_job = DiffJob.objects.create(key=key, difftype=difftype,
+                                              params=data)
+            # the diff job is marked failed if it can't be triggered
+            Task.enqueue('trigger_job', {
+                'server': JOB_SERVER,
+                'name': 'create-diff',
+                'group': 'OpenIKT',
+                'data': data,
+                'diff_job_id': diff_job.id,
+            })
+    except IntegrityError:
+        # the identical diff job is running
+        diff_job = DiffJob.objects.filter(
+                     key=key, status=DiffJob.STATUS_TRIGGERED).first()
+    return {'jobId': diff_job.id if diff_job else None}
+
+def fail_diff_job(diff_job_id):
+    if diff_job_id:
+        # the identical diff request could trigger a new one
+        DiffJob.objects.filter(id=diff_job_id,
+                               status=DiffJob.STATUS_TRIGGERED).update(
+          status=DiffJob.STATUS_FAILED)
+
+def fail_trigger_job(task):
+    fail_diff_job(task.params.get('diff_job_id'))
+
+# task kind: send_email
+#   params: { 'user_email', 'msg' }
+def run_send_email(task):
+    send_email(msg=task.params['msg'], user_email=task.params['user_email'])
+
+# task kind: gen_export
+#   params: { 'kind': rangediff or imagediff, 'id': diff id,
+#             'format': xlsx, csv or json }, see app_diff.exports
+def run_gen_export(task):
+    params = task.params
+    return {'path': gen_export(params['kind'], params['id'], params['format'])}
+
+# dict: mapping task kind to (handler, handler on the final failure)
+HANDLERS = {
+    'request_diff': (run_request_diff, None),
+    'trigger_job': (run_trigger_job, fail_trigger_job),
+    'send_email': (run_send_email, None),
+    'gen_export': (run_gen_export, None),
+}
+
+def claim_task():
+    """take the next due task, the concurrent workers skip the locked ones"""
+    now = timezone.now()
+    with transaction.atomic():
+        task = Task.objects.select_for_update(skip_locked=True).filter(
+                 Q(status=Task.STATUS_QUEUED, run_after__lte=now) |
+                 Q(status=Task.STATUS_RUNNING,
+                   updated_date__lt=now - Task.TIMEOUT)
+               ).order_by('run_after', 'id').first()
+        if task:
+            task.status = Task.STATUS_RUNNING
+            task.attempts += 1
+            task.save(update_fields=['status', 'attempts', 'updated_date'])
+    return task
+
+def run_task(task):
+    handler, on_failure = HANDLERS[task.kind]
+    logger.info("Run task %s, attempt %i/%i" % \
+                  (task, task.attempts, task.max_attempts))
+    try:
+        task.result = handler(task)
+        task.status = Task.STATUS_DONE
+        task.error = None
+    except (Exception, SystemExit) as e:
+        # lib.utils.requests_get/post exit on the http errors, they are
+        # retried as the other failures instead of killing the worker
+        logger.error(repr(e))
+        task.error = traceback.format_exc()
+        if task.attempts < task.max_attempts:
+            # retry with exponential backoff
+            task.status = Task.STATUS_QUEUED
+            task.run_after = timezone.now() + \
+                               timedelta(seconds=30 * 2 ** (task.attempts - 1))
+        else:
+            task.status = Task.STATUS_FAILED
+            if on_failure:
+                on_failure(task)
+    task.save()
+    logger.info("Task %s" % task)
+    return task
+
+def track_build(monitors, task):
+    """follow the jenkins build of a triggered job"""
+    params = task.params
+    server = params['server']
+    if BUILD_SERVERS[server]['type'] != 'jenkins':
+        # the local jobs update their status themselves
+        return
+    queue_id = (task.result or {}).get('queue_id')
+    if not queue_id:
+        logger.warning("No queue id of task %s, not tracked" % task)
+        return
+    if server not in monitors:
+        monitors[server] = BuildMonitor(
+                             server, max_age=DiffJob.TIMEOUT.total_seconds())
+    monitors[server].track(params.get('group'), params['name'], queue_id,
+                           data=task.id)
+
+def track_builds(monitors):
+    """the builds triggered but not finished, e.g. before a restart"""
+    # build_result is missing before the build starts and json null until
+    # it finishes, isnull only matches the missing key
+    tasks = Task.objects.filter(
+              Q(result__build_result__isnull=True) |
+              Q(result__build_result=None),
+              kind='trigger_job', status=Task.STATUS_DONE,
+              updated_date__gte=timezone.now() - DiffJob.TIMEOUT)
+    for task in tasks:
+        track_build(monitors, task)
+
+def update_build(task_id, build):
+    task = Task.objects.filter(id=task_id).first()
+    if not task:
+        return
+    task.result.update(build_number=build['number'], build_url=build['url'],
+                       build_result=build['result'])
+    task.save(update_fields=['result', 'updated_date'])
+    if build['result'] and build['result'] != 'SUCCESS':
+        # the build failed before the diff script could mark the diff
+        # job, e.g. the agent is offline
+        fail_diff_job(task.params.get('diff_job_id'))
+
+def main(args):
+    # the jobs of the local build server are run in the process pool
+    executor = LocalExecutor(workers=args.local_workers) \
+                 if args.local_workers else None
+    # dict: mapping jenkins server name to the monitor of its builds
+    monitors = {}
+    track_builds(monitors)
+    try:
+        while True:
+            task = None
+            nrunning = 0
+            # an error of one iteration, e.g. the DB is restarted, is
+            # logged and the loop goes on
+            try:
+                task = claim_task()
+                if task:
+                    run_task(task)
+                    if task.kind == 'trigger_job' and \
+                       task.status == Task.STATUS_DONE:
+                        track_build(monitors, task)
+                nrunning = executor.poll() if executor else 0
+                for monitor in monitors.values():
+                    if monitor.due():
+                        for key, build in monitor.poll():
+                            update_build(build['data'], build)
+            except Exception as e:
+                logger.error("Task worker iteration failed: %s\n%s" % \
+                               (repr(e), traceback.format_exc()))
+                # reconnect to the DB in the next iteration
+                connection.close()
+                time.sleep(args.interval)
+                continue
+            if task:
+                continue
+            if args.once and not nrunning:
+                break
+            time.sleep(args.interval)
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    parser = argparse.ArgumentParser(prog=sys.argv[0])
+    parser.add_argument('--once', '-1', action='store_true',
+                        help="Quit when no task is due")
+    parser.add_argument('--interval', '-i', type=int, default=2,
+                        help="Seconds to wait for the new tasks")
+    parser.add_argument('--local-workers', '-w', type=int,
+                        default=BUILD_SERVERS['local']['workers'] \
+                          if BUILD_SERVERS[JOB_SERVER]['type'] == 'local' \
+                          else 0,
+                        help="Size of the process pool running the local "
+                             "jobs, 0 to not run them")
+    args = parser.parse_args()
+
+    main(args)
@@ -1,3 +1,492 @@
-from django.test import TestCase
+import io
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import git
+from django.db import DatabaseError
+from django.db.models import Q
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory
+
+from lib.gitutils import RD_SAME, RD_CMCO, RD_UPDATED, RD_NEW, RD_REMOVED, \
+                         iter_rangediff, parse_rangediff, parallel_rangediff, \
+                         py_rangediff, patch_cost, similar_lines, \
+                         min_cost_assign, gen_rangediff, object_reader
+from lib.ourxlsx import NewXlsx
+from app_diff import exports
+from app_diff import task_worker
+from app_diff.models import RangeDiffPatch, UpstreamedPatch, Task
+from app_diff.methods import encode_cursor, decode_cursor, keyset_filter
+from app_diff.rangediff_gen import merge_incremental
+from app_diff.views import QuiltDiffDetailView
+from bench.synthrepo import gen_repos
+
+
+class MergeIncrementalTests(SimpleTestCase):
+    def rdp(self, rdp_id, patchtype, commit_a, commit_b):
+        cmt_a = UpstreamedPatch(commit=commit_a) if commit_a else None
+        cmt_b = UpstreamedPatch(commit=commit_b) if commit_b else None
+        return RangeDiffPatch(id=rdp_id, patchtype=patchtype, cmt_a=cmt_a,
+                              cmt_b=cmt_b)
+
+    def test_merge(self):
+        prev = [
+            self.rdp(1, RangeDiffPatch.TYPE_SAME, None, 'a' * 40),
+            self.rdp(2, RangeDiffPatch.TYPE_REMOVED, 'b' * 40, None),
+            self.rdp(3, RangeDiffPatch.TYPE_REMOVED, 'c' * 40, None),
+            self.rdp(4, RangeDiffPatch.TYPE_NEW, None, 'd' * 40),
+        ]
+        diffs = [
+            # commit a is already matched, the commit b is a new one
+            [(1, 'a' * 12, 'e' * 12, 'dup')],
+            [],
+            # the removed commit a is matched now
+            [(2, 'b' * 12, 'f' * 12, 'updated')],
+            [(3, None, '1' * 12, 'new')],
+            # recorded in the previous rangediff already
+            [(4, 'c' * 12, None, 'removed'), (5, '2' * 12, None, 'gone')],
+        ]
+        kept, rv = merge_incremental(prev, diffs)
+        self.assertEqual([ rdp.id for rdp in kept ], [1, 3, 4])
+        self.assertEqual(rv, [
+            [],
+            [],
+            [(2, 'b' * 12, 'f' * 12, 'updated')],
+            [(3, None, '1' * 12, 'new'), (1, None, 'e' * 12, 'dup')],
+            [(5, '2' * 12, None, 'gone')],
+        ])
+
+
+class RangeDiffParseTests(SimpleTestCase):
+    OUTPUT = """\
+1:  c0debee0123 = 1:  cab005e0123 Add a helpful message at the start
+-:  ----------- > 2:  0ddba110123 Prepare for the inevitable!
+2:  f00dba10123 ! 3:  decafe10123 Describe a bug
+    @@ -1,3 +1,3 @@
+     Author: A U Thor <author@example.com>
+
+    -    TODO: Describe a bug
+    +    Describe a bug
+3:  bedead00123 ! 4:  bedbad00123 Fix the crash
+    @@ Fix the crash
+      ## lib.c ##
+    @@ lib.c: int crash(void)
+    -+	return 0;
+    ++	return 1;
+4:  deadbee0123 < -:  ----------- TO-UNDO
+"""
+
+    def test_iter_rangediff(self):
+        # the message is changed only, the patch ids are the same
+        with mock.patch('lib.gitutils.get_patchid', return_value='pid'):
+            rv = list(iter_rangediff(self.OUTPUT))
+        self.assertEqual(rv, [
+            (RD_SAME, (1, 'c0debee0123', 'cab005e0123',
+                       'Add a helpful message at the start',)),
+            (RD_NEW, (2, None, '0ddba110123', 'Prepare for the inevitable!',)),
+            (RD_CMCO, (3, 'f00dba10123', 'decafe10123', 'Describe a bug',)),
+            (RD_UPDATED, (4, 'bedead00123', 'bedbad00123', 'Fix the crash',)),
+            (RD_REMOVED, (5, 'deadbee0123', None, 'TO-UNDO',)),
+        ])
+
+    def test_twisted_diff(self):
+        out = "1:  aaaaaaaaaa ! 2:  bbbbbbbbbb Revert \"x\"\n" \
+              "    @@ x\n    -+revert\n" \
+              "2:  bbbbbbbbbb ! 1:  aaaaaaaaaa x\n" \
+              "    @@ x\n    ++revert\n"
+        rv = parse_rangediff(out, repo=mock.Mock())
+        self.assertEqual(rv, [[], [], [], [], []])
+
+
+class PatchMatchTests(SimpleTestCase):
+    def test_patch_cost(self):
+        a = [ "+line %i" % i for i in range(20) ]
+        self.assertEqual(patch_cost(a, a), 0)
+        self.assertEqual(patch_cost([], ['+a']), 2)
+        # hunk header, 3 + 3 context lines, - and +
+        b = a[:10] + ['+x'] + a[11:]
+        self.assertEqual(patch_cost(a, b), 9)
+        self.assertIsNone(patch_cost(a, b, max_cost=9))
+        # the changes far apart are in 2 hunks
+        self.assertEqual(patch_cost(a, ['+x'] + a[1:19] + ['+y']), 12)
+
+    def test_similar_lines(self):
+        a = [ "+line %i" % i for i in range(10) ]
+        self.assertTrue(similar_lines(a, a[:8] + ['+x', '+y']))
+        self.assertFalse(similar_lines(a, [ "+other %i" % i for i in range(10) ]))
+        self.assertFalse(similar_lines([], []))
+
+    def test_min_cost_assign(self):
+        cost = [[4, 1, 3],
+                [2, 0, 5],
+                [3, 2, 2]]
+        # the greedy choice of (1, 1) isn't the optimal one
+        self.assertEqual(min_cost_assign(cost), [1, 0, 2])
+        self.assertEqual(min_cost_assign([[7]]), [0])
+
+
+def rangediff_commits(rv):
+    # the subject of git range-diff is the one of commit a
+    return [ [ (seq, ca and ca[:12], cb and cb[:12],) \
+                 for seq, ca, cb, _ in patches ] for patches in rv ]
+
+
+class RangeDiffEngineTests(SimpleTestCase):
+    """the engines classify the patches as git range-diff"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.path = tempfile.mkdtemp()
+        cls.repo = git.Repo.init(cls.path)
+        with cls.repo.config_writer() as cw:
+            cw.set_value('user', 'name', 'A U Thor')
+            cw.set_value('user', 'email', 'author@example.com')
+            # the shas of the big trees, see rd_result_re
+            cw.set_value('core', 'abbrev', '12')
+        cls.commit('base', {'README': 'base\n'})
+        cls.repo.git.tag('base')
+        for i in range(6):
+            cls.commit("fix typo", {'typo%i.c' % i: "int x%i;\n" % i})
+        cls.commit("add lib", {'lib.c': ''.join("int f%i(void);\n" % i \
+                                                for i in range(10))})
+        cls.commit("drop me", {'drop.c': "int drop;\n"})
+        cls.commit("reword me", {'reword.c': "int reword;\n"})
+        cls.repo.git.tag('ref_a')
+        cls.repo.git.checkout('-b', 'b', 'base')
+        cls.commit('new base', {'BASE': 'new base\n'})
+        cls.repo.git.tag('base_b')
+        for i in range(6):
+            cls.commit("fix typo", {'typo%i.c' % i: "int x%i;\n" % i})
+        cls.commit("add lib", {'lib.c': ''.join("int f%i(void);\n" % i \
+                                                for i in range(9)) + \
+                                        "int g(void);\n"})
+        cls.commit("reword me again", {'reword.c': "int reword;\n"})
+        cls.commit("fix typo", {'other.c': "int other;\n"})
+        cls.commit("brand new", {'new.c': "int new;\n"})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+        super().tearDownClass()
+
+    @classmethod
+    def commit(cls, msg, files):
+        for name, text in files.items():
+            with open(os.path.join(cls.path, name), 'w') as f:
+                f.write(text)
+            cls.repo.index.add([name])
+        cls.repo.index.commit(msg)
+
+    def expected(self):
+        rv = parse_rangediff(
+               self.repo.git.range_diff('base..ref_a', 'base_b..b'), self.repo)
+        self.assertEqual([ len(l) for l in rv ], [6, 1, 1, 2, 1])
+        return rangediff_commits(rv)
+
+    def test_parallel_rangediff(self):
+        _, rv = parallel_rangediff(self.repo, 'base..ref_a', 'base_b..b',
+                                   workers=2)
+        self.assertEqual(rangediff_commits(rv), self.expected())
+
+    def test_py_rangediff(self):
+        _, rv = py_rangediff(self.repo, 'base..ref_a', 'base_b..b')
+        self.assertEqual(rangediff_commits(rv), self.expected())
+
+
+class SynthRepoEngineTests(SimpleTestCase):
+    """the engines classify the series of the bench repos as git range-diff"""
+    range_a = 'v6.1..tree-a-v6.1'
+    range_b = 'v6.2..tree-b-v6.2'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.path = tempfile.mkdtemp()
+        gen_repos(cls.path, npatches=300, nupstream=300, nfiles=100, seed=2)
+        cls.repo = git.Repo(os.path.join(cls.path, 'linux.git'))
+        with cls.repo.config_writer() as cw:
+            cw.set_value('core', 'abbrev', '12')
+        cls.expected = rangediff_commits(parse_rangediff(
+                         cls.repo.git.range_diff(cls.range_a, cls.range_b),
+                         cls.repo))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+        super().tearDownClass()
+
+    def test_parallel_rangediff(self):
+        _, rv = parallel_rangediff(self.repo, self.range_a, self.range_b,
+                                   workers=2)
+        self.assertEqual(rangediff_commits(rv), self.expected)
+
+    def test_py_rangediff(self):
+        _, rv = py_rangediff(self.repo, self.range_a, self.range_b)
+        self.assertEqual(rangediff_commits(rv), self.expected)
+
+
+class ObjectReaderTests(SimpleTestCase):
+    """the cached readers don't outlive the repos re-cloned in a workspace"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.repo_a = self.init('a')
+        self.commit(self.repo_a, 'base', 'README')
+        self.repo_a.git.tag('base')
+        self.commit(self.repo_a, 'patch a', 'a.c')
+        self.repo_a.git.tag('ref_a')
+        self.repo_b = self.init('b')
+        self.repo_b.git.pull(self.repo_a.working_dir, 'ref_a')
+        self.repo_b.git.fetch(self.repo_a.working_dir, 'tag', 'base')
+
+    def init(self, name):
+        repo = git.Repo.init(os.path.join(self.path, name))
+        with repo.config_writer() as cw:
+            cw.set_value('user', 'name', 'A U Thor')
+            cw.set_value('user', 'email', 'author@example.com')
+        return repo
+
+    def commit(self, repo, msg, name):
+        with open(os.path.join(repo.working_dir, name), 'w') as f:
+            f.write("%s\n" % msg)
+        repo.index.add([name])
+        return repo.index.commit(msg).hexsha
+
+    def test_two_diffs_in_workspace(self):
+        workspace = os.path.join(self.path, 'workspace')
+        for i in range(2):
+            # a new commit b, unknown to the git processes of the last diff
+            sha = self.commit(self.repo_b, "patch b%i" % i, "b%i.c" % i)
+            self.repo_b.git.tag("ref_b%i" % i)
+            ref_dict, _ = gen_rangediff(self.repo_a.working_dir,
+                                        self.repo_b.working_dir,
+                                        'ref_a', "ref_b%i" % i, 'base', 'base',
+                                        repo_path=workspace)
+            gitc = object_reader(ref_dict['b']['repo']).commit(sha)
+            self.assertEqual(gitc.summary, "patch b%i" % i)
+
+
+class TaskRetryTests(SimpleTestCase):
+    def run_task(self, attempts, handler):
+        on_failure = mock.Mock()
+        task = Task(id=1, kind='test', attempts=attempts, max_attempts=3)
+        with mock.patch.dict(task_worker.HANDLERS,
+                             {'test': (handler, on_failure)}), \
+             mock.patch.object(Task, 'save'):
+            task_worker.run_task(task)
+        return task, on_failure
+
+    def test_done(self):
+        task, on_failure = self.run_task(1, lambda t: {'ok': True})
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.result, {'ok': True})
+        on_failure.assert_not_called()
+
+    def test_retry(self):
+        def handler(t):
+            # e.g. lib.utils.requests_post on a http error
+            sys.exit(1)
+        task, on_failure = self.run_task(2, handler)
+        self.assertEqual(task.status, Task.STATUS_QUEUED)
+        self.assertIn('SystemExit', task.error)
+        on_failure.assert_not_called()
+
+    def test_failed(self):
+        def handler(t):
+            raise RuntimeError("Trigger job failed")
+        task, on_failure = self.run_task(3, handler)
+        self.assertEqual(task.status, Task.STATUS_FAILED)
+        on_failure.assert_called_once_with(task)
+
+
+class TaskWorkerLoopTests(SimpleTestCase):
+    def test_iteration_error(self):
+        args = mock.Mock(once=True, interval=0, local_workers=0)
+        task = Task(id=1, kind='trigger_job', status=Task.STATUS_DONE,
+                    params={'server': 'jenkins'}, result={})
+        with mock.patch.object(task_worker, 'track_builds'), \
+             mock.patch.object(task_worker, 'connection') as connection, \
+             mock.patch.object(task_worker, 'claim_task',
+                               side_effect=[DatabaseError(), task, None]), \
+             mock.patch.object(task_worker, 'run_task'), \
+             mock.patch.dict(task_worker.BUILD_SERVERS,
+                             {'jenkins': {'type': 'jenkins'}}):
+            # the DB error and the task without queue id don't kill it
+            task_worker.main(args)
+        connection.close.assert_called_once_with()
+
+
+class QuiltDiffDetailViewTests(SimpleTestCase):
+    def test_invalid_page(self):
+        view = QuiltDiffDetailView.as_view()
+        factory = APIRequestFactory()
+        for params in ({'pageSize': 'x'}, {'currentPage': '1.5'},
+                       {'pageSize': '0'}, {'cursor': 'not base64!'}):
+            params['quiltDiffId'] = 1
+            resp = view(factory.get('/', params))
+            self.assertEqual(resp.status_code, 400, params)
+            self.assertEqual(resp.data['code'], 21008)
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        values = [2, None, 'linux-firmware', 100]
+        self.assertEqual(decode_cursor(encode_cursor(values), 4), values)
+
+    def test_first_page(self):
+        self.assertIsNone(decode_cursor(None, 3))
+        self.assertIsNone(decode_cursor('', 3))
+
+    def test_malformed(self):
+        for cursor in ('not base64!', encode_cursor([1, 2]),
+                       encode_cursor({'id': 1}), encode_cursor([1, [2], 3])):
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor, 3)
+
+
+# evaluate a Q of keyset_filter() against a row of dict, None is NULL
+def eval_q(q, row):
+    rv = []
+    for child in q.children:
+        if isinstance(child, Q):
+            rv.append(eval_q(child, row))
+            continue
+        lookup, value = child
+        field, _, op = lookup.partition('__')
+        if op == 'gt':
+            rv.append(row[field] is not None and row[field] > value)
+        elif op == 'isnull':
+            rv.append((row[field] is None) == value)
+        elif op == 'in':
+            rv.append(row[field] in value)
+        else:
+            rv.append(row[field] == value)
+    rv = all(rv) if q.connector == Q.AND else any(rv)
+    return not rv if q.negated else rv
+
+
+class KeysetFilterTests(SimpleTestCase):
+    FIELDS = ('patchtype', 'pr_id', 'id')
+
+    def rows(self):
+        # in the order of postgresql, the NULLs are the last
+        rows = [ {'patchtype': t, 'pr_id': pr, 'id': i} \
+                   for i, (t, pr) in enumerate([(1, 3), (1, None), (2, 7),
+                                                (2, 7), (2, None), (None, 1),
+                                                (None, None), (2, 5)]) ]
+        def key(r):
+            return tuple((r[f] is None, r[f] or 0) for f in self.FIELDS)
+        return sorted(rows, key=key)
+
+    def test_rows_after_cursor(self):
+        rows = self.rows()
+        for i, row in enumerate(rows):
+            q = keyset_filter(self.FIELDS, [ row[f] for f in self.FIELDS ])
+            self.assertEqual([ r for r in rows if eval_q(q, r) ], rows[i + 1:],
+                             row)
+
+    def test_all_null(self):
+        self.assertEqual(keyset_filter(('a', 'b'), (None, None)),
+                         Q(pk__in=[]))
+
+
+class XlsxTests(SimpleTestCase):
+    def read_xml(self, fileobj, name):
+        with zipfile.ZipFile(fileobj) as zf:
+            return zf.read(name).decode()
+
+    def test_write_table(self):
+        f = io.BytesIO()
+        wb = NewXlsx(filename=f, options={'constant_memory': True})
+        sheet = wb.add_worksheet(name='patches')
+        count = wb.write_table(sheet, [ ('Subject', 80), ('Commit', 60) ],
+                               ([ "subject %i" % i, "%040x" % i ] \
+                                  for i in range(3)))
+        empty = wb.add_worksheet(name='empty')
+        self.assertEqual(wb.write_table(empty, [ ('Subject', 80) ], []), 0)
+        wb.close()
+        self.assertEqual(count, 3)
+        self.assertEqual(sheet.row_count, 3)
+        xml = self.read_xml(f, 'xl/worksheets/sheet1.xml')
+        self.assertIn('subject 2', xml)
+        self.assertIn('<dimension ref="A1:B4"/>', xml)
+
+    def test_write_quiltdiff_xlsx(self):
+        def rdp(patchtype, subject):
+            return RangeDiffPatch(
+                     patchtype=patchtype,
+                     cmt_b=UpstreamedPatch(commit='a' * 40, subject=subject,
+                                           author='author@example.com'))
+        rdps = [ rdp(RangeDiffPatch.TYPE_NEW, 'only b'),
+                 rdp(RangeDiffPatch.TYPE_SAME, 'same') ]
+        qs = mock.Mock()
+        qs.iterator.return_value = iter(rdps)
+        f = io.BytesIO()
+        with mock.patch.object(exports, 'quiltdiff_patches', return_value=qs):
+            exports.write_quiltdiff_xlsx(f, 1, {'ref A': 'v6.1', 'ref B': 'v6.6'})
+        xml = self.read_xml(f, 'xl/workbook.xml')
+        sheets = [ s.split('"')[0] for s in xml.split('<sheet name="')[1:] ]
+        # the empty sheets of the optional types are skipped
+        self.assertEqual(sheets, ['Summary', 'only ref A', 'only ref B',
+                                  'both', 'same'])
+        self.assertIn('ref B:v6.6',
+                      self.read_xml(f, 'xl/worksheets/sheet1.xml'))
+        self.assertIn('only b', self.read_xml(f, 'xl/worksheets/sheet3.xml'))
+
+
+class ExportResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        patcher = mock.patch.object(exports, 'EXPORT_ROOT', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'rangediff', '1'))
+        self.path = os.path.join(self.root, 'rangediff', '1', '100.csv')
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+        self.factory = APIRequestFactory()
+
+    def get(self, **headers):
+        return exports.export_response(self.factory.get('/', **headers),
+                                       self.path, 'rangediff-1.csv')
+
+    def content(self, resp):
+        return b''.join(resp.streaming_content)
+
+    def test_full(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['ETag'], '"rangediff-1-100.csv"')
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertEqual(self.content(resp), b'0123456789')
+
+    def test_not_modified(self):
+        resp = self.get(HTTP_IF_NONE_MATCH='"x", "rangediff-1-100.csv"')
+        self.assertEqual(resp.status_code, 304)
+
+    def test_range(self):
+        resp = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(self.content(resp), b'2345')
+        resp = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual(self.content(resp), b'789')
+        resp = self.get(HTTP_RANGE='bytes=8-')
+        self.assertEqual(self.content(resp), b'89')
+
+    def test_range_not_satisfiable(self):
+        resp = self.get(HTTP_RANGE='bytes=20-')
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp['Content-Range'], 'bytes */10')
+
+    def test_if_range_changed(self):
+        # the file was changed since the partial download, send it all
+        resp = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"old"')
+        self.assertEqual(resp.status_code, 200)
@@ -9,4 +9,8 @@ urlpatterns = [
     path('type', RangeDiffPatchTypeView.as_view(), name='quilt_diff_patch_type'),
     path('diff_type', RangeDiffTypeView.as_view(), name='quilt_diff_type'),
     path('create', TriggerDiffJob.as_view(), name='trigger_diff_job'),
+    path('task', TaskView.as_view(), name='task'),
+    path('progress', DiffJobProgressView.as_view(), name='diff_job_progress'),
+    path('export', DiffExportView.as_view(), name='diff_export'),
+    path('rows', DiffRowsView.as_view(), name='diff_rows'),
 ]
@@ -5,14 +5,16 @@ from rest_framework.response import Response
 from rest_framework import status
 from .serializers import *
 from .models import *
-from .methods import format_resp
-from django.db.models import Q
-from django.core.paginator import Paginator
+from .methods import format_resp, encode_cursor, decode_cursor, \
+                     keyset_filter
+from django.db.models import Q, Count
 from .methods import email_display
-from lib.ourxlsx import NewXlsx
-from io import BytesIO
-from django.http import HttpResponse
-from lib.jenkinswrapper import JenkinsWrapper
+import os
+import tempfile
+from django.http import FileResponse, StreamingHttpResponse
+from .exports import write_quiltdiff_xlsx, quiltdiff_refs, get_diff, \
+                     export_version, export_path, enqueue_export, \
+                     export_response, FORMATS, EXPORTS, RECORDS, STREAMS
 
 
 class GetRepositoryView(APIView):
@@ -109,10 +111,15 @@ class QuiltDiffDetailView(APIView):
 
     Args:
         quiltDIffId: the quilt diff id
+        cursor: the page after the cursor, see detail.nextCursor, the
+                keyset pagination is used instead of currentPage if it's
+                given, an empty one for the first page
 
     Return:
         the list of quilt diff respost data
     """
+    # sort key of the patches, see RangeDiffPatch.Meta.indexes
+    ORDER = ("patchtype", "pr_id", "id")
 
     def get(self, request):
         """
@@ -123,58 +130,95 @@ class QuiltDiffDetailView(APIView):
         """
         qd_id = request.query_params.get("quiltDiffId")
         qd_type = request.query_params.get("quiltDiffType")
-        pagesize = request.query_params.get("pageSize", 20)
-        currentpage = request.query_params.get("currentPage", 1)
+        cursor = request.query_params.get("cursor")
+        try:
+            pagesize = int(request.query_params.get("pageSize", 20))
+            currentpage = int(request.query_params.get("currentPage", 1))
+            if pagesize <= 0:
+                raise ValueError("Invalid page size: %i" % pagesize)
+            after = decode_cursor(cursor, len(self.ORDER))
+        except ValueError:
+            return Response(data=format_resp(code=21008, msg="Invalid Page"),
+                            status=status.HTTP_400_BAD_REQUEST)
         if not qd_id:
             data = format_resp(code=21001, msg="Quilt Diff Not Found")
             return Response(data=data, status=status.HTTP_404_NOT_FOUND)
-        rdps = (
-            RangeDiffPatch.objects.select_related("cmt_a", "cmt_b")
-            .filter(rangediff_id=qd_id, patchtype=qd_type)
-            .order_by("pr")
+        rdps = RangeDiffPatch.objects.filter(rangediff_id=qd_id,
+                                             patchtype=qd_type)
+        # the counts are pre-aggregated by import_rdiff(), they are
+        # counted here only for the diffs imported before the summary
+        summary = RangeDiffSummary.objects.filter(rangediff_id=qd_id,
+                                                  patchtype=qd_type).first()
+        if summary:
+            counts = {"patch_count": summary.count,
+                      "ups_count": summary.upstreamed,
+                      "domains": summary.domains}
+        elif RangeDiffSummary.objects.filter(rangediff_id=qd_id).exists():
+            # no patch of the type
+            counts = {"patch_count": 0, "ups_count": 0, "domains": {}}
+        else:
+            # both counts by one query
+            counts = rdps.aggregate(
+                patch_count=Count("id"),
+                ups_count=Count("id", filter=Q(cmt_a__upstreamed_in__isnull=False) |
+                                             Q(cmt_b__upstreamed_in__isnull=False)),
+            )
+            counts["domains"] = None
+        # one page with all the joins the rows need, the large columns
+        # of the patches aren't loaded
+        page_qs = (
+            rdps.select_related("cmt_a__repo", "cmt_b__repo", "pr")
+            .defer("cmt_a__files", "cmt_a__trailers",
+                   "cmt_b__files", "cmt_b__trailers")
+            .order_by(*self.ORDER)
         )
-        if rdps:
-            ups = rdps.filter(Q(cmt_a__upstreamed_in__isnull=False) | Q(cmt_b__upstreamed_in__isnull=False))
-            page_obj = Paginator(rdps, pagesize)
-            page_count = page_obj.count
-            page_size = page_obj.page(currentpage)
-            rdps = page_size.object_list
-            res_patch_diff = []
-            ups_count = ups.count()
-            for rdp in rdps:
-                rdq_dict = {}
-                commit_b = rdp.cmt_b
-                ups_obj = rdp.cmt_a
-                if commit_b:
-                    ups_obj = commit_b
-                email = ups_obj.author
-                upstreamed_in = ups_obj.upstreamed_in
-                if rdp.patchtype == RangeDiffPatch.TYPE_UPDATED and rdp.cmt_a:
-                    rdq_dict["commit_a"] = rdp.cmt_a.commit
-                    rdq_dict["git_url_cmta"] = (
-                        rdp.cmt_a.repo.url() + "/commit/" + rdp.cmt_a.commit
-                    )
-                rdq_dict["subject"] = ups_obj.subject
-                rdq_dict["pr_url"] = rdp.pr.url if rdp.pr else ""
-                rdq_dict["insert_size"] = ups_obj.insert_size
-                rdq_dict["delete_size"] = ups_obj.delete_size
-                rdq_dict["commit"] = ups_obj.commit
-
-                rdq_dict["upstreamedVersion"] = (
-                    ups_obj.upstreamed_in if ups_obj.upstreamed_in else ""
-                )
-                rdq_dict["git_url"] = ups_obj.repo.url() + "/commit/" + ups_obj.commit
-                rdq_dict["author"] = email_display(email)
-                rdq_dict["submitter"] = email_display(email)
-                if upstreamed_in:
-                    rdq_dict["upstreamedVersion"] = upstreamed_in
-                res_patch_diff.append(rdq_dict)
+        if cursor is not None:
+            # the deep pages cost the same as the first one
+            if after:
+                page_qs = page_qs.filter(keyset_filter(self.ORDER, after))
+            rdps = list(page_qs[:pagesize])
         else:
-            res_patch_diff = []
-            page_count = 0
-            ups_count = 0
+            offset = (max(currentpage, 1) - 1) * pagesize
+            rdps = list(page_qs[offset:offset + pagesize])
+        next_cursor = None
+        if len(rdps) == pagesize:
+            last = rdps[-1]
+            next_cursor = encode_cursor([ getattr(last, f) for f in self.ORDER ])
+        res_patch_diff = []
+        for rdp in rdps:
+            rdq_dict = {}
+            commit_b = rdp.cmt_b
+            ups_obj = rdp.cmt_a
+            if commit_b:
+                ups_obj = commit_b
+            email = ups_obj.author
+            upstreamed_in = ups_obj.upstreamed_in
+            if rdp.patchtype == RangeDiffPatch.TYPE_UPDATED and rdp.cmt_a:
+                rdq_dict["commit_a"] = rdp.cmt_a.commit
+                rdq_dict["git_url_cmta"] = (
+                    rdp.cmt_a.repo.url() + "/commit/" + rdp.cmt_a.commit
+                )
+            rdq_dict["subject"] = ups_obj.subject
+            rdq_dict["pr_url"] = rdp.pr.url if rdp.pr else ""
+            rdq_dict["insert_size"] = ups_obj.insert_size
+            rdq_dict["delete_size"] = ups_obj.delete_size
+            rdq_dict["commit"] = ups_obj.commit
+
+            rdq_dict["upstreamedVersion"] = (
+                ups_obj.upstreamed_in if ups_obj.upstreamed_in else ""
+            )
+            rdq_dict["git_url"] = ups_obj.repo.url() + "/commit/" + ups_obj.commit
+            rdq_dict["author"] = email_display(email)
+            rdq_dict["submitter"] = email_display(email)
+            if upstreamed_in:
+                rdq_dict["upstreamedVersion"] = upstreamed_in
+            res_patch_diff.append(rdq_dict)
         return Response(
-            data=format_resp(data=res_patch_diff, detail={"patchCount": page_count, "upsCount": ups_count}),
+            data=format_resp(data=res_patch_diff,
+                             detail={"patchCount": counts["patch_count"],
+                                     "upsCount": counts["ups_count"],
+                                     "domainCount": counts["domains"],
+                                     "nextCursor": next_cursor}),
             status=status.HTTP_200_OK,
         )
 
@@ -199,228 +243,26 @@ class QuiltDiffDetailView(APIView):
         qd_id = request.data.get('quiltDiffId')
         ref_a = request.data.get('refA')
         ref_b = request.data.get('refB')
-        rdps = RangeDiffPatch.objects.select_related(
-            'cmt_a', 'cmt_b').filter(rangediff_id=qd_id, patchtype=RangeDiffPatch.TYPE_REMOVED).order_by('pr')
-        ref_a_b = {"ref A": ref_a, "ref B": ref_b}
-        # create excel
-        output = BytesIO()
-        wb = NewXlsx(
-            filename=output,
-            options={
-                # global settings
-                'string_to_number': True,
-                'constant_memory': False,
-                'default_format_properties': {
-                    'font_name': 'Calibri',
-                    'font_size': 12,
-                    'align': 'left',
-                    'valign': 'vcenter',
-                    'text_wrap': False,
-                }
-            }
-        )
-        # format cell style
-        title_style = wb.add_format(
-            {'bold': True,
-             'font_size': 12,
-             'align': 'left',
-             'bg_color': '#F0F8FF',
-             }
-        )
-        # create sheet Explanation
-        explanat = wb.add_worksheet(name='Summary')
-        explant_sheet_tree = explanat.title_tree
-        explain = explant_sheet_tree.add_child(
-            nid='Summary',
-            data=wb.get_tree_node_format_data(
-                style=title_style,
-                width=80,
-                abs_width=True
-            )
-        )
-        for k, v in ref_a_b.items():
-            explain.data['column_cells_list'].append(
-                wb.get_tree_node_format_cell(
-                    value=k + ":" + v
-                    )
-                )
-        wb.write_worksheet(explanat)
-        # create sheet only A
-        only_sheet_a = wb.add_worksheet(name='only ref A')
-        self.write_data_excel(only_sheet_a, wb, title_style, rdps, both=False)
-        
-        # create sheet only b
-        rdps = RangeDiffPatch.objects.select_related(
-            'cmt_a', 'cmt_b').filter(rangediff_id=qd_id, patchtype=RangeDiffPatch.TYPE_NEW).order_by('pr')
-        only_sheet_b = wb.add_worksheet(name='only ref B')
-        self.write_data_excel(only_sheet_b, wb, title_style, rdps, both=False)
-        
-        # create both sheet
-        rdps = RangeDiffPatch.objects.select_related(
-            'cmt_a', 'cmt_b').filter(rangediff_id=qd_id, patchtype=RangeDiffPatch.TYPE_UPDATED).order_by('pr')
-        both_sheet = wb.add_worksheet(name='both')
-        self.write_data_excel(both_sheet, wb, title_style, rdps, both=True)
-      
-        # create same sheet
-        rdps = RangeDiffPatch.objects.select_related(
-            'cmt_a', 'cmt_b').filter(rangediff_id=qd_id, patchtype=RangeDiffPatch.TYPE_SAME).order_by('pr')
-        if rdps:
-            same_sheet = wb.add_worksheet(name='same')
-            self.write_data_excel(same_sheet, wb, title_style, rdps, both=False)
-        
-        # create both change only sheet
-        rdps = RangeDiffPatch.objects.select_related(
-            'cmt_a', 'cmt_b').filter(rangediff_id=qd_id, patchtype=RangeDiffPatch.TYPE_CMCO).order_by('pr')
-        if rdps:
-            both_chanege_sheet = wb.add_worksheet(name='commit message change only')
-            self.write_data_excel(both_chanege_sheet, wb, title_style, rdps, both=False)
-        
-        wb.close()
-        xlsx_data = output.getvalue()
+        rdiff = get_diff('rangediff', qd_id)
+        # the refs of the diff are written to the summary sheet as the
+        # cached workbook, refA/refB are only used for an unknown diff
+        ref_a_b = quiltdiff_refs(rdiff) if rdiff else \
+                    {"ref A": ref_a, "ref B": ref_b}
+        version = export_version(rdiff) if rdiff else None
+        if version:
+            path = export_path('rangediff', rdiff.id, version, 'xlsx')
+            if os.path.exists(path):
+                return export_response(request, path, 'Openikt quiltdiff.xlsx')
+            enqueue_export('rangediff', rdiff.id, 'xlsx')
+        # the workbook is written to a temp file in the constant_memory
+        # mode and streamed from there, the file is deleted once closed
+        output = tempfile.TemporaryFile(suffix='.xlsx')
+        write_quiltdiff_xlsx(output, qd_id, ref_a_b)
+        output.seek(0)
         file_name = 'Openikt quiltdiff' + '.xlsx'
-        response = HttpResponse(content_type='application/ms-excel')
-        response['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
-        response.write(xlsx_data)
-        return response
-
-    def write_data_excel(self, sheet_name, wb, title_style, rdps, both=False):
-        if rdps:
-            diff_sheet_tree = sheet_name.title_tree
-            subject = diff_sheet_tree.add_child(
-                nid='Subject',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=80,
-                    abs_width=True
-                )
-            )
-            if both:
-                cmt_a = diff_sheet_tree.add_child(
-                    nid='Commit(A)',
-                    data=wb.get_tree_node_format_data(
-                        style=title_style,
-                        width=60
-                    )
-                )
-                cmt_b = diff_sheet_tree.add_child(
-                    nid='Commit(B)',
-                    data=wb.get_tree_node_format_data(
-                        style=title_style,
-                        width=60
-                    )
-                )
-            else:
-                commit = diff_sheet_tree.add_child(
-                    nid='Commit',
-                    data=wb.get_tree_node_format_data(
-                        style=title_style,
-                        width=60
-                    )
-                )
-            up_version = diff_sheet_tree.add_child(
-                nid='Upstreamed Version',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=30
-                )
-            )
-            pr_url = diff_sheet_tree.add_child(
-                nid='Pull Request',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=40
-                )
-            )
-            author = diff_sheet_tree.add_child(
-                nid='Author Email',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=30
-                )
-            )
-            submit = diff_sheet_tree.add_child(
-                nid='Submitter Email',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=30
-                )
-            )
-            size_add = diff_sheet_tree.add_child(
-                nid='Size(insert)',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=20
-                )
-            )
-            size_del = diff_sheet_tree.add_child(
-                nid='Size(delete)',
-                data=wb.get_tree_node_format_data(
-                    style=title_style,
-                    width=20
-                )
-            )
-        
-            for rdp in rdps:
-                commit_b = rdp.cmt_b
-                ups_obj = rdp.cmt_a
-                if commit_b:
-                    ups_obj = commit_b
-                email = ups_obj.author
-                subject.data['column_cells_list'].append(
-                    wb.get_tree_node_format_cell(
-                        value=ups_obj.subject
-                    )
-                )
-                if both:
-                    if rdp.patchtype == RangeDiffPatch.TYPE_UPDATED and rdp.cmt_a:
-                        commit_a = rdp.cmt_a.commit
-                    cmt_a.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=commit_a if commit_a else ''
-                        )
-                    )
-                    cmt_b.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=ups_obj.commit
-                        )
-                    )
-                else:
-                    commit.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=ups_obj.commit
-                        )
-                    )
-                up_version.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=ups_obj.upstreamed_in if ups_obj.upstreamed_in else ''
-                        )
-                    )
-                pr_url.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=rdp.pr.url if rdp.pr else ''
-                        )
-                    )
-                author.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=email
-                        )
-                    )
-                submit.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=email
-                        )
-                    )
-                size_add.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=ups_obj.insert_size
-                        )
-                    )
-                size_del.data['column_cells_list'].append(
-                        wb.get_tree_node_format_cell(
-                            value=ups_obj.delete_size
-                        )
-                    )
-            wb.write_worksheet(sheet_name)
+        return FileResponse(output, as_attachment=True, filename=file_name,
+                            content_type=FORMATS['xlsx'])
+
 
 class RangeDiffPatchTypeView(APIView):
     """
@@ -432,10 +274,16 @@ class RangeDiffPatchTypeView(APIView):
     """
 
     def get(self, request):
-        """get diff patch type api"""
+        """get diff patch type api, with the patch counts of quiltDiffId"""
+        qd_id = request.query_params.get("quiltDiffId")
         diffPatchType = [
             {"label": i[1], "value": i[0]} for i in RangeDiffPatch.TYPE_CHOICES
         ]
+        if qd_id:
+            counts = dict(RangeDiffSummary.objects.filter(
+                            rangediff_id=qd_id).values_list("patchtype", "count"))
+            for t in diffPatchType:
+                t["count"] = counts.get(t["value"], 0)
         return Response(data=format_resp(data=diffPatchType), status=status.HTTP_200_OK)
 
 
@@ -460,6 +308,10 @@ class TriggerDiffJob(APIView):
     """
     Summary:
         trigger create diff job
+
+    Return:
+        the taskId of the request, its result is the diffId of the
+        identical diff or the jobId of the diff job, see TaskView
     """
 
     @staticmethod
@@ -496,6 +348,145 @@ class TriggerDiffJob(APIView):
         }
         self.extra_repo(form['repositoryFrom'])
         self.extra_repo(form['repositoryTo'])
-        job = JenkinsWrapper(server_name='cje_jenkins')
-        job.trigger_job(name='create-diff', group='OpenIKT', data=data)
-        return Response(data=format_resp(data={}), status=status.HTTP_200_OK)
+
+        # the refs are resolved by git ls-remote, which takes seconds for
+        # the big remote repos, so it's done by the task worker rather than
+        # blocking the request, see task_worker.run_request_diff()
+        task = Task.enqueue('request_diff', {'data': data})
+        return Response(data=format_resp(data={"taskId": task.id}),
+                        status=status.HTTP_200_OK)
+
+
+class DiffJobProgressView(APIView):
+    """
+    Summary:
+        progress of a diff job, polled by web until the job is done
+    """
+
+    def get(self, request, *args, **kwargs):
+        diff_job = DiffJob.objects.filter(
+                     id=request.query_params.get('jobId')).first()
+        if not diff_job:
+            return Response(data=format_resp(code=21005, msg="Diff Job Not Found"),
+                            status=status.HTTP_404_NOT_FOUND)
+        data = {
+            'jobId': diff_job.id,
+            'status': diff_job.get_status_display(),
+            'rangediffId': diff_job.rangediff_id,
+            'stage': None,
+            'done': 0,
+            'total': 0,
+            'eta': None,
+            'updated': None,
+        }
+        progress = JobProgress.objects.filter(key=diff_job.key).first()
+        # the progress of the previous identical job is ignored
+        if progress and progress.updated_date >= diff_job.created_date:
+            data.update({
+                'stage': progress.stage,
+                'done': progress.done,
+                'total': progress.total,
+                'eta': progress.eta(),
+                'updated': progress.updated_date,
+            })
+        return Response(data=format_resp(data=data), status=status.HTTP_200_OK)
+
+
+class TaskView(APIView):
+    """
+    Summary:
+        status of a background task, e.g. triggering a jenkins job
+    """
+
+    def get(self, request, *args, **kwargs):
+        task = Task.objects.filter(id=request.query_params.get('id')).first()
+        if not task:
+            return Response(data=format_resp(code=21004, msg="Task Not Found"),
+                            status=status.HTTP_404_NOT_FOUND)
+        data = {
+            'id': task.id,
+            'kind': task.kind,
+            'status': task.get_status_display(),
+            'attempts': task.attempts,
+            'result': task.result,
+            'error': task.error,
+            'created': task.created_date,
+            'updated': task.updated_date,
+        }
+        return Response(data=format_resp(data=data), status=status.HTTP_200_OK)
+
+
+class DiffExportView(APIView):
+    """
+    Summary:
+        download the export of a diff, it's generated once per content
+        version of the diff by a background task
+
+    Args:
+        kind: rangediff or imagediff
+        id: the diff id
+        format: xlsx, csv or json
+
+    Return:
+        the export file, or the taskId generating it with status 202
+    """
+
+    def get(self, request, *args, **kwargs):
+        kind = request.query_params.get('kind', 'rangediff')
+        fmt = request.query_params.get('format', 'xlsx')
+        if kind not in EXPORTS or fmt not in FORMATS:
+            return Response(data=format_resp(code=21006, msg="Invalid Export"),
+                            status=status.HTTP_400_BAD_REQUEST)
+        diff = get_diff(kind, request.query_params.get('id'))
+        version = export_version(diff) if diff else None
+        if not version:
+            return Response(data=format_resp(code=21007,
+                                             msg="Diff Not Found or Not Completed"),
+                            status=status.HTTP_404_NOT_FOUND)
+        path = export_path(kind, diff.id, version, fmt)
+        if os.path.exists(path):
+            return export_response(request, path,
+                                   "openikt-%s-%i.%s" % (kind, diff.id, fmt))
+        task = enqueue_export(kind, diff.id, fmt)
+        return Response(data=format_resp(data={'taskId': task.id},
+                                         msg="Export is being generated"),
+                        status=status.HTTP_202_ACCEPTED)
+
+
+class DiffRowsView(APIView):
+    """
+    Summary:
+        stream the patches of a rangediff or the packages of an image diff
+        as they are read from the database, for the scripts
+
+    Args:
+        kind: rangediff or imagediff
+        id: the diff id
+        format: csv or ndjson
+        types: optional, the patch or package types separated by comma
+
+    Return:
+        the rows of the diff, see app_diff.exports.RECORDS for the fields
+    """
+
+    def get(self, request, *args, **kwargs):
+        kind = request.query_params.get('kind', 'rangediff')
+        fmt = request.query_params.get('format', 'csv')
+        types = request.query_params.get('types')
+        if kind not in RECORDS or fmt not in STREAMS or \
+           (types and not all(t.isdigit() for t in types.split(','))):
+            return Response(data=format_resp(code=21006, msg="Invalid Export"),
+                            status=status.HTTP_400_BAD_REQUEST)
+        diff = get_diff(kind, request.query_params.get('id'))
+        if not diff:
+            return Response(data=format_resp(code=21007,
+                                             msg="Diff Not Found or Not Completed"),
+                            status=status.HTTP_404_NOT_FOUND)
+        fields, records = RECORDS[kind]
+        content_type, stream = STREAMS[fmt]
+        rows = records(diff.id, types.split(',') if types else None)
+        resp = StreamingHttpResponse(stream(fields, rows),
+                                     content_type=content_type)
+        resp['Content-Disposition'] = 'attachment; filename="openikt-%s-%i.%s"' % \
+                                        (kind, diff.id, fmt)
+        return resp
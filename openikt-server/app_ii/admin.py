@@ -11,3 +11,4 @@ admin.site.register(PKGExtraInfo)
 admin.site.register(PKGRelation)
 admin.site.register(ImageDiff)
 admin.site.register(ImageDiffPKG)
+admin.site.register(ImageDiffSummary)
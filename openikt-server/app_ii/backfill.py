@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Backfill the columns added to the image diffs, run once after migrating:
+    completed_date  the image diffs compared before it was added are
+                    completed at their created date
+    ImageDiffPKG.name
+                    name of pkg b or pkg a, the sort key of the listing
+"""
+
+import os
+import sys
+import logging
+import argparse
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Now
+
+if not "DJANGO_SETTINGS_MODULE" in os.environ:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+    import django
+    django.setup()
+
+from app_ii.models import *
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_completed_date():
+    # the diffs with packages, a diff being compared gets its date when
+    # it's completed
+    n = ImageDiff.objects.filter(
+          completed_date__isnull=True,
+          id__in=ImageDiffPKG.objects.values('imgdiff_id')).update(
+          completed_date=Coalesce('created', Now()))
+    logger.info("Backfilled completed_date of %i image diffs" % n)
+    # the counts of the old diffs, see ImageDiffSummary
+    for imgdiff_id in ImageDiff.objects.filter(completed_date__isnull=False,
+                                               summaries__isnull=True).values_list(
+                        'id', flat=True):
+        ImageDiffSummary.refresh(imgdiff_id)
+
+def backfill_pkg_name():
+    # one UPDATE ... SET name = COALESCE(pkg_b.name, pkg_a.name)
+    def pkg_name(field):
+        return Subquery(Package.objects.filter(id=OuterRef(field)).values(
+                          'name')[:1])
+    n = ImageDiffPKG.objects.filter(name='').update(
+          name=Coalesce(pkg_name('pkg_b_id'), pkg_name('pkg_a_id'), Value('')))
+    logger.info("Backfilled name of %i image diff packages" % n)
+
+def main(args):
+    backfill_completed_date()
+    backfill_pkg_name()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog=sys.argv[0])
+    return parser
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    args = get_parser().parse_args()
+    main(args)
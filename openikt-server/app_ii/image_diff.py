@@ -20,6 +20,7 @@ if not "DJANGO_SETTINGS_MODULE" in os.environ:
     django.setup()
 
 from app_ii.models import *
+from app_diff.models import Task
 
 logger = logging.getLogger(__name__)
 
@@ -63,12 +64,14 @@ def gen_imagediff(imgdiff, img_a, img_b):
         if pn in b_pkgrs:
             for rpkg in b_pkgrs[pn]:
                 diff = ImageDiffPKG(imgdiff_id=imgdiff.id,
+                                    name=pn,
                                     pkg_a_id=rpkg.id,
                                     pkg_b_id=b_pkgs[pn].id,
                                     pkgtype=ImageDiffPKG.TYPE_REPLACED)
                 replaced.append(diff)
         else:
-            diff = ImageDiffPKG(imgdiff_id=imgdiff.id, pkg_b_id=b_pkgs[pn].id)
+            diff = ImageDiffPKG(imgdiff_id=imgdiff.id, name=pn,
+                                pkg_b_id=b_pkgs[pn].id)
             new.append(diff)
     for pn in sorted(a_pnms & b_pnms):
         pkga = a_pkgs[pn]
@@ -76,12 +79,14 @@ def gen_imagediff(imgdiff, img_a, img_b):
         if pn in b_pkgrs:
             for rpkg in b_pkgrs[pn]:
                 diff = ImageDiffPKG(imgdiff_id=imgdiff.id,
+                                    name=pn,
                                     pkg_a_id=rpkg.id,
                                     pkg_b_id=pkgb.id,
                                     pkgtype=ImageDiffPKG.TYPE_REPLACED)
                 replaced.append(diff)
         cv = version_compare(pkga.version, pkgb.version)
         diff = ImageDiffPKG(imgdiff_id=imgdiff.id,
+                            name=pn,
                             pkg_a_id=pkga.id,
                             pkg_b_id=pkgb.id)
         if cv == 1:
@@ -95,6 +100,7 @@ def gen_imagediff(imgdiff, img_a, img_b):
             upgraded.append(diff)
     for pn in sorted(a_pnms - b_pnms):
         diff = ImageDiffPKG(imgdiff_id=imgdiff.id,
+                            name=pn,
                             pkg_a_id=a_pkgs[pn].id,
                             pkgtype=ImageDiffPKG.TYPE_REMOVED)
         removed.append(diff)
@@ -107,6 +113,12 @@ def gen_imagediff(imgdiff, img_a, img_b):
     if all_diffs:
         with transaction.atomic():
             ImageDiffPKG.objects.bulk_create(all_diffs)
+    ImageDiffSummary.refresh(imgdiff.id)
+    imgdiff.completed_date = timezone.now()
+    imgdiff.save(update_fields=['completed_date'])
+    # the export of the diff is ready before it's downloaded
+    Task.enqueue('gen_export', {'kind': 'imagediff', 'id': imgdiff.id,
+                                'format': 'xlsx'})
 
     return diffs
 
@@ -126,6 +138,9 @@ def main(args):
     if idiff:
         if args.overwrite:
             logger.info("The image diff already exists, going to overwrite it")
+            # not exported until the packages are compared again
+            idiff.completed_date = None
+            idiff.save(update_fields=['completed_date'])
             ImageDiffPKG.objects.filter(imgdiff_id=idiff.id).delete()
         else:
             #assert False, "The image diff already exists, skipped"
@@ -137,10 +152,7 @@ def main(args):
     gen_imagediff(idiff, imga, imgb)
 
 
-if __name__ == '__main__':
-    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
-    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
-
+def get_parser():
     parser = argparse.ArgumentParser(prog=sys.argv[0])
     parser.add_argument('--image-a', '-a', action='store', required=True,
                         help="The name of image A")
@@ -148,7 +160,14 @@ if __name__ == '__main__':
                         help="The name of image B")
     parser.add_argument('--overwrite', '-o', action='store_true',
                         help="Overwrite the existing image diffs")
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    args = get_parser().parse_args()
     
     assert os.environ.get("WORKSPACE")
     main(args)
@@ -245,32 +245,23 @@ def mount(iso_file_path, iso_mount_point):
         ret = 1
     return ret
 
-def create_raw_data(iso_file_path, iso_mount_point='/mnt'):
+def create_raw_data(iso_file_path, raw_data_path, iso_mount_point='/mnt'):
     ret = mount(iso_file_path, iso_mount_point)
     if ret > 0:
         logger.error("    mount failed, ret: %s", ret)
         sys.exit(1)
     logger.info("    mount %s to %s successfully", iso_file_path, iso_mount_point)
 
-    cmd = ('cd %s/pool; for p in $(find . -name "*.deb"); do dpkg-deb -I $p; echo ""; echo ""; done > /opt/raw_data' % iso_mount_point)
+    cmd = ('cd %s/pool; for p in $(find . -name "*.deb"); do dpkg-deb -I $p; echo ""; echo ""; done > %s' % (iso_mount_point, raw_data_path))
     logger.debug('    cmd: %s', cmd)
     ret = subprocess.run(cmd, shell=True)
     ret = ret.returncode
+    # the mount point is reused by the next import of the workspace
+    subprocess.run('umount %s' % iso_mount_point, shell=True)
     return ret
 
-if __name__ == '__main__':
-    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
-    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
-
-    parser = argparse.ArgumentParser(prog=sys.argv[0])
-    parser.add_argument('--image', '-i', action='store', required=True,
-                        help="Specify OS image name")
-    parser.add_argument('--data-file', '-f', action='store',
-                        help="Specify package data file")
-    parser.add_argument('--overwrite', '-o', action='store_true', default=False,
-                        help="Overwrite the existing image packages")
-    args = parser.parse_args()
 
+def main(args):
     image = OSImage.objects.filter(name=args.image).first()
     assert image, "Image %s doesn't exist" % args.image
 
@@ -290,18 +281,24 @@ if __name__ == '__main__':
             image.save()
     else:
         if not image.raw_data and image.url:
+            # the files of the concurrent local jobs are kept apart in the
+            # workspaces of their pool slots, see lib/localwrapper.py
+            workdir = os.environ.get('WORKSPACE', '/opt')
+            iso_path = os.path.join(workdir, 'download.iso')
+            raw_data_path = os.path.join(workdir, 'raw_data')
             logger.info("Begin to download ISO from url: %s" % image.url)
-            success = download_file_from_url(image.url, "/opt/download.iso")
+            success = download_file_from_url(image.url, iso_path)
             if success:
-                ret = create_raw_data('/opt/download.iso')
+                ret = create_raw_data(iso_path, raw_data_path,
+                                      os.path.join(workdir, 'mnt'))
                 if ret > 0:
                     logger.error("create_raw_data run failed, ret: %s", ret)
                     sys.exit(1)
                 logger.info("create_raw_data run successfully: %s" % image.url)
-                if not os.path.isfile('/opt/raw_data'):
+                if not os.path.isfile(raw_data_path):
                     logger.error("raw_data file doesn't exist, quit")
                     sys.exit(1)
-                with open('/opt/raw_data', 'r') as f:
+                with open(raw_data_path, 'r') as f:
                     image.raw_data = f.read()
                     image.save()
             else:
@@ -320,3 +317,22 @@ if __name__ == '__main__':
             sys.exit(0)
 
     importer.import_image()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog=sys.argv[0])
+    parser.add_argument('--image', '-i', action='store', required=True,
+                        help="Specify OS image name")
+    parser.add_argument('--data-file', '-f', action='store',
+                        help="Specify package data file")
+    parser.add_argument('--overwrite', '-o', action='store_true', default=False,
+                        help="Overwrite the existing image packages")
+    return parser
+
+
+if __name__ == '__main__':
+    LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO')
+    logging.basicConfig(level=LOGLEVEL, format='%(levelname)-5s: %(message)s')
+
+    args = get_parser().parse_args()
+    main(args)
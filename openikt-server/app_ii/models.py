@@ -7,13 +7,13 @@ from difflib import SequenceMatcher
 from datetime import timezone as dttz
 from datetime import datetime, timedelta
 from argparse import ArgumentTypeError
-from django.db import models
+from django.db import models, transaction
 from django.db.models import JSONField
 from django.contrib.postgres.fields import ArrayField
 from django.db.models import Q, CharField, TextField, ForeignKey, IntegerField, \
                              DateTimeField, BooleanField, OneToOneField, \
                              ManyToManyField, BigIntegerField, Model, CASCADE, \
-                             DO_NOTHING
+                             DO_NOTHING, Count
 from django.db.models.functions import Cast
 from django.db.models.expressions import F, Value, Func
 
@@ -167,6 +167,8 @@ class ImageDiff(Model):
     img_a = ForeignKey(OSImage, related_name='img_a', on_delete=DO_NOTHING)
     img_b = ForeignKey(OSImage, related_name='img_b', on_delete=DO_NOTHING)
     created = DateTimeField(auto_now_add=True, null=True, blank=True)
+    # set when all the packages are compared
+    completed_date = DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ('img_a', 'img_b')
@@ -200,8 +202,45 @@ class ImageDiffPKG(Model):
     pkg_b = ForeignKey(Package, on_delete=CASCADE, related_name='pkg_b',
                        null=True, blank=True)
     pkgtype = IntegerField(choices=TYPE_CHOICES, default=TYPE_NEW)
+    # name of pkg b or pkg a, the sort key of the listing
+    name = CharField(max_length=256, default='', blank=True)
+
+    class Meta:
+        # keyset pagination of the packages of a diff, see ImageDiffPackage
+        indexes = [
+            models.Index(fields=['imgdiff', 'pkgtype', 'name', 'id'],
+                         name='imagediffpkg_keyset_idx'),
+        ]
 
     def __str__(self):
         return "%s: %s --> %s" % (self.get_pkgtype_display(),
                                   self.pkg_a.name if self.pkg_a else '-'*40,
                                   self.pkg_b.name if self.pkg_b else '-'*40)
+
+
+class ImageDiffSummary(Model):
+    """
+    Package counts of an image diff by type, refreshed at the end of
+    gen_imagediff() instead of counting the packages per web request
+    """
+    imgdiff = ForeignKey(ImageDiff, on_delete=CASCADE, related_name='summaries')
+    pkgtype = IntegerField(choices=ImageDiffPKG.TYPE_CHOICES)
+    count = IntegerField(default=0)
+    updated_date = DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('imgdiff', 'pkgtype')
+
+    def __str__(self):
+        return "%s: %i" % (self.get_pkgtype_display(), self.count)
+
+    @classmethod
+    def refresh(cls, imgdiff_id):
+        rows = ImageDiffPKG.objects.filter(imgdiff_id=imgdiff_id).values(
+                 'pkgtype').annotate(n=Count('id')).order_by()
+        summaries = [ cls(imgdiff_id=imgdiff_id, pkgtype=r['pkgtype'],
+                          count=r['n']) for r in rows ]
+        with transaction.atomic():
+            cls.objects.filter(imgdiff_id=imgdiff_id).delete()
+            cls.objects.bulk_create(summaries)
+        return summaries
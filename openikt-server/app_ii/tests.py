@@ -1,3 +1,37 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from app_diff.methods import encode_cursor
+from app_ii.views import ImageDiffPackage, ImportImageView
+
+
+class ImageDiffPackageTests(SimpleTestCase):
+    def test_invalid_page(self):
+        view = ImageDiffPackage.as_view()
+        factory = APIRequestFactory()
+        for params in ({'pageSize': 'x'}, {'pageSize': '-1'},
+                       {'cursor': 'not base64!'},
+                       {'cursor': encode_cursor([1, 'bash'])}):
+            params['DiffId'] = 1
+            resp = view(factory.get('/', params))
+            self.assertEqual(resp.status_code, 400, params)
+            self.assertEqual(resp.data['code'], 21008)
+
+
+class ImportImageViewTests(SimpleTestCase):
+    def test_notify_msg(self):
+        view = ImportImageView.as_view()
+        request = APIRequestFactory().post('/', {'imgA': {}, 'imgB': {}},
+                                           format='json')
+        force_authenticate(request, user=mock.Mock(email='a@example.com'))
+        with mock.patch.object(ImportImageView, 'judge_import',
+                               side_effect=['{a}', 'b}']), \
+             mock.patch('app_ii.views.Task.enqueue') as enqueue:
+            view(request)
+        # the task worker formats the msg by job_url
+        msg = enqueue.call_args[0][1]['notify']['msg']
+        self.assertEqual(msg.format(job_url='URL'),
+                         "The Openikt image inspector: Image A: {a}, "
+                         "Image B: b} job trigger successfully:<br>URL")
@@ -7,9 +7,10 @@ from django.http import JsonResponse
 from .serializers import *
 from .models import *
 from django.db.models import Q
-from lib.jenkinswrapper import JenkinsWrapper
-from lib.email import send_email
-from app_diff.methods import format_resp
+from app_diff.methods import format_resp, encode_cursor, decode_cursor, \
+                             keyset_filter
+from app_diff.models import Task
+from lib.jobwrapper import JOB_SERVER
 from django.contrib.auth.models import AnonymousUser
 # Create your views here.
 
@@ -89,10 +90,16 @@ class PKGTypesView(APIView):
     """
 
     def get(self, request):
-        """get package type api"""
+        """get package type api, with the package counts of DiffId"""
+        diff_id = request.query_params.get('DiffId')
         pkgType = [
             {"label": i[1], "value": i[0]} for i in ImageDiffPKG.TYPE_CHOICES
         ]
+        if diff_id:
+            counts = dict(ImageDiffSummary.objects.filter(
+                            imgdiff_id=diff_id).values_list('pkgtype', 'count'))
+            for t in pkgType:
+                t['count'] = counts.get(t['value'], 0)
         return Response(data=format_resp(data=pkgType), status=status.HTTP_200_OK)
 
 
@@ -110,14 +117,22 @@ class ImportImageView(APIView):
                             status=status.HTTP_401_UNAUTHORIZED)
         img_a = self.judge_import(img=data.get('imgA'))
         img_b = self.judge_import(img=data.get('imgB'))
-        job = JenkinsWrapper(server_name='cje_jenkins')
-        job.trigger_job(name='image-inspector', group='OpenIKT', data={'img_a': img_a, 'img_b': img_b})
-        send_email(
-            msg=f'The Openikt image inspector: Image A: {img_a}, Image B: {img_b} job trigger successfully:<br>'
-                f'{job.job_url_base}',
-            user_email=req_user.email
-        )
-        return Response(data=format_resp(data={}), status=status.HTTP_200_OK)
+        # the jenkins job is triggered and the email is sent by the task
+        # worker, the msg is formatted by job_url so the braces are escaped
+        imgs = ("Image A: %s, Image B: %s" % (img_a, img_b)).replace(
+                 '{', '{{').replace('}', '}}')
+        task = Task.enqueue('trigger_job', {
+            'server': JOB_SERVER,
+            'name': 'image-inspector',
+            'group': 'OpenIKT',
+            'data': {'img_a': img_a, 'img_b': img_b},
+            'notify': {
+                'user_email': req_user.email,
+                'msg': 'The Openikt image inspector: ' + imgs + \
+                       ' job trigger successfully:<br>{job_url}',
+            },
+        })
+        return Response(data=format_resp(data={"taskId": task.id}), status=status.HTTP_200_OK)
 
     @staticmethod
     def judge_import(img):
@@ -209,13 +224,26 @@ class ImageUrlVerify(APIView):
 class ImageDiffPackage(APIView):
     """
     Summary:
-        get all image diff package
+        get image diff packages, all of them unless pageSize or cursor is
+        given, the next page is the one after detail.nextCursor
     """
+    # sort key of the packages, see ImageDiffPKG.Meta.indexes
+    ORDER = ('pkgtype', 'name', 'id')
 
     def get(self, request, *args, **kwargs):
         diff_id = request.query_params.get('DiffId')
         package_name = request.query_params.get('packageName')
         package_type = request.query_params.get('diffType')
+        pagesize = request.query_params.get('pageSize')
+        cursor = request.query_params.get('cursor')
+        try:
+            after = decode_cursor(cursor, len(self.ORDER))
+            pagesize = int(pagesize) if pagesize else None
+            if pagesize is not None and pagesize <= 0:
+                raise ValueError("Invalid page size: %i" % pagesize)
+        except ValueError:
+            return Response(data=format_resp(code=21008, msg="Invalid Page"),
+                            status=status.HTTP_400_BAD_REQUEST)
 
         query = Q(imgdiff_id=diff_id)
         if package_name:
@@ -224,9 +252,26 @@ class ImageDiffPackage(APIView):
         if package_type:
             pkg_t = package_type.split(',')
             query = query & Q(pkgtype__in=pkg_t)
-        image_diff_pag = ImageDiffPKG.objects.filter(query).order_by('pkgtype', 'pkg_a__name', 'pkg_b__name')
+        image_diff_pag = ImageDiffPKG.objects.select_related(
+                           'pkg_a', 'pkg_b').filter(query)
+        next_cursor = None
+        if pagesize or cursor is not None:
+            pagesize = pagesize or 100
+            image_diff_pag = image_diff_pag.order_by(*self.ORDER)
+            if after:
+                image_diff_pag = image_diff_pag.filter(keyset_filter(self.ORDER, after))
+            image_diff_pag = list(image_diff_pag[:pagesize])
+            if len(image_diff_pag) == pagesize:
+                last = image_diff_pag[-1]
+                next_cursor = encode_cursor([ getattr(last, f) for f in self.ORDER ])
+        else:
+            # the full list of the web UI
+            image_diff_pag = image_diff_pag.order_by('pkgtype', 'pkg_a__name',
+                                                     'pkg_b__name')
         ser = ImageDiffPkgSerializers(instance=image_diff_pag, many=True)
-        return Response(data=format_resp(data={"tableData": ser.data}), status=status.HTTP_200_OK)
+        return Response(data=format_resp(data={"tableData": ser.data},
+                                         detail={"nextCursor": next_cursor}),
+                        status=status.HTTP_200_OK)
 
 
 class PKGDetail(APIView):
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the diff generation hot paths on synthetic git repos
+
+The repos are generated by synthrepo.py(or reused with --repos), each
+benchmark is run --repeat times and the best/median run is reported.
+The results are saved to bench/results/<label>.json and compared with a
+previous result by --compare, e.g.:
+    ./bench_diff.py -p 2000 -u 3000 -l v2.0-base
+    ./bench_diff.py -p 2000 -u 3000 -l v2.0-new -c results/v2.0-base.json
+
+import_rdiff needs the database, it runs against a django test database
+with --db, e.g.:
+    DJANGO_SETTINGS_MODULE=settings.settings ./bench_diff.py --db
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import git
+
+from synthrepo import gen_repos
+from lib.jobstats import STATS
+from lib.gitutils import parse_rangediff, gen_quiltdiff, similar_patches, \
+                         find_upstreamed_tag, prepare_repo, prepare_repos, \
+                         get_patchids, object_reader, parallel_rangediff, \
+                         py_rangediff
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+
+def run_bench(func, repeat, items):
+    """
+    func: the benchmark body, called repeat times
+    items: number of the items processed per call
+    """
+    seconds = []
+    for _ in range(repeat):
+        STATS.reset()
+        t0 = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - t0)
+    best = min(seconds)
+    return {
+        'items': items,
+        'runs': [ round(s, 4) for s in seconds ],
+        'best': round(best, 4),
+        'median': round(statistics.median(seconds), 4),
+        'items_per_sec': round(items / best, 1) if best else None,
+        # stage timers and counters of the last run
+        'stats': STATS.summary(),
+    }
+
+def bench_parse_rangediff(ctx, repeat):
+    repo = ctx['repo']
+    diff_text = repo.git.range_diff(ctx['range_a'], ctx['range_b'])
+    nlines = diff_text.count('\n')
+    return run_bench(lambda: parse_rangediff(diff_text, repo), repeat, nlines)
+
+def bench_rangediff(ctx, repeat, workers=0):
+    repo = ctx['repo']
+    def body():
+        if workers:
+            parallel_rangediff(repo, ctx['range_a'], ctx['range_b'], workers)
+        else:
+            parse_rangediff(repo.git.range_diff(ctx['range_a'],
+                                                ctx['range_b']), repo)
+    return run_bench(body, repeat, ctx['info']['npatches'])
+
+def bench_rangediff_parallel(ctx, repeat):
+    return bench_rangediff(ctx, repeat, ctx['jobs'])
+
+def bench_py_rangediff(ctx, repeat):
+    repo = ctx['repo']
+    return run_bench(lambda: py_rangediff(repo, ctx['range_a'],
+                                          ctx['range_b']),
+                     repeat, ctx['info']['npatches'])
+
+def bench_gen_quiltdiff(ctx, repeat):
+    info = ctx['info']
+    path = os.path.join(ctx['workdir'], 'quiltdiff')
+    def body():
+        gen_quiltdiff(info['urls']['tree-a'], info['urls']['tree-b'],
+                      info['ref_a'], info['ref_b'], info['base_a'],
+                      info['base_b'], repo_path=path, check_base=False,
+                      intel_only=False)
+    return run_bench(body, repeat, info['npatches'])
+
+def bench_similar_patches(ctx, repeat):
+    repo = ctx['repo']
+    reader = object_reader(repo)
+    revs_a = repo.git.rev_list('--reverse', ctx['range_a']).split()
+    revs_b = repo.git.rev_list('--reverse', ctx['range_b']).split()
+    # compare each patch with its neighbours in the other series
+    pairs = []
+    for i, ca in enumerate(revs_a):
+        da = reader.diff(ca)
+        for cb in revs_b[max(0, i - 2):i + 3]:
+            pairs.append((da, reader.diff(cb),))
+    def body():
+        for da, db in pairs:
+            similar_patches(da, db)
+    return run_bench(body, repeat, len(pairs))
+
+def bench_find_upstreamed_tag(ctx, repeat):
+    repo = ctx['mainline']
+    pids = { pid: { 'commit': c, 'tag': 'v6.2' } \
+               for c, pid in get_patchids('v6.1..v6.2', repo).items() }
+    # the commits of tree a are in the diff repo rather than mainline
+    repo_a = ctx['repo']
+    revs = repo_a.git.rev_list(ctx['range_a']).split()
+    # the upstreamed patches are found by pid, the others fall back to
+    # the search by files
+    gitcs = [ git.Commit(repo_a, bytes.fromhex(c)) for c in revs[:200] ]
+    def body():
+        for gitc in gitcs:
+            find_upstreamed_tag(gitc, repo, pids)
+    return run_bench(body, repeat, len(gitcs))
+
+def bench_import_rdiff(ctx, repeat):
+    if "DJANGO_SETTINGS_MODULE" not in os.environ:
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings.settings")
+    import django
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    # never touch the real database
+    old_name = connection.creation.create_test_db(verbosity=0,
+                                                  autoclobber=True)
+    try:
+        from app_diff.models import Repository, RangeDiff, RangeDiffPatch, \
+                                    UpstreamedPatch
+        from app_diff.rangediff_gen import import_rdiff
+        info = ctx['info']
+        repos = {}
+        for name, rname in (('mainline', 'kernel.org main'),
+                            ('mainline', 'kernel.org stable'),
+                            ('tree-a', 'tree a'), ('tree-b', 'tree b')):
+            repos[rname] = Repository.objects.create(
+                             protocol='file', host='',
+                             project=info['urls'][name][len('file:///'):],
+                             name=rname)
+        repo = ctx['repo']
+        diffs = parse_rangediff(
+                  repo.git.range_diff(ctx['range_a'], ctx['range_b']), repo)
+        def body():
+            UpstreamedPatch.objects.all().delete()
+            RangeDiffPatch.objects.all().delete()
+            RangeDiff.objects.all().delete()
+            rdiff = RangeDiff.objects.create(
+                      ref_a=info['ref_a'], ref_b=info['ref_b'],
+                      base_a=info['base_a'], base_b=info['base_b'],
+                      repo_a=repos['tree a'], repo_b=repos['tree b'])
+            import_rdiff(repo, repo, rdiff, diffs)
+        return run_bench(body, repeat, sum(len(pl) for pl in diffs))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+BENCHMARKS = {
+    'parse_rangediff': bench_parse_rangediff,
+    'rangediff': bench_rangediff,
+    'rangediff_parallel': bench_rangediff_parallel,
+    'py_rangediff': bench_py_rangediff,
+    'gen_quiltdiff': bench_gen_quiltdiff,
+    'similar_patches': bench_similar_patches,
+    'find_upstreamed_tag': bench_find_upstreamed_tag,
+    'import_rdiff': bench_import_rdiff,
+}
+
+def default_label():
+    try:
+        sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=BENCH_DIR, text=True).strip()
+    except subprocess.CalledProcessError:
+        sha = 'unknown'
+    return "%s-%s" % (datetime.now().strftime("%Y%m%dT%H%M%S"), sha)
+
+def compare(results, base_fl):
+    with open(base_fl) as f:
+        base = json.load(f)
+    lines = [ "%-22s %10s %10s %8s" % ('benchmark', 'base(s)', 'this(s)',
+                                        'speedup') ]
+    for name, r in results['benchmarks'].items():
+        b = base['benchmarks'].get(name)
+        if not b:
+            continue
+        lines.append("%-22s %10.4f %10.4f %7.2fx" % \
+                       (name, b['best'], r['best'],
+                        b['best'] / r['best'] if r['best'] else 0))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+               description="Benchmark the diff generation on synthetic repos")
+    parser.add_argument('--repos', '-r', type=str, default=None,
+                        help="Directory of the repos generated by "
+                             "synthrepo.py, generated in a temp dir if unset")
+    parser.add_argument('--patches', '-p', type=int, default=1000,
+                        help="Number of patches of tree a")
+    parser.add_argument('--upstream', '-u', type=int, default=1000,
+                        help="Number of mainline commits in v6.1..v6.2")
+    parser.add_argument('--files', '-f', type=int, default=400,
+                        help="Number of driver files")
+    parser.add_argument('--seed', '-s', type=int, default=1,
+                        help="Random seed")
+    parser.add_argument('--repeat', '-n', type=int, default=3,
+                        help="Runs of each benchmark")
+    parser.add_argument('--jobs', '-j', type=int, default=4,
+                        help="Workers of rangediff_parallel")
+    parser.add_argument('--bench', '-b', type=str, action='append',
+                        choices=BENCHMARKS.keys(), default=None,
+                        help="Benchmark to run, all but import_rdiff "
+                             "if unset")
+    parser.add_argument('--db', action='store_true',
+                        help="Run import_rdiff on a django test database")
+    parser.add_argument('--label', '-l', type=str, default=None,
+                        help="Label of the results, "
+                             "defaults to <timestamp>-<git sha>")
+    parser.add_argument('--compare', '-c', type=str, default=None,
+                        help="Previous result file to compare with")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Log the details of the diff functions")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    names = args.bench or [ n for n in BENCHMARKS if n != 'import_rdiff' ]
+    if args.db and 'import_rdiff' not in names:
+        names.append('import_rdiff')
+
+    workdir = tempfile.mkdtemp(prefix='openikt-bench-')
+    # the repos are cloned to $WORKSPACE/job, see gen_repo_path()
+    os.environ['WORKSPACE'] = workdir
+    try:
+        if args.repos and os.path.exists(os.path.join(args.repos,
+                                                      'info.json')):
+            with open(os.path.join(args.repos, 'info.json')) as f:
+                info = json.load(f)
+        else:
+            repos_dir = args.repos or os.path.join(workdir, 'repos')
+            t0 = time.perf_counter()
+            info = gen_repos(repos_dir, args.patches, args.upstream,
+                             args.files, args.seed)
+            print("Generated repos in %.1fs: %s" % \
+                    (time.perf_counter() - t0, json.dumps(info['counts'])))
+        # the working repos as the diff jobs prepare them
+        mainline = prepare_repo(info['urls']['mainline'],
+                                os.path.join(workdir, 'mainline'))
+        repo = prepare_repos((('rangediff_b', info['urls']['tree-b'],),
+                              ('rangediff_a', info['urls']['tree-a'],),),
+                             os.path.join(workdir, 'rangediff'))
+        # git abbreviates the shas of the small repos to 7 chars, the
+        # kernel ones are 12 chars as parse_rangediff() expects
+        repo.git.config('core.abbrev', '12')
+        ctx = {
+            'info': info,
+            'workdir': workdir,
+            'mainline': mainline,
+            'repo': repo,
+            'range_a': "%s..%s" % (info['base_a'], info['ref_a']),
+            'range_b': "%s..%s" % (info['base_b'], info['ref_b']),
+            'jobs': args.jobs,
+        }
+        results = {
+            'label': args.label or default_label(),
+            'date': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'git': git.Git().version(),
+            'repos': { k: info[k] for k in ('npatches', 'nupstream', 'nfiles',
+                                            'seed', 'counts') },
+            'benchmarks': {},
+        }
+        for name in names:
+            r = BENCHMARKS[name](ctx, args.repeat)
+            results['benchmarks'][name] = r
+            print("%-22s best %8.4fs  median %8.4fs  %10.1f items/s" % \
+                    (name, r['best'], r['median'], r['items_per_sec'] or 0))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    result_fl = os.path.join(RESULTS_DIR, "%s.json" % results['label'])
+    with open(result_fl, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to %s" % result_fl)
+    if args.compare:
+        print(compare(results, args.compare))
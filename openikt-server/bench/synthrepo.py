@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic kernel-like git repos for benchmarks, offline
+
+The mainline repo has the tags v6.1 and v6.2, tree a carries a patch
+series on v6.1 and tree b carries a variant of the series on v6.2:
+    same     the patch is rebased without change
+    cmco     the commit message is changed only
+    updated  the diff is changed
+    removed  the patch is dropped, part of them are upstreamed in v6.2
+    new      the patch is only in tree b
+
+The commits are written by git fast-import, the patches touch the
+driver files only and insert lines after the anchor lines, so that the
+rebased patches have the same patch ids as the originals.
+
+Usage:
+    ./synthrepo.py -o /tmp/synth -p 2000 -u 3000
+"""
+import os
+import json
+import random
+import logging
+import argparse
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+SUBSYSTEMS = ('drm/i915', 'net/ethernet/intel', 'gpu/drm/xe', 'platform/x86',
+              'thermal/intel', 'media/pci/intel', 'soundwire', 'iommu/intel')
+CORE_DIRS = ('kernel', 'mm', 'fs', 'net/core', 'lib', 'include/linux')
+# function lines of a file, the patches insert lines after them
+NFUNCS = 40
+# ratio of the patch kinds in tree b, the rest are same
+KIND_RATIOS = (('cmco', 0.08), ('updated', 0.08), ('removed', 0.07))
+NEW_RATIO = 0.07
+# ratio of the removed patches which are upstreamed
+UPSTREAMED_RATIO = 0.5
+
+
+class FastImport:
+    """writer of a git fast-import stream"""
+    def __init__(self, repo_path):
+        self.proc = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                     cwd=repo_path, stdin=subprocess.PIPE)
+        self.mark = 0
+        # seconds since epoch of the commits
+        self.ts = 1660000000
+
+    def write(self, s):
+        self.proc.stdin.write(s.encode() if isinstance(s, str) else s)
+
+    def data(self, s):
+        b = s.encode()
+        self.write("data %i\n" % len(b))
+        self.write(b)
+        self.write("\n")
+
+    def commit(self, branch, parent, author, message, files):
+        """
+        files: dict mapping path to content
+        returns: mark of the commit
+        """
+        self.mark += 1
+        self.ts += 60
+        name = author.split('@')[0]
+        self.write("commit refs/heads/%s\nmark :%i\n" % (branch, self.mark))
+        self.write("author %s <%s> %i +0000\n" % (name, author, self.ts))
+        self.write("committer %s <%s> %i +0000\n" % (name, author, self.ts))
+        self.data(message)
+        if parent:
+            self.write("from :%i\n" % parent)
+        for path, content in sorted(files.items()):
+            self.write("M 100644 inline %s\n" % path)
+            self.data(content)
+        self.write("\n")
+        return self.mark
+
+    def ref(self, ref, mark):
+        self.write("reset %s\nfrom :%i\n\n" % (ref, mark))
+
+    def close(self):
+        self.proc.stdin.close()
+        assert self.proc.wait() == 0, "git fast-import failed"
+
+
+class Tree:
+    """the files of a branch, mapping path to list of lines"""
+    def __init__(self, files=None):
+        self.files = { p: list(l) for p, l in (files or {}).items() }
+
+    def copy(self):
+        return Tree(self.files)
+
+    def apply(self, change):
+        """
+        change: list of (path, anchor, lines), the lines are inserted
+                after the anchor line
+        returns: dict mapping the changed path to content
+        """
+        changed = {}
+        for path, anchor, lines in change:
+            content = self.files[path]
+            idx = content.index(anchor) + 1
+            content[idx:idx] = lines
+            changed[path] = '\n'.join(content) + '\n'
+        return changed
+
+
+def gen_file(path, seed):
+    name = os.path.splitext(os.path.basename(path))[0]
+    lines = [ "// SPDX-License-Identifier: GPL-2.0", "/* %s */" % path, "" ]
+    for j in range(NFUNCS):
+        lines.append("int %s_fn%i(void) { return %i; }" % (name, j, seed + j))
+    return lines
+
+def gen_patch(rnd, k, drv_files):
+    # 1-3 files, 1-2 hunks each
+    change = []
+    for path in rnd.sample(drv_files, rnd.randint(1, 3)):
+        name = os.path.splitext(os.path.basename(path))[0]
+        for j in rnd.sample(range(NFUNCS), rnd.randint(1, 2)):
+            anchor = "int %s_fn%i(void) { return " % (name, j)
+            lines = [ "\tpr_debug(\"p%i %s %i %i\");" % (k, name, j, n) \
+                        for n in range(rnd.randint(1, 5)) ]
+            change.append((path, anchor, lines,))
+    sub = path.split('/')[1]
+    author = rnd.choice(('alice', 'bob', 'carol', 'dave', 'erin'))
+    domain = 'intel.com' if rnd.random() < 0.9 else 'example.org'
+    return {
+        'seq': k,
+        'subject': "%s: fix %s_fn%i handling #%i" % (sub, name, j, k),
+        'body': "Fix the handling of %s.\n\nSigned-off-by: %s <%s@%s>" % \
+                  (name, author, author, domain),
+        'author': "%s@%s" % (author, domain),
+        'change': change,
+    }
+
+def resolve_anchors(tree, change):
+    # anchors are prefixes of the function lines
+    resolved = []
+    for path, anchor, lines in change:
+        full = next(l for l in tree.files[path] if l.startswith(anchor))
+        resolved.append((path, full, lines,))
+    return resolved
+
+def message(p, cmco=False):
+    body = p['body']
+    if cmco:
+        body = "Reworded for the rebase.\n\n" + body
+    return "%s\n\n%s\n" % (p['subject'], body)
+
+def gen_repos(outdir, npatches=1000, nupstream=1000, nfiles=400, seed=1):
+    """
+    returns: dict of the repo urls, refs and the expected diff counts
+    """
+    rnd = random.Random(seed)
+    mainline = os.path.join(outdir, 'linux.git')
+    os.makedirs(mainline, exist_ok=True)
+    subprocess.check_call(['git', 'init', '-q', '--bare', mainline])
+    drv_files = [ "drivers/%s/drv%i.c" % (rnd.choice(SUBSYSTEMS), i) \
+                    for i in range(nfiles) ]
+    core_files = [ "%s/core%i.c" % (rnd.choice(CORE_DIRS), i) \
+                     for i in range(nfiles // 4) ]
+    files = { p: gen_file(p, i * NFUNCS) \
+                for i, p in enumerate(drv_files + core_files) }
+
+    fi = FastImport(mainline)
+    base_tree = Tree(files)
+    base = fi.commit('master', None, 'torvalds@linux-foundation.org',
+                     "Linux 6.1\n",
+                     { p: '\n'.join(l) + '\n' for p, l in files.items() })
+    fi.ref('refs/tags/v6.1', base)
+
+    # the patch series of tree a
+    series = [ gen_patch(rnd, k, drv_files) for k in range(npatches) ]
+    tree_a = base_tree.copy()
+    mark = base
+    for p in series:
+        p['change'] = resolve_anchors(tree_a, p['change'])
+        mark = fi.commit('tree-a', mark, p['author'], message(p),
+                         tree_a.apply(p['change']))
+    fi.ref('refs/tags/tree-a-v6.1', mark)
+
+    # decide the kind of each patch in tree b
+    counts = { 'same': 0, 'cmco': 0, 'updated': 0, 'removed': 0, 'new': 0,
+               'upstreamed': 0 }
+    for p in series:
+        r = rnd.random()
+        p['kind'] = 'same'
+        for kind, ratio in KIND_RATIOS:
+            if r < ratio:
+                p['kind'] = kind
+                break
+            r -= ratio
+        p['upstreamed'] = p['kind'] == 'removed' and \
+                            rnd.random() < UPSTREAMED_RATIO
+        counts[p['kind']] += 1
+        counts['upstreamed'] += p['upstreamed']
+
+    # mainline v6.1..v6.2: core changes and the upstreamed patches
+    up_tree = base_tree.copy()
+    upstreamed = [ p for p in series if p['upstreamed'] ]
+    mark = base
+    for i in range(nupstream):
+        if upstreamed and rnd.random() < len(upstreamed) / (nupstream - i):
+            p = upstreamed.pop(0)
+            mark = fi.commit('master', mark, p['author'], message(p),
+                             up_tree.apply(p['change']))
+            continue
+        path = rnd.choice(core_files)
+        name = os.path.splitext(os.path.basename(path))[0]
+        prefix = "int %s_fn%i(" % (name, rnd.randrange(NFUNCS))
+        anchor = next(l for l in up_tree.files[path] if l.startswith(prefix))
+        change = [ (path, anchor, [ "\t/* upstream %i */" % i ],) ]
+        mark = fi.commit('master', mark, 'dev%i@kernel.org' % (i % 50),
+                         "%s: core change %i\n" % (path.split('/')[0], i),
+                         up_tree.apply(change))
+    for p in upstreamed:
+        mark = fi.commit('master', mark, p['author'], message(p),
+                         up_tree.apply(p['change']))
+    mark = fi.commit('master', mark, 'torvalds@linux-foundation.org',
+                     "Linux 6.2\n", {})
+    fi.ref('refs/tags/v6.2', mark)
+
+    # the variant series of tree b on v6.2
+    tree_b = up_tree.copy()
+    for p in series:
+        if p['kind'] == 'removed':
+            continue
+        if p['kind'] == 'updated':
+            path, anchor, lines = p['change'][0]
+            lines = lines[:-1] + [ lines[-1].replace('pr_debug', 'pr_info') ]
+            change = [ (path, anchor, lines,) ] + p['change'][1:]
+        else:
+            change = p['change']
+        mark = fi.commit('tree-b', mark, p['author'],
+                         message(p, cmco=p['kind'] == 'cmco'),
+                         tree_b.apply(change))
+        if rnd.random() < NEW_RATIO:
+            q = gen_patch(rnd, npatches + counts['new'], drv_files)
+            q['change'] = resolve_anchors(tree_b, q['change'])
+            mark = fi.commit('tree-b', mark, q['author'], message(q),
+                             tree_b.apply(q['change']))
+            counts['new'] += 1
+    fi.ref('refs/tags/tree-b-v6.2', mark)
+    fi.close()
+
+    # the downstream trees are mirrors of the mainline repo
+    urls = { 'mainline': "file://%s" % mainline }
+    for name in ('tree-a', 'tree-b'):
+        path = os.path.join(outdir, "%s.git" % name)
+        if not os.path.exists(path):
+            subprocess.check_call(['git', 'clone', '-q', '--mirror',
+                                   mainline, path])
+        urls[name] = "file://%s" % path
+
+    info = {
+        'urls': urls,
+        'ref_a': 'tree-a-v6.1',
+        'base_a': 'v6.1',
+        'ref_b': 'tree-b-v6.2',
+        'base_b': 'v6.2',
+        'npatches': npatches,
+        'nupstream': nupstream,
+        'nfiles': nfiles,
+        'seed': seed,
+        'counts': counts,
+    }
+    with open(os.path.join(outdir, 'info.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+               description="Generate synthetic kernel-like git repos")
+    parser.add_argument('--outdir', '-o', type=str, required=True,
+                        help="Output directory, must not exist")
+    parser.add_argument('--patches', '-p', type=int, default=1000,
+                        help="Number of patches of tree a")
+    parser.add_argument('--upstream', '-u', type=int, default=1000,
+                        help="Number of mainline commits in v6.1..v6.2")
+    parser.add_argument('--files', '-f', type=int, default=400,
+                        help="Number of driver files")
+    parser.add_argument('--seed', '-s', type=int, default=1,
+                        help="Random seed")
+    args = parser.parse_args()
+
+    assert not os.path.exists(args.outdir), \
+           "Output directory exists: %s" % args.outdir
+    info = gen_repos(args.outdir, args.patches, args.upstream,
+                     args.files, args.seed)
+    print(json.dumps(info, indent=2))
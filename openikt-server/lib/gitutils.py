@@ -10,8 +10,14 @@ import re
 import pty
 import git
 import time
+import atexit
+import bisect
 import logging
+import threading
+import subprocess
 from urllib.parse import urlsplit
+from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from github import Github, GithubException, UnknownObjectException
 
@@ -21,11 +27,256 @@ from django.db.models import Q, F
 
 from lib.pushd import pushd
 from lib import utils
+from lib.jobstats import STATS, PROFILER, PROGRESS
 
 
 logger = logging.getLogger(__name__)
 
 
+#
+# Classes
+#
+class ProfiledGit(git.cmd.Git):
+    """
+    git command wrapper recording the name, duration and output size of
+    each call, see lib.jobstats.PROFILER
+    """
+    # e.g. "/usr/bin/git -c core.quotepath=off log ..." or
+    #      "git show <sha> | git patch-id"
+    subcmd_re = re.compile(r'(?:^|[\s|;&/])git(?:\s+-c\s+\S+)*\s+([a-z][\w-]*)')
+
+    @classmethod
+    def cmd_name(cls, command):
+        if not isinstance(command, str):
+            command = ' '.join(str(c) for c in command)
+        names = cls.subcmd_re.findall(command)
+        return '|'.join(names) if names else 'git'
+
+    def execute(self, command, *args, **kwargs):
+        t0 = time.time()
+        out = None
+        error = False
+        try:
+            out = super().execute(command, *args, **kwargs)
+            return out
+        except Exception:
+            error = True
+            raise
+        finally:
+            # output of with_extended_output: (status, stdout, stderr)
+            stdout = out[1] if isinstance(out, tuple) else out
+            if isinstance(stdout, str):
+                nbytes = len(stdout.encode('utf-8', 'surrogateescape'))
+            elif isinstance(stdout, bytes):
+                nbytes = len(stdout)
+            else:
+                # as_process
+                nbytes = 0
+            PROFILER.record("git " + self.cmd_name(command),
+                            time.time() - t0, nbytes, error)
+
+# all repo.git.* calls go through the wrapper
+git.Repo.GitCommandWrapperType = ProfiledGit
+
+
+class ObjectReader:
+    """
+    Read the objects and diffs of a repository with long-lived git
+    processes instead of one git command per commit:
+        git cat-file --batch         raw objects, e.g. commits
+        git diff-tree --stdin -p     patch text of a commit(as git show)
+        git diff-tree --stdin ...    numstat of a commit(as commit.stats)
+
+    The diff-tree processes echo the lines which are not object ids, so a
+    sentinel line is written after each request to delimit its output.
+    The reader of a repository is shared by threads, see object_reader(),
+    the requests are serialized by a lock.
+    """
+    SENTINEL = b'--openikt-end--'
+    hexsha_re = re.compile(r'^[0-9a-f]{40}$')
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.lock = threading.Lock()
+        # dict: mapping name to the git process
+        self.procs = {}
+        self.cmds = {
+            'cat-file': ['cat-file', '--batch'],
+            'diff-tree': ['diff-tree', '--stdin', '--root', '--no-commit-id',
+                          '-p', '-M'],
+            'numstat': ['diff-tree', '--stdin', '--root', '--no-commit-id',
+                        '-r', '--numstat', '--no-renames'],
+        }
+
+    def _proc(self, name):
+        proc = self.procs.get(name)
+        if not proc or proc.poll() is not None:
+            proc = subprocess.Popen([git.Git.GIT_PYTHON_GIT_EXECUTABLE] + \
+                                      self.cmds[name],
+                                    cwd=self.repo.working_dir,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL)
+            self.procs[name] = proc
+        return proc
+
+    def _kill(self, name):
+        proc = self.procs.pop(name, None)
+        if proc:
+            proc.kill()
+            proc.wait()
+
+    def close(self):
+        with self.lock:
+            for name in list(self.procs.keys()):
+                proc = self.procs.pop(name)
+                proc.stdin.close()
+                proc.wait()
+
+    def _request(self, name, line, reader):
+        t0 = time.time()
+        out = b''
+        error = True
+        try:
+            proc = self._proc(name)
+            proc.stdin.write(line)
+            proc.stdin.flush()
+            out = reader(proc)
+            error = False
+            return out
+        except (BrokenPipeError, EOFError):
+            # restart the process on the next request
+            self._kill(name)
+            raise EOFError("git %s exited" % name)
+        finally:
+            PROFILER.record("git %s" % name, time.time() - t0,
+                            len(out or b''), error)
+
+    def read(self, rev):
+        """
+        Read an object by cat-file
+
+        returns: (hexsha, type, data in bytes), or None if not exist
+        """
+        def reader(proc):
+            header = proc.stdout.readline()
+            if not header:
+                raise EOFError()
+            fields = header.split()
+            if fields[-1] == b'missing' or fields[-1] == b'ambiguous':
+                return None
+            size = int(fields[2])
+            # the object data is followed by a LF
+            data = proc.stdout.read(size + 1)
+            if len(data) != size + 1:
+                raise EOFError()
+            return (fields[0].decode(), fields[1].decode(), data[:-1])
+
+        with self.lock:
+            return self._request('cat-file', ("%s\n" % rev).encode(), reader)
+
+    def _read_commit(self, rev):
+        obj = self.read(rev)
+        if not obj or obj[1] != 'commit':
+            raise ValueError("Bad commit: %s" % rev)
+        return obj
+
+    def commit(self, rev):
+        """
+        The commit object with all attributes loaded, no lazy loading
+        through repo.odb which is not thread-safe
+        """
+        hexsha, _, data = self._read_commit(rev)
+        gitc = git.Commit(self.repo, bytes.fromhex(hexsha))
+        gitc.size = len(data)
+        gitc._deserialize(io.BytesIO(data))
+        return gitc
+
+    def _diff_tree(self, name, line):
+        def reader(proc):
+            lines = []
+            while True:
+                l = proc.stdout.readline()
+                if not l:
+                    raise EOFError()
+                if l.rstrip(b'\n') == self.SENTINEL:
+                    break
+                lines.append(l)
+            return b''.join(lines)
+
+        with self.lock:
+            return self._request(name, line + b'\n' + self.SENTINEL + b'\n',
+                                 reader)
+
+    def diff(self, rev):
+        """
+        Patch text of a commit, same diffs as "git show", the merge commit
+        has no diff
+        """
+        hexsha = rev if self.hexsha_re.match(rev) else \
+                   self._read_commit(rev)[0]
+        out = self._diff_tree('diff-tree', hexsha.encode())
+        return out.decode('utf-8', 'replace')
+
+    def stats(self, rev):
+        """
+        Stats of a commit against its first parent, same as commit.stats
+        """
+        hexsha, _, data = self._read_commit(rev)
+        line = hexsha
+        for l in data.splitlines():
+            if l.startswith(b'parent '):
+                line += ' ' + l.split()[1].decode()
+                break
+            elif not l:
+                break
+        out = self._diff_tree('numstat', line.encode())
+        total = {'insertions': 0, 'deletions': 0, 'lines': 0, 'files': 0}
+        files = {}
+        for l in out.decode('utf-8', 'replace').splitlines():
+            ins, dels, f = l.split('\t', 2)
+            ins = int(ins) if ins != '-' else 0
+            dels = int(dels) if dels != '-' else 0
+            files[f] = {'insertions': ins, 'deletions': dels,
+                        'lines': ins + dels}
+            total['insertions'] += ins
+            total['deletions'] += dels
+            total['lines'] += ins + dels
+            total['files'] += 1
+        return git.Stats(total, files)
+
+
+# dict: mapping git dir to the shared ObjectReader
+_object_readers = {}
+_object_readers_lock = threading.Lock()
+
+def object_reader(repo):
+    """the shared ObjectReader of a repository"""
+    with _object_readers_lock:
+        reader = _object_readers.get(repo.git_dir)
+        if not reader:
+            reader = ObjectReader(repo)
+            _object_readers[repo.git_dir] = reader
+        return reader
+
+@atexit.register
+def close_object_readers(path=None):
+    """
+    close the shared ObjectReaders, only the ones of the repositories in
+    path if it's given, e.g. before the repository is removed or fetched,
+    the git processes keep reading the object store they started with
+    """
+    if path:
+        path = os.path.realpath(path)
+    with _object_readers_lock:
+        for git_dir in list(_object_readers.keys()):
+            real_dir = os.path.realpath(git_dir)
+            if path and real_dir != path and \
+               not real_dir.startswith(path + os.sep):
+                continue
+            _object_readers.pop(git_dir).close()
+
+
 #
 # Functions
 #
@@ -53,7 +304,7 @@ def peek_repo(ref, url=None, repo=None):
     else:
         output = None
         if url:
-            g = git.cmd.Git()
+            g = ProfiledGit()
             try:
                 output = g.ls_remote(
                   "--heads", "--tags", url, ref.replace("origin/", ''))
@@ -95,12 +346,15 @@ def gen_repo_path(url):
 
     return path
 
+@STATS.timed()
 @utils.retry(err_kw="HTTP code 503")
 def prepare_repo(url, path=None, ref=None):
     if not path:
         path = gen_repo_path(url)
     if not os.path.exists(path):
         os.makedirs(path, exist_ok=True)
+    # the repo is re-cloned or fetched
+    close_object_readers(path)
     try:
         logger.info("Clone repo %s ..." % url)
         repo = git.Repo.clone_from(url, path)
@@ -141,6 +395,7 @@ def prepare_repo(url, path=None, ref=None):
     return repo
 
 
+@STATS.timed()
 def prepare_repos(repo_list, path=None):
     """ clone/fetch multiple repos in one folder
     parm repo_list: ((remote_name, url),...)
@@ -192,13 +447,14 @@ def parse_commit(git_commit):
     author = git_commit.author.email.lower()
     repo = git_commit.repo
     ref_cmt = get_ref_commit(git_commit.message)
+    stats = object_reader(repo).stats(git_commit.hexsha)
     patch = {
         'commit': git_commit.hexsha,
         'payload_hash': get_patchid(git_commit.hexsha, repo),
         'subject': git_commit.summary,
-        'files': sorted(git_commit.stats.files.keys()),
-        'insert_size': git_commit.stats.total['insertions'],
-        'delete_size': git_commit.stats.total['deletions'],
+        'files': sorted(stats.files.keys()),
+        'insert_size': stats.total['insertions'],
+        'delete_size': stats.total['deletions'],
         'author': author,
         'author_date': git_commit.authored_datetime,
         'committer': git_commit.committer.email.lower(),
@@ -216,6 +472,7 @@ def parse_commit(git_commit):
 # arg1: kernel branch/tag/sha1
 # return: (kernek version, sha1)
 #
+@STATS.timed()
 def get_baseline(rev, is_rt=False, path=None, since=False, count_cherrypick=False):
     cmd = r"""
     declare rev=%s
@@ -297,8 +554,28 @@ def get_baseline(rev, is_rt=False, path=None, since=False, count_cherrypick=Fals
     return out.strip().split()
 
 
+def _since_range(ref):
+    """
+    Narrow the range of the ref to the commits since ref['since'], i.e. the
+    previous sha of the ref, if the ref is fast-forward from it. Otherwise
+    ref['since'] is reset and the full range is kept.
+    """
+    if not ref.get('since'):
+        return
+    if is_ancestor(ref['since'], ref['sha'], ref['repo']):
+        ref['range'] = "%s..%s" % (ref['since'], ref['sha'])
+    else:
+        logger.info("%s(%s) is not fast-forward from %s, diff the full range" % \
+                      (ref['ref'], ref['sha'], ref['since']))
+        ref['since'] = None
+
 def gen_rangediff(url_a, url_b, ref_a, ref_b, base_a=None,
-                  base_b=None, repo_path=None, check_base=True):
+                  base_b=None, repo_path=None, check_base=True, workers=0,
+                  engine='git', since_b=None):
+    """
+    since_b: the previous sha of ref b, only the commits since it are
+             diffed if ref b is fast-forward from it, see _since_range()
+    """
     ref_dict = {
         'a': {
             'url': url_a,
@@ -309,6 +586,7 @@ def gen_rangediff(url_a, url_b, ref_a, ref_b, base_a=None,
             'url': url_b,
             'ref': ref_b,
             'base': base_b,
+            'since': since_b,
         },
     }
     for ref in ref_dict.values():
@@ -322,6 +600,7 @@ def gen_rangediff(url_a, url_b, ref_a, ref_b, base_a=None,
     if not repo_path:
         repo_path = gen_repo_path(url_b)
     if url_a != url_b:
+        close_object_readers(repo_path)
         shutil.rmtree(repo_path, ignore_errors=True)
     os.makedirs(repo_path, exist_ok=True)
     # clone repos everytime for multiple remotes
@@ -354,14 +633,26 @@ def gen_rangediff(url_a, url_b, ref_a, ref_b, base_a=None,
         # some repository has no upstream tag, e.g. anolis/cloud-kernel
         ref['range'] = "%s..%s" % (ref['basesha'], ref['sha'])
         ref['repo'] = repo
+        _since_range(ref)
 
     # generate range diff
     logger.info("Generate rangediff: %s, %s" % \
                   (ref_dict['a']['range'], ref_dict['b']['range']))
-    diff_text = repo.git.range_diff(ref_dict['a']['range'],
-                                    ref_dict['b']['range'])
-    logger.info("Parse the rangediff ...")
-    diffs = parse_rangediff(diff_text, repo)
+    if engine == 'python':
+        diff_text, diffs = py_rangediff(repo,
+                                        ref_dict['a']['range'],
+                                        ref_dict['b']['range'])
+    elif workers:
+        diff_text, diffs = parallel_rangediff(repo,
+                                              ref_dict['a']['range'],
+                                              ref_dict['b']['range'],
+                                              workers)
+    else:
+        with STATS.timer('range_diff'):
+            diff_text = repo.git.range_diff(ref_dict['a']['range'],
+                                            ref_dict['b']['range'])
+        logger.info("Parse the rangediff ...")
+        diffs = parse_rangediff(diff_text, repo)
     ref_dict['diff'] = diff_text
 
     return (ref_dict, diffs,)
@@ -371,18 +662,28 @@ def is_same_patchid(sha1_a, sha1_b, repo=None):
     pid_b = get_patchid(sha1_b, repo)
     return (pid_a and pid_b and pid_a == pid_b)
 
-def check_updated_patch(cmconly_patches, updated_patches,
-                        up_candidate, up_confirmed, psb_codechg, repo=None):
+# indexes of the patch lists returned by parse_rangediff()
+RD_SAME = 0
+# commit message changed only
+RD_CMCO = 1
+RD_UPDATED = 2
+RD_NEW = 3
+RD_REMOVED = 4
+
+def check_updated_patch(rev_a, rev_b, up_confirmed, psb_codechg, repo=None):
+    """
+    Classify a '!' patch pair of the range-diff
+
+    returns: RD_UPDATED or RD_CMCO
+    """
     if up_confirmed:
-        updated_patches.append(up_candidate)
+        return RD_UPDATED
     elif psb_codechg:
         # check if the patch-ids is the same
-        if is_same_patchid(up_candidate[1], up_candidate[2], repo):
-            cmconly_patches.append(up_candidate)
-        else:
-            updated_patches.append(up_candidate)
-    elif not psb_codechg:
-        cmconly_patches.append(up_candidate)
+        if is_same_patchid(rev_a, rev_b, repo):
+            return RD_CMCO
+        return RD_UPDATED
+    return RD_CMCO
 
 # git-range-diff sometimes gives a twisted diff which is a false positive:
 # 8025:  7f0de68338ad ! 2707:  6d6e4bb1acc7 Revert "drm/i915/display: Re-add check for low voltage sku...
@@ -405,45 +706,41 @@ def _rm_twisted_diff(patches):
         rv = patches
     return rv
 
-def parse_rangediff(diff_text, repo=None):
-    if not repo:
-        repo = git.Repo()
-    # rl_rep: re pattern for result lines
-    # e.g.: " 1:  c0debee = 2:  cab005e Add a helpful message at the start"
-    #       " X:  effdc5234c5ee <    -:  ------------- net: stmmac: fix ..."
-    rl_rep = re.compile(r'^\s*[\d-]+:\s+([0-9a-f-]{10,})\s+([=!><])\s+[\d-]+:\s+([0-9a-f-]{10,})\s+(\S.*)$')
-    # commit message meta info.
-    cm_metas = [
-        'Change-Id',
-        'Signed-off-by',
-        'Reviewed-on',
-        'Reviewed-by',
-        'Tested-by',
-        'Tracked-On',
-        'Acked-by',
-        'Link',
-    ]
-    # cm_rep: re pattern for commit message meta info. line
-    cm_rep = re.compile(r"^\s*(%s):" % '|'.join(cm_metas), flags=re.I)
-
-    same_patches = []
-    new_patches = []
-    # cmconly_patches: commit message change only patches
-    cmconly_patches = []
-    updated_patches = []
-    removed_patches = []
-    # updated patch candidate
+# result line of range-diff
+#   e.g.: " 1:  c0debee = 2:  cab005e Add a helpful message at the start"
+#         " X:  effdc5234c5ee <    -:  ------------- net: stmmac: fix ..."
+rd_result_re = re.compile(r'^\s*[\d-]+:\s+([0-9a-f-]{10,})\s+([=!><])\s+[\d-]+:\s+([0-9a-f-]{10,})\s+(\S.*)$')
+# commit message meta info. line
+rd_cmmeta_re = re.compile(r"^\s*(%s):" % '|'.join([
+    'Change-Id',
+    'Signed-off-by',
+    'Reviewed-on',
+    'Reviewed-by',
+    'Tested-by',
+    'Tracked-On',
+    'Acked-by',
+    'Link',
+]), flags=re.I)
+
+def iter_rangediff(diff_lines, repo=None):
+    """
+    Classify the range-diff output in a single pass
+
+    param diff_lines: the range-diff output, in text or iterable of lines
+    yields: (RD_* list index, (seq, rev_a, rev_b, subject)) as soon as the
+            block of a patch is closed, the twisted diffs are not removed,
+            see parse_rangediff()
+    """
+    if isinstance(diff_lines, str):
+        diff_lines = diff_lines.splitlines()
+    # '!' patch pair waiting for its diff block
     up_candidate = None
-    # flag for the first hunk header
-    is_1st_hheader = False
     # flag for if it is a diff block
-    in_diff = None
+    in_diff = False
     # flag for detecting a possible code change line
     psb_codechg = False
     # flag for confirming the update patch
     up_confirmed = False
-    # diff text between updated-patch-pair
-    payload = []
     # sequence no in the rangediff
     seq = 0
     # sample:
@@ -457,13 +754,7 @@ def parse_rangediff(diff_text, repo=None):
     #       ^ identifier offset 3 position
     #    + #define X86_FEATURE_MD_CLEAR      (18*32+10)...
     # the postion of the identifier: +/-
-    iidx = None
-    # the postition of identifier offset 1
-    io1idx = None
-    # the postition of identifier offset 2
-    io2idx = None
-    # the postition of identifier offset 3
-    io3idx = None
+    iidx = io1idx = io2idx = io3idx = None
     #
     # git range-diff output sample:
     #   -:  ------- > 1:  0ddba11 Prepare for the inevitable! <-- result line
@@ -484,91 +775,698 @@ def parse_rangediff(diff_text, repo=None):
     #         Contact
     #   3:  bedead < -:  ------- TO-UNDO
     #
-    for l in diff_text.splitlines():
-        m = rl_rep.search(l)
+    for l in diff_lines:
+        # only the lines led by a number or '-' could be a result line
+        s = l.lstrip()
+        m = rd_result_re.match(l) if s[:1].isdigit() or s[:1] == '-' else None
         if m:
-            # this is result line
-            # check if the previous lines are diff content
-            if in_diff:
-                check_updated_patch(cmconly_patches,
-                                    updated_patches,
-                                    up_candidate,
-                                    up_confirmed,
-                                    psb_codechg,
-                                    repo)
+            # this is result line, close the diff block of the previous '!'
+            if up_candidate:
+                if in_diff:
+                    yield (check_updated_patch(up_candidate[1],
+                                               up_candidate[2],
+                                               up_confirmed,
+                                               psb_codechg,
+                                               repo),
+                           up_candidate,)
                 # reset the flags and data
+                up_candidate = None
                 in_diff = False
                 up_confirmed = False
                 psb_codechg = False
-                up_candidate = None
-                payload = []
 
             # increase sequence no.
             seq += 1
             # extract commit ids and commit message
-            rev_a = m.group(1)
-            rev_b = m.group(3)
-            c_msg = m.group(4)
-            # don't need to rev_parse
-            #sha_re = re.compile(r'^[0-9a-f]{4,}$')
-            #rev_a = repo.git.rev_parse(rev_a) if sha_re.search(rev_a) else None
-            #rev_b = repo.git.rev_parse(rev_b) if sha_re.search(rev_b) else None
-            if m.group(2) == '=':
-                same_patches.append((seq, rev_a, rev_b, c_msg))
-            elif m.group(2) == '>':
-                new_patches.append((seq, None, rev_b, c_msg))
-            elif m.group(2) == '!':
-                is_1st_hheader = True
-                up_candidate = [seq, rev_a, rev_b, c_msg, payload]
-            elif m.group(2) == '<':
-                removed_patches.append((seq, rev_a, None, c_msg))
+            rev_a, op, rev_b, c_msg = m.groups()
+            if op == '=':
+                yield (RD_SAME, (seq, rev_a, rev_b, c_msg,),)
+            elif op == '>':
+                yield (RD_NEW, (seq, None, rev_b, c_msg,),)
+            elif op == '<':
+                yield (RD_REMOVED, (seq, rev_a, None, c_msg,),)
+            else:
+                up_candidate = (seq, rev_a, rev_b, c_msg,)
+        elif not up_candidate or up_confirmed:
+            # nothing to check in the diff lines
+            continue
+        elif not in_diff:
+            # this is the first hunk header
+            in_diff = True
+            iidx = l.find(r'@')
+            io1idx = iidx + 1
+            io2idx = iidx + 2
+            io3idx = iidx + 3
         else:
             # this is diff line, need to figure out
             # whether there is any code change
-            payload.append(l)
-            if is_1st_hheader:
-                # this is the first hunk header
-                in_diff = True
-                # reset the flags
-                is_1st_hheader = False
-
-                iidx = l.find(r'@')
-                io1idx = iidx + 1
-                io2idx = iidx + 2
-                io3idx = iidx + 3
-            elif not up_confirmed:
-                llen = len(l)
-                if llen >= io2idx and l[io1idx] in '+-':
-                    # check if there is a +/- at the io1idx postion. If yes,
-                    # this must be a code change line. Set flag and skip all
-                    # the following diff lines
-                    up_confirmed = True
-                elif not psb_codechg and llen >= io3idx and l[iidx] in '+-':
-                    # check if insertion/deletion line is a commit message line
-                    # or not. If not, this line could be a code change, set
-                    # psb_codechg = True, igmore all the following diff lines
-                    # and compare the patch ids later
-                    m = cm_rep.search(l[io1idx:])
-                    if not m:
-                        psb_codechg = True
+            llen = len(l)
+            if llen >= io2idx and l[io1idx] in '+-':
+                # check if there is a +/- at the io1idx postion. If yes,
+                # this must be a code change line. Set flag and skip all
+                # the following diff lines
+                up_confirmed = True
+            elif not psb_codechg and llen >= io3idx and l[iidx] in '+-':
+                # check if insertion/deletion line is a commit message line
+                # or not. If not, this line could be a code change, set
+                # psb_codechg = True, igmore all the following diff lines
+                # and compare the patch ids later
+                if not rd_cmmeta_re.search(l[io1idx:]):
+                    psb_codechg = True
 
     # check the last updated patch out of the loop
-    if in_diff:
-        check_updated_patch(cmconly_patches,
-                            updated_patches,
-                            up_candidate,
-                            up_confirmed,
-                            psb_codechg,
-                            repo)
+    if up_candidate and in_diff:
+        yield (check_updated_patch(up_candidate[1], up_candidate[2],
+                                   up_confirmed, psb_codechg, repo),
+               up_candidate,)
+
+@STATS.timed()
+def parse_rangediff(diff_text, repo=None):
+    """
+    returns: [same, cmco, updated, new, removed], the lists of
+             (seq, rev_a, rev_b, subject)
+    """
+    if not repo:
+        repo = git.Repo()
+    rv = [[], [], [], [], []]
+    for idx, patch in iter_rangediff(diff_text, repo):
+        rv[idx].append(patch)
 
     # remove patches from the twisted diff
-    if cmconly_patches:
-        cmconly_patches = _rm_twisted_diff(cmconly_patches)
-    if updated_patches:
-        updated_patches = _rm_twisted_diff(updated_patches)
-    return [same_patches, cmconly_patches,
-            updated_patches, new_patches, removed_patches]
+    if rv[RD_CMCO]:
+        rv[RD_CMCO] = _rm_twisted_diff(rv[RD_CMCO])
+    if rv[RD_UPDATED]:
+        rv[RD_UPDATED] = _rm_twisted_diff(rv[RD_UPDATED])
+    return rv
+
+def _prematch_by_pid(msgs_a, msgs_b, pids_a, pids_b):
+    """
+    Match the commits with identical patch ids in order, see
+    get_commits_msg() for msgs_a/msgs_b
+
+    returns: (dict mapping commit a to commit b,
+              list of (RD_SAME or RD_CMCO, commit a, commit b))
+    """
+    pid2b = {}
+    for c, _, _ in msgs_b:
+        pid = pids_b.get(c)
+        if pid:
+            pid2b.setdefault(pid, []).append(c)
+    msg_b = { c: m for c, *m in msgs_b }
+    matched = {}
+    results = []
+    for c, *m in msgs_a:
+        cbs = pid2b.get(pids_a.get(c))
+        if cbs:
+            cb = cbs.pop(0)
+            matched[c] = cb
+            # same author and message
+            idx = RD_SAME if m == msg_b[cb] else RD_CMCO
+            results.append((idx, c, cb,))
+    logger.info("Pre-matched %i patches by patch id" % len(matched))
+    return (matched, results,)
+
+def _rangediff_lists(results, msgs_a, msgs_b):
+    """
+    Sequence the classified pairs as git range-diff, i.e. in the order of
+    b, the removed ones follow the b matched by the previous commit a
 
+    param results: list of (RD_* index, commit a, commit b)
+    returns: [same, cmco, updated, new, removed] as parse_rangediff()
+    """
+    idx_a = { m[0]: i for i, m in enumerate(msgs_a) }
+    idx_b = { m[0]: i for i, m in enumerate(msgs_b) }
+    b_of_a = { r[1]: idx_b[r[2]] for r in results if r[1] and r[2] }
+    last_b = -1
+    after_b = {}
+    for c, _, _ in msgs_a:
+        if c in b_of_a:
+            last_b = b_of_a[c]
+        else:
+            after_b[c] = last_b
+    def seq_key(r):
+        if r[2]:
+            return (idx_b[r[2]], 0, 0,)
+        return (after_b[r[1]], 1, idx_a[r[1]],)
+    results = sorted(results, key=seq_key)
+    rv = [[], [], [], [], []]
+    for seq, (idx, ca, cb) in enumerate(results, 1):
+        msg = msgs_b[idx_b[cb]][2] if cb else msgs_a[idx_a[ca]][2]
+        rv[idx].append((seq, ca, cb, msg.split('\n', 1)[0],))
+
+    # remove patches from the twisted diff
+    if rv[RD_CMCO]:
+        rv[RD_CMCO] = _rm_twisted_diff(rv[RD_CMCO])
+    if rv[RD_UPDATED]:
+        rv[RD_UPDATED] = _rm_twisted_diff(rv[RD_UPDATED])
+    return rv
+
+@STATS.timed()
+def parallel_rangediff(repo, range_a, range_b, workers=4, chunk=None):
+    """
+    Range-diff of the big patch sets, e.g. 5-15k patches of the product
+    trees, the cost of git range-diff is O(n*m) and single-threaded:
+      1. the commits with identical patch ids are matched in bulk, they
+         are same or cmco patches
+      2. the longest sequence of the matched pairs in the same order on
+         both sides splits the ranges into segments, the residual commits
+         of the segments are diffed by git range-diff in parallel
+      3. the residual commits left unmatched in their segments(e.g. moved
+         far away) are paired by the normalized subject as updated ones,
+         if git range-diff would pair their patches, see similar_lines()
+
+    returns: (diff text of the segments, [same, cmco, updated, new, removed])
+             as parse_rangediff()
+    """
+    msgs_a = get_commits_msg(range_a, repo)
+    msgs_b = get_commits_msg(range_b, repo)
+    commits_a = [ m[0] for m in msgs_a ]
+    commits_b = [ m[0] for m in msgs_b ]
+    idx_a = { c: i for i, c in enumerate(commits_a) }
+    idx_b = { c: i for i, c in enumerate(commits_b) }
+
+    # 1. pre-match the identical patch ids
+    matched, results = _prematch_by_pid(msgs_a, msgs_b,
+                                         get_patchids(range_a, repo),
+                                         get_patchids(range_b, repo))
+    matched_b = set(matched.values())
+
+    # 2. the anchors: longest increasing sequence of the matched pairs
+    pairs = sorted((idx_a[ca], idx_b[cb],) for ca, cb in matched.items())
+    tails = []
+    tail_idx = []
+    prev = [ -1 ] * len(pairs)
+    for i, (_, ib) in enumerate(pairs):
+        k = bisect.bisect_left(tails, ib)
+        if k == len(tails):
+            tails.append(ib)
+            tail_idx.append(i)
+        else:
+            tails[k] = ib
+            tail_idx[k] = i
+        prev[i] = tail_idx[k - 1] if k else -1
+    anchors = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i >= 0:
+        anchors.append(pairs[i])
+        i = prev[i]
+    anchors.reverse()
+    # sentinel anchor at the end of both ranges
+    anchors.append((len(commits_a), len(commits_b),))
+
+    # split into segments of about chunk residual commits
+    nresidual = len(commits_a) + len(commits_b) - 2 * len(matched)
+    chunk = chunk or max(50, nresidual // (workers * 4) + 1)
+    base_a = range_a.split('..')[0]
+    base_b = range_b.split('..')[0]
+    segments = []
+    lo_a = lo_b = -1
+    cnt = 0
+    for ia, ib in anchors:
+        cnt += sum(1 for c in commits_a[lo_a + 1:ia] if c not in matched)
+        cnt += sum(1 for c in commits_b[lo_b + 1:ib] if c not in matched_b)
+        if cnt >= chunk or ia == len(commits_a):
+            if cnt:
+                segments.append((lo_a, ia, lo_b, ib,))
+            lo_a, lo_b = ia, ib
+            cnt = 0
+    logger.info("Diff %i residual commits in %i segments" % \
+                  (nresidual, len(segments)))
+
+    # range-diff of the segments, one side could be empty
+    def seg_rangediff(seg):
+        lo_a, hi_a, lo_b, hi_b = seg
+        if hi_a - lo_a <= 1 or hi_b - lo_b <= 1:
+            return ''
+        ra = "%s..%s" % (commits_a[lo_a] if lo_a >= 0 else base_a,
+                         commits_a[hi_a - 1])
+        rb = "%s..%s" % (commits_b[lo_b] if lo_b >= 0 else base_b,
+                         commits_b[hi_b - 1])
+        return "# range-diff %s %s\n%s\n" % \
+                 (ra, rb, repo.git.range_diff(ra, rb))
+
+    with STATS.timer('range_diff'):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outs = list(executor.map(seg_rangediff, segments))
+
+    # resolve the abbreviated shas of the range-diff output
+    sha_idx = {}
+    for c in commits_a + commits_b:
+        sha_idx.setdefault(c[:7], []).append(c)
+    def lookup(rev):
+        for sha in sha_idx.get(rev[:7], []) if rev else []:
+            if sha.startswith(rev):
+                return sha
+        return None
+
+    # dict: mapping commit a/b of residual to the classified pair
+    done_a = {}
+    done_b = {}
+    for out in outs:
+        for idx, patch in iter_rangediff(out, repo):
+            ca = lookup(patch[1])
+            cb = lookup(patch[2])
+            ca = ca if ca and ca not in matched and ca not in done_a else None
+            cb = cb if cb and cb not in matched_b and cb not in done_b else None
+            if idx in (RD_SAME, RD_CMCO, RD_UPDATED,) and ca and cb:
+                results.append((idx, ca, cb,))
+                done_a[ca] = done_b[cb] = True
+
+    # 3. pair the left commits by the normalized subject
+    sub2b = {}
+    for c in commits_b:
+        if c not in matched_b and c not in done_b:
+            sub = normalize_subject(msgs_b[idx_b[c]][2].split('\n', 1)[0])
+            sub2b.setdefault(sub, []).append(c)
+    left_a = []
+    for c in commits_a:
+        if c in matched or c in done_a:
+            continue
+        sub = normalize_subject(msgs_a[idx_a[c]][2].split('\n', 1)[0])
+        left_a.append((c, sub2b.get(sub, []),))
+    # the generic subjects are shared by unrelated patches, the patches
+    # of the candidates are compared
+    cands = set(c for c, cbs in left_a if cbs)
+    cands.update(cb for c, cbs in left_a for cb in cbs)
+    lines = get_patch_lines(sorted(cands), repo) if cands else {}
+    for c, cbs in left_a:
+        cb = next((cb for cb in cbs if cb not in done_b and \
+                     similar_lines(lines.get(c, []), lines.get(cb, []))), None)
+        if cb:
+            results.append((RD_UPDATED, c, cb,))
+            done_b[cb] = True
+        else:
+            results.append((RD_REMOVED, c, None,))
+    for cbs in sub2b.values():
+        for c in cbs:
+            if c not in done_b:
+                results.append((RD_NEW, None, c,))
+
+    return (''.join(outs), _rangediff_lists(results, msgs_a, msgs_b),)
+
+# header lines of a file diff, see _rangediff_file_header()
+diff_header_re = re.compile(r'^(old mode|new mode|deleted file mode|'
+                            r'new file mode|copy from|copy to|rename from|'
+                            r'rename to|similarity index|dissimilarity index|'
+                            r'index|---|\+\+\+) ')
+
+def _rangediff_file_header(header):
+    """
+    the section line of a file diff in the patch of git range-diff, e.g.
+    " ## drivers/x.c (new) ##", and the file name of its hunk headers
+    """
+    info = {}
+    for l in header[1:]:
+        m = diff_header_re.match(l)
+        info[m.group(1)] = l[m.end():]
+    # --no-prefix: "diff --git <name> <name>" if it isn't renamed
+    names = header[0][len('diff --git '):]
+    name_a = info.get('rename from', names[:len(names) // 2])
+    name_b = info.get('rename to', names[len(names) // 2 + 1:])
+    old_mode = info.get('old mode', info.get('deleted file mode'))
+    new_mode = info.get('new mode', info.get('new file mode'))
+    if 'new file mode' in info:
+        section = "%s (new)" % name_b
+    elif 'deleted file mode' in info:
+        section = "%s (deleted)" % name_a
+    elif 'rename from' in info:
+        section = "%s => %s" % (name_a, name_b)
+    else:
+        section = name_b
+    if old_mode and new_mode and old_mode != new_mode:
+        section += " (mode change %s => %s)" % (old_mode, new_mode)
+    filename = name_a if 'deleted file mode' in info else name_b
+    return (" ## %s ##" % section, filename,)
+
+@STATS.timed()
+def get_patch_lines(rev_range, repo=None):
+    """
+    Get the diffs of all the non-merge commits in a range with one git-log
+    stream, formatted as the patches compared by git range-diff:
+        " ## <file> ##" instead of the header lines of a file diff
+        "@@ <file>: <function>" instead of the hunk headers
+        an empty line between the files
+    the commit messages aren't compared by git range-diff
+
+    rev_range: the range, or a list of the commits
+
+    returns: dict mapping commit to list of lines
+    """
+    if not repo:
+        repo = git.Repo()
+    revs = [ rev_range ] if isinstance(rev_range, str) else \
+             [ "--no-walk=unsorted" ] + list(rev_range)
+    # the indicators of the diff lines are never the first char of the
+    # other lines, e.g. the commit message
+    out = repo.git.log("-p", "--no-merges", "--no-color", "--no-prefix",
+                       "--submodule=short", "--format=%x01%H",
+                       "--output-indicator-new=>",
+                       "--output-indicator-old=<",
+                       "--output-indicator-context=#", *revs)
+    patches = {}
+    lines = None
+    header = None
+    filename = None
+    # split by LF only as git, the sources may have the other line breaks
+    for l in out.split('\n'):
+        if header and not diff_header_re.match(l):
+            section, filename = _rangediff_file_header(header)
+            lines.append(section)
+            header = None
+        if l.startswith('\x01'):
+            lines = patches.setdefault(l[1:], [])
+            filename = None
+        elif l.startswith('diff --git '):
+            if lines:
+                lines.append('')
+            header = [ l ]
+        elif header:
+            header.append(l)
+        elif l.startswith('@@ '):
+            func = l[l.find('@@', 3) + 2:]
+            lines.append("@@ %s:%s" % (filename, func) if func else '@@')
+        elif not l:
+            continue
+        elif l[0] in '><#':
+            lines.append({'>': '+', '<': '-', '#': ' '}[l[0]] + l[1:])
+        else:
+            lines.append(' ' + l)
+    if header:
+        lines.append(_rangediff_file_header(header)[0])
+    return patches
+
+def patch_size(lines):
+    """size of a patch by git range-diff, the empty lines aren't counted"""
+    return sum(1 for l in lines if l)
+
+def _diff_pairs(a, b, max_d):
+    """
+    the matched lines of the shortest edit script of a and b by the Myers
+    algorithm
+
+    returns: list of (index a, index b), or None if it takes more than
+             max_d insertions and deletions
+    """
+    n = len(a)
+    m = len(b)
+    # dict: mapping diagonal k to the furthest x reached
+    v = { 1: 0 }
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x < n or y < m:
+                continue
+            # backtrack the snakes
+            pairs = []
+            for dd in range(d, -1, -1):
+                vv = trace[dd]
+                kk = x - y
+                if kk == -dd or (kk != dd and vv[kk - 1] < vv[kk + 1]):
+                    pk = kk + 1
+                else:
+                    pk = kk - 1
+                px = vv[pk]
+                py = px - pk
+                while x > px and y > py:
+                    x -= 1
+                    y -= 1
+                    pairs.append((x, y,))
+                x, y = px, py
+            pairs.reverse()
+            return pairs
+    return None
+
+def patch_cost(lines_a, lines_b, max_cost=None, context=3):
+    """
+    cost of pairing the patches as git range-diff: the number of the lines
+    and hunks in the unified diff of the patches with 3 context lines
+
+    returns: the cost, or None if it's max_cost or more
+    """
+    # the lines in only one of the patches are a lower bound of the
+    # insertions and deletions, skip the costly diff if it's too different
+    counts = {}
+    for l in lines_a:
+        counts[l] = counts.get(l, 0) + 1
+    common = 0
+    for l in lines_b:
+        if counts.get(l, 0) > 0:
+            counts[l] -= 1
+            common += 1
+    changed = len(lines_a) + len(lines_b) - 2 * common
+    if max_cost is None:
+        max_cost = len(lines_a) + len(lines_b) + 2
+    elif changed + (1 if changed else 0) >= max_cost:
+        return None
+    pairs = _diff_pairs(lines_a, lines_b, max_cost)
+    if pairs is None:
+        return None
+    # (equal lines before, changed lines) of the changes
+    changes = []
+    equal = 0
+    pi = pj = 0
+    for i, j in pairs + [ (len(lines_a), len(lines_b),) ]:
+        n = (i - pi) + (j - pj)
+        if n:
+            changes.append((equal, n,))
+            equal = 0
+        equal += 1
+        pi, pj = i + 1, j + 1
+    # the end sentinel isn't an equal line
+    equal -= 1
+    cost = 0
+    for idx, (before, n) in enumerate(changes):
+        if idx == 0:
+            # hunk header and the leading context
+            cost += 1 + min(context, before) + n
+        elif before <= 2 * context:
+            # the changes are merged into the hunk
+            cost += before + n
+        else:
+            # trailing context, hunk header and leading context
+            cost += 2 * context + 1 + n
+    if changes:
+        cost += min(context, equal)
+    return cost if cost < max_cost else None
+
+def similar_lines(lines_a, lines_b, creation_factor=60):
+    """
+    whether the patches are paired by git range-diff rather than left
+    unmatched, i.e. the cost is less than creation_factor% of their sizes
+    """
+    return patch_cost(lines_a, lines_b,
+                      patch_size(lines_a) * creation_factor // 100 + \
+                      patch_size(lines_b) * creation_factor // 100) is not None
+
+def min_cost_assign(cost):
+    """
+    Solve the linear assignment of a square cost matrix by the Hungarian
+    algorithm, O(n^3)
+
+    returns: list of the assigned column of each row
+    """
+    n = len(cost)
+    inf = float('inf')
+    # potentials of rows/columns, 1-based with the virtual column 0
+    u = [0] * (n + 1)
+    v = [0] * (n + 1)
+    # row assigned to column
+    p = [0] * (n + 1)
+    way = [0] * (n + 1)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = [inf] * (n + 1)
+        used = [False] * (n + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            row = cost[i0 - 1]
+            delta = inf
+            j1 = 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(n + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    assigned = [0] * n
+    for j in range(1, n + 1):
+        assigned[p[j] - 1] = j - 1
+    return assigned
+
+@STATS.timed()
+def py_rangediff(repo, range_a, range_b, creation_factor=60, max_df=50,
+                 max_assign=150):
+    """
+    In-process range-diff engine with the same classification as
+    parse_rangediff(), instead of git range-diff:
+      1. the commits with identical patch ids are matched in bulk
+      2. the candidate pairs of the residual patches share at least one
+         line which is not in more than max_df patches(e.g. the common
+         context), the cost of a pair is the size of the diff of the
+         patches as git range-diff, see patch_cost()
+      3. the pairs are assigned as git range-diff: a patch is left
+         unmatched at the cost of creation_factor% of its size, the
+         connected groups of candidates are solved by the Hungarian
+         algorithm, or greedily if bigger than max_assign
+
+    returns: (range-diff style result lines, [same, cmco, updated, new,
+             removed])
+    """
+    msgs_a = get_commits_msg(range_a, repo)
+    msgs_b = get_commits_msg(range_b, repo)
+    matched, results = _prematch_by_pid(msgs_a, msgs_b,
+                                        get_patchids(range_a, repo),
+                                        get_patchids(range_b, repo))
+    matched_b = set(matched.values())
+    res_a = [ m[0] for m in msgs_a if m[0] not in matched ]
+    res_b = [ m[0] for m in msgs_b if m[0] not in matched_b ]
+
+    # 2. the lines of the patches are numbered, the same lines by the same
+    # number, so that the diffs compare ints instead of the strings
+    with STATS.timer('py_rangediff.hash'):
+        lines_a = get_patch_lines(range_a, repo)
+        lines_b = get_patch_lines(range_b, repo)
+        line_ids = {}
+        # node: ('a', index) or ('b', index)
+        patches = {}
+        sizes = {}
+        # dict: mapping line number to the nodes
+        inv = {}
+        for side, commits, lines in (('a', res_a, lines_a),
+                                     ('b', res_b, lines_b)):
+            for i, c in enumerate(commits):
+                node = (side, i,)
+                patch = lines.get(c, [])
+                patches[node] = [ line_ids.setdefault(l, len(line_ids)) \
+                                    for l in patch ]
+                sizes[node] = patch_size(patch)
+                for l in set(patch):
+                    if l:
+                        inv.setdefault(line_ids[l], []).append(node)
+
+    # cost of leaving a patch unmatched
+    def uncost(node):
+        return sizes[node] * creation_factor // 100
+
+    # sparse cost of the candidate pairs, keyed by (index a, index b), the
+    # pairs which cost more than unmatched aren't kept
+    with STATS.timer('py_rangediff.cost'):
+        cands = set()
+        for nodes in inv.values():
+            if len(nodes) > max_df:
+                continue
+            na = [ n[1] for n in nodes if n[0] == 'a' ]
+            nb = [ n[1] for n in nodes if n[0] == 'b' ]
+            cands.update((i, j,) for i in na for j in nb)
+        cost = {}
+        for i, j in cands:
+            c = patch_cost(patches[('a', i,)], patches[('b', j,)],
+                           uncost(('a', i,)) + uncost(('b', j,)))
+            if c is not None:
+                cost[(i, j,)] = c
+    STATS.incr('py_rangediff.pairs', len(cost))
+
+    # 3. connected groups of the candidate pairs
+    parent = {}
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for i, j in cost:
+        parent[find(('a', i,))] = find(('b', j,))
+    groups = {}
+    for node in parent:
+        groups.setdefault(find(node), []).append(node)
+
+    with STATS.timer('py_rangediff.assign'):
+        assigned = []
+        for nodes in groups.values():
+            ga = sorted(n[1] for n in nodes if n[0] == 'a')
+            gb = sorted(n[1] for n in nodes if n[0] == 'b')
+            if len(ga) + len(gb) > max_assign:
+                # greedy: the cheapest pairs first if cheaper than unmatched
+                used_a = set()
+                used_b = set()
+                pairs = sorted((cost[(i, j,)], i, j,) for i in ga for j in gb \
+                                 if (i, j,) in cost)
+                for c, i, j in pairs:
+                    if i in used_a or j in used_b:
+                        continue
+                    used_a.add(i)
+                    used_b.add(j)
+                    assigned.append((i, j,))
+                continue
+            # square matrix as git range-diff: rows are a and the dummies
+            # of b, columns are b and the dummies of a
+            big = sum(sizes[x] for x in nodes) + 1
+            matrix = []
+            for i in ga:
+                row = [ cost.get((i, j,), big) for j in gb ]
+                row.extend([ uncost(('a', i,)) ] * len(ga))
+                matrix.append(row)
+            dummy = [ uncost(('b', j,)) for j in gb ] + [ 0 ] * len(ga)
+            matrix.extend([ dummy ] * len(gb))
+            for r, col in enumerate(min_cost_assign(matrix)[:len(ga)]):
+                if col < len(gb) and (ga[r], gb[col],) in cost:
+                    assigned.append((ga[r], gb[col],))
+
+    done_a = set()
+    done_b = set()
+    for i, j in assigned:
+        # the pids are different, so the code is changed
+        results.append((RD_UPDATED, res_a[i], res_b[j],))
+        done_a.add(i)
+        done_b.add(j)
+    results.extend((RD_REMOVED, c, None,) for i, c in enumerate(res_a) \
+                     if i not in done_a)
+    results.extend((RD_NEW, None, c,) for j, c in enumerate(res_b) \
+                     if j not in done_b)
+    rv = _rangediff_lists(results, msgs_a, msgs_b)
+
+    # result lines in the format of git range-diff
+    ops = { RD_SAME: '=', RD_CMCO: '!', RD_UPDATED: '!', RD_NEW: '>',
+            RD_REMOVED: '<' }
+    text = []
+    for idx, patches in enumerate(rv):
+        for seq, ca, cb, sub in patches:
+            text.append((seq, "%s:  %s %s %s:  %s %s" % \
+                                 (seq if ca else '-',
+                                  ca[:12] if ca else '-' * 12, ops[idx],
+                                  seq if cb else '-',
+                                  cb[:12] if cb else '-' * 12, sub)))
+    text.sort()
+    return ('\n'.join(t for _, t in text), rv,)
+
+@STATS.timed()
 def get_patchid(commit, repo=None, pid_only=True):
     if not repo:
         repo = git.Repo()
@@ -971,16 +1869,19 @@ def find_similar_patch_by_sub(gitcmt_a, gitrepo_b, ref_b=None,
         params['min_ratio'] = min_ratio
     return find_similar_patch(**params)
 
+@STATS.timed()
 def find_similar_patch(gitcmt_a, gitrepo_b, rev_list, min_ratio=0.8, fast=False):
     matched = None
     max_ratio = (0.0, 0, 0)
     if rev_list:
+        reader_b = object_reader(gitrepo_b)
         # get diff text of commit a
-        da = gitcmt_a.repo.git.show(gitcmt_a.hexsha)
+        da = object_reader(gitcmt_a.repo).diff(gitcmt_a.hexsha)
         for rev in rev_list:
             # diff text of commit b
-            db = gitrepo_b.git.show(rev)
+            db = reader_b.diff(rev)
             ratio = similar_patches(da, db)
+            STATS.incr('similar.compared')
             if ratio[0] == 1.0:
                 matched = rev
                 max_ratio = ratio
@@ -1005,12 +1906,14 @@ def find_similar_patch(gitcmt_a, gitrepo_b, rev_list, min_ratio=0.8, fast=False)
 
     return (matched, max_ratio)
 
+@STATS.timed()
 def find_upstreamed_tag(gitcmt_a, gitrepo_b, pids_b=None, fast=True):
     def find_tag_by_pid(gitcmt, pids):
         tag = None
         if pids:
             pid = get_patchid(gitcmt.hexsha, gitcmt.repo)
             if pid in pids:
+                STATS.incr('cache.korg_pid.hit')
                 logger.info("matched upstream patch by pid: %s, tag=%s" % \
                               (pids[pid]['commit'], pids[pid]['tag']))
                 tag = pids[pid]['tag'] or pids[pid]['commit']
@@ -1064,12 +1967,294 @@ def find_parent_merge_commit(git_cmt, ref):
                 logger.error(e)
     return repo.commit(pmc) if pmc else None
 
+def is_ancestor(commit, ref, repo=None):
+    if not repo:
+        repo = git.Repo()
+    try:
+        # cmd: git merge-base --is-ancestor <commit> <ref>
+        repo.git.merge_base("--is-ancestor", commit, ref)
+    except git.exc.GitCommandError as e:
+        if str(e).find('exit code(1)') < 0:
+            logger.error(e)
+        return False
+    return True
+
+@STATS.timed()
+def get_patchids(rev_range, repo=None):
+    """
+    Get patch ids of all the non-merge commits in a range with one git-log
+    stream instead of one git-show per commit
+
+    returns: dict keyed by commit
+    """
+    if not repo:
+        repo = git.Repo()
+    out = repo.git.execute(
+            ["git log -p --no-merges %s | git patch-id" % rev_range], shell=True)
+    pids = {}
+    for l in out.splitlines():
+        pid, c = l.split()
+        pids[c] = pid
+    return pids
+
+@STATS.timed()
+def get_commits_info(rev_range, repo=None):
+    """
+    Get author and changed files of all the non-merge commits in a range
+    with one git-log stream, the files are the same as commit.stats.files
+
+    returns: list of dict in the order from oldest to latest
+    """
+    if not repo:
+        repo = git.Repo()
+    out = repo.git.log("--no-merges", "--reverse", "--no-renames", "--numstat",
+                       "--format=%x00%H %ae", rev_range)
+    infos = []
+    for l in out.splitlines():
+        if l.startswith('\x00'):
+            c, _, author = l[1:].partition(' ')
+            info = {
+                'commit': c,
+                'author': author.lower(),
+                'files': [],
+            }
+            infos.append(info)
+        elif l:
+            # numstat line: <insertions>\t<deletions>\t<file>
+            info['files'].append(l.split('\t', 2)[2])
+    return infos
+
+@STATS.timed()
+def get_commits_msg(rev_range, repo=None):
+    """
+    Get author and message of all the non-merge commits in a range with
+    one git-log stream
+
+    returns: list of (commit, author, message) in topological order from
+             oldest to latest
+    """
+    if not repo:
+        repo = git.Repo()
+    out = repo.git.log("--no-merges", "--reverse", "--topo-order",
+                       "--format=%x01%H%x00%an <%ae>%x00%B", rev_range,
+                       strip_newline_in_stdout=False)
+    msgs = []
+    for rec in out.split('\x01')[1:]:
+        c, author, msg = rec.split('\x00', 2)
+        msgs.append((c, author, msg,))
+    return msgs
+
+def is_intel_email(email):
+    return email.lower().find('intel.com') > 0
+
 def is_intel_patch(git_cmt):
-        return git_cmt.author.email.lower().find('intel.com') > 0
+    return is_intel_email(git_cmt.author.email)
+
+@STATS.timed()
+def _gen_quilt(ref, check_base=True, intel_only=True):
+    reftype, sha = peek_repo(ref['ref'], ref['url'])
+    assert (reftype not in (INVALID_REPO, NOT_EXIST,)), \
+           "Tag/branch not exist: %s, %s" % (ref['url'], ref['ref'])
+    ref['sha'] = sha
+    ref['reftype'] = reftype
+    if 'repo' not in ref:
+        os.makedirs(ref['path'], exist_ok=True)
+        ref['repo'] = prepare_repo(ref['url'], ref['path'])
+    repo = ref['repo']
+    rt_re = re.compile(r'-rt\d*\b')
+    reltag_re = re.compile(r'(v[3-9]\.[\d\.\-rct]+)-.*\d{6}T\d{6}Z$')
+    if ref['base']:
+        basetype, sha = peek_repo(ref['base'], ref['url'])
+        # only accept base in tag or sha
+        assert basetype in (IS_TAG, IS_SHA,), \
+          "Invalid base: %s, %s(type: %i)" % (ref['url'], ref['base'], basetype)
+        ref['basesha'] = sha
+    else:
+        m = rt_re.search(ref['ref'])
+        is_rt = True if m else False
+        # don't use pushd, the quilts of both sides are generated in threads
+        ref['base'], ref['basesha'] = get_baseline(ref['sha'], is_rt,
+                                                   path=ref['path'])
+        basetype = IS_TAG
+    if check_base and ref['reftype'] == basetype == IS_TAG:
+        # check if the tag consistence
+        m = reltag_re.search(ref['ref'])
+        if m:
+            baseline_bytag = m.group(1)
+            assert (ref['base'] == baseline_bytag), \
+                   "Baseline inconsistent: %s, %s(from tag)" % \
+                     (ref['base'], baseline_bytag)
+    # generate range diff
+    # use basesha instead of baseline(i.e. kernel version) in case
+    # some repository has no upstream tag, e.g. anolis/cloud-kernel
+    ref['range'] = "%s..%s" % (ref['basesha'], ref['sha'])
+    _since_range(ref)
+    logger.info("Generate quilt %s: %s" % (ref['ref'], ref['range']))
+    pids = get_patchids(ref['range'], repo)
+    ref['quilt'] = []
+    # dict: mapping commit to git commit object
+    ref['gitcs'] = {}
+    # dict: mapping commit to pid
+    ref['pids'] = {}
+    # dict: mapping commit to changed files
+    ref['files'] = {}
+    epids = ref['epids']
+    reader = object_reader(repo)
+    for info in get_commits_info(ref['range'], repo):
+        c = info['commit']
+        pid = pids.get(c)
+        if pid in epids:
+            logger.info("    exluded commit %s, up=%s" % (c, epids[pid]))
+            continue
+        if intel_only and not is_intel_email(info['author']):
+            continue
+
+        # load the commit by the shared cat-file process, it's read later
+        # by the matcher without lazy loading
+        gitc = reader.commit(c)
+        ref['quilt'].append(gitc)
+        ref['gitcs'][c]  = gitc
+        ref['pids'][c]  = pid
+        ref['files'][c] = info['files']
+
+def normalize_subject(sub):
+    """
+    Normalize the commit subject for matching, e.g.:
+        "UBUNTU: SAUCE: [PATCH v2] drm/i915: Fix  foo."
+    is normalized to:
+        "drm/i915: fix foo"
+    """
+    # tags prefixed by downstream trees or mail patches
+    prefix_re = re.compile(r'^\s*(?:\[[^\]]*\]\s*|(?:UBUNTU|SAUCE|BACKPORT|'
+                           r'FROMLIST|FROMGIT|UPSTREAM|PATCH)\s*:\s*)+', re.I)
+    sub = prefix_re.sub('', sub)
+    return ' '.join(sub.lower().split()).rstrip('.')
+
+class QuiltMatcher:
+    """
+    Match commits against a quilt with inverted indexes built once.
+
+    The candidates sharing files or author with a commit are deduplicated
+    and ranked by the number of shared files, author match and subject
+    similarity, only the top-k candidates get the full hunk comparison.
+    The commits without such candidates are matched by the normalized
+    subject, or the similar subject in fuzzy mode.
+    """
+    def __init__(self, ref, top_k=10, min_ratio=0.8, fuzzy_ratio=0.8):
+        self.repo = ref['repo']
+        self.top_k = top_k
+        self.min_ratio = min_ratio
+        # min subject similarity in fuzzy mode
+        self.fuzzy_ratio = fuzzy_ratio
+        # dict: mapping pid to commits
+        self.pid2c = {}
+        # dict: mapping file to commits
+        self.file2c = {}
+        # dict: mapping author to commits
+        self.author2c = {}
+        # dict: mapping commit to the number of changed files
+        self.nfiles = {}
+        # dict: mapping commit to subject
+        self.subjects = {}
+        # dict: mapping normalized subject to commits
+        self.sub2c = {}
+        # dict: mapping word of normalized subject to commits
+        self.word2c = {}
+        for gitc in ref['quilt']:
+            c = gitc.hexsha
+            pid = ref['pids'][c]
+            if pid:
+                self.pid2c.setdefault(pid, []).append(c)
+            ae = gitc.author.email.lower()
+            self.author2c.setdefault(ae, []).append(c)
+            files = set(ref['files'][c])
+            for f in files:
+                self.file2c.setdefault(f, []).append(c)
+            self.nfiles[c] = len(files)
+            self.subjects[c] = gitc.summary
+            nsub = normalize_subject(gitc.summary)
+            self.sub2c.setdefault(nsub, []).append(c)
+            for w in set(nsub.split()):
+                self.word2c.setdefault(w, []).append(c)
+
+    def candidates(self, gitc, files):
+        """
+        Rank the commits sharing files or author with gitc
+
+        returns: list of (score, commit), the highest score first
+        """
+        files = set(files)
+        # number of shared files keyed by commit
+        shared = {}
+        for f in files:
+            for c in self.file2c.get(f, []):
+                shared[c] = shared.get(c, 0) + 1
+        authored = set(self.author2c.get(gitc.author.email.lower(), []))
+        sub = gitc.summary
+        ranked = []
+        for c in set(shared.keys()) | authored:
+            # ratio of shared files in the union of changed files
+            nshared = shared.get(c, 0)
+            score = nshared / (len(files) + self.nfiles[c] - nshared or 1)
+            if c in authored:
+                score += 1
+            sm = SequenceMatcher(None, sub, self.subjects[c])
+            # quick_ratio() is an upper bound, skip the exact ratio if low
+            if sm.quick_ratio() > 0.5:
+                score += sm.ratio()
+            ranked.append((score, c,))
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        return ranked
+
+    def match(self, gitc, files):
+        """
+        Find the similar patch of gitc by comparing hunks of the top-k
+        candidates
+
+        returns: (git commit object or None, (ratio, similar hunks, total))
+        """
+        ranked = self.candidates(gitc, files)
+        if not ranked:
+            return (None, None)
+        revs = [ c for _, c in ranked[:self.top_k] ]
+        return find_similar_patch(gitc, self.repo, revs, self.min_ratio)
+
+    def match_by_subject(self, gitc, fuzzy=False):
+        """
+        Find the similar patch of gitc by comparing hunks of the commits
+        with the same normalized subject, or the top-k most similar
+        subjects if fuzzy is True
+
+        returns: (git commit object or None, (ratio, similar hunks, total))
+        """
+        nsub = normalize_subject(gitc.summary)
+        revs = self.sub2c.get(nsub, [])
+        if not revs and fuzzy:
+            words = nsub.split()
+            # the similar subject shares at least half of the words
+            nshared = {}
+            for w in set(words):
+                for c in self.word2c.get(w, []):
+                    nshared[c] = nshared.get(c, 0) + 1
+            ranked = []
+            for c, n in nshared.items():
+                if n * 2 < len(words):
+                    continue
+                sm = SequenceMatcher(None, nsub,
+                                     normalize_subject(self.subjects[c]))
+                if sm.quick_ratio() >= self.fuzzy_ratio and \
+                   sm.ratio() >= self.fuzzy_ratio:
+                    ranked.append((sm.ratio(), c,))
+            ranked.sort(key=lambda r: r[0], reverse=True)
+            revs = [ c for _, c in ranked[:self.top_k] ]
+        if not revs:
+            logger.info("No patch found by subject in quilt")
+            return (None, None)
+        return find_similar_patch(gitc, self.repo, revs, self.min_ratio)
 
 def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
                   repo_path=None, check_base=True, intel_only=True, epids_a=None,
-                  epids_b=None):
+                  epids_b=None, fuzzy_sub=True, since_b=None):
     ref_dict = {
         'a': {
             'url': url_a,
@@ -1083,100 +2268,32 @@ def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
             'ref': ref_b,
             'base': base_b,
             'epids': epids_b or [],
+            'since': since_b,
         },
     }
-    for ref in ref_dict.values():
-        reftype, sha = peek_repo(ref['ref'], ref['url'])
-        assert (reftype not in (INVALID_REPO, NOT_EXIST,)), \
-               "Tag/branch not exist: %s, %s" % (ref['url'], ref['ref'])
-        ref['sha'] = sha
-        ref['reftype'] = reftype
 
     # initialize the repo(s)
     ref_dict['b']['path'] = repo_path or gen_repo_path(url_b)
-    os.makedirs(ref_dict['b']['path'], exist_ok=True)
-    ref_dict['b']['repo'] = prepare_repo(url_b, ref_dict['b']['path'])
     if url_a == url_b:
+        # prepare the shared repo before generating quilts in parallel
+        os.makedirs(ref_dict['b']['path'], exist_ok=True)
+        ref_dict['b']['repo'] = prepare_repo(url_b, ref_dict['b']['path'])
         ref_dict['a']['path'] = ref_dict['b']['path']
         ref_dict['a']['repo'] = ref_dict['b']['repo']
     else:
         ref_dict['a']['path'] = gen_repo_path(url_a)
-        os.makedirs(ref_dict['a']['path'], exist_ok=True)
-        ref_dict['a']['repo'] = prepare_repo(url_a, ref_dict['a']['path'])
-    rt_re = re.compile(r'-rt\d*\b')
-    reltag_re = re.compile(r'(v[3-9]\.[\d\.\-rct]+)-.*\d{6}T\d{6}Z$')
-    for ref in ref_dict.values():
-        repo = ref['repo']
-        if ref['base']:
-            basetype, sha = peek_repo(ref['base'], ref['url'])
-            # only accept base in tag or sha
-            assert basetype in (IS_TAG, IS_SHA,), \
-              "Invalid base: %s, %s(type: %i)" % (ref['url'], ref['base'], basetype)
-            ref['basesha'] = sha
-        else:
-            m = rt_re.search(ref['ref'])
-            is_rt = True if m else False
-            with pushd(ref['path']):
-                ref['base'], ref['basesha'] = get_baseline(ref['sha'], is_rt)
-            basetype = IS_TAG
-        if check_base and ref['reftype'] == basetype == IS_TAG:
-            # check if the tag consistence
-            m = reltag_re.search(ref['ref'])
-            if m:
-                baseline_bytag = m.group(1)
-                assert (ref['base'] == baseline_bytag), \
-                       "Baseline inconsistent: %s, %s(from tag)" % \
-                         (ref['base'], baseline_bytag)
-        # generate range diff
-        # use basesha instead of baseline(i.e. kernel version) in case
-        # some repository has no upstream tag, e.g. anolis/cloud-kernel
-        ref['range'] = "%s..%s" % (ref['basesha'], ref['sha'])
-        logger.info("Generate quilt %s: %s" % (ref['ref'], ref['range']))
-        revs = repo.git.rev_list("--no-merges", "--reverse", ref['range'])
-        ref['quilt'] = []
-        # dict: mapping commit to git commit object
-        ref['gitcs'] = {}
-        # dict: mapping commit to pid
-        ref['pids'] = {}
-        epids = ref['epids']
-        for c in revs.splitlines():
-            pid  = get_patchid(c, repo)
-            if pid in epids:
-                logger.info("    exluded commit %s, up=%s" % (c, epids[pid]))
-                continue
-            gitc = repo.commit(c)
-            if intel_only and not is_intel_patch(gitc):
-                continue
-
-            ref['quilt'].append(gitc)
-            ref['gitcs'][c]  = gitc
-            ref['pids'][c]  = pid
+    # generate quilts of both sides concurrently
+    PROGRESS.stage('quilt')
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [ executor.submit(_gen_quilt, ref, check_base, intel_only) \
+                      for ref in ref_dict.values() ]
+        for f in futures:
+            # re-raise the exception in thread if any
+            f.result()
 
     ref_b = ref_dict['b']
-    # dict: mapping pid to commits
-    ref_b['pid2c'] = {}
-    # dict: mapping file to commits
-    ref_b['file2c'] = {}
-    # dict: mapping author to commits
-    ref_b['author2c'] = {}
-    for gitc in ref_b['quilt']:
-        c = gitc.hexsha
-        pid = ref_b['pids'][c]
-        if pid:
-            if pid in ref_b['pid2c']:
-                ref_b['pid2c'][pid].append(c)
-            else:
-                ref_b['pid2c'][pid] = [ c ]
-        ae = gitc.author.email.lower()
-        if ae in ref_b['author2c']:
-            ref_b['author2c'][ae].append(c)
-        else:
-            ref_b['author2c'][ae] = [ c ]
-        for f in gitc.stats.files.keys():
-            if f in ref_b['file2c']:
-                ref_b['file2c'][f].append(c)
-            else:
-                ref_b['file2c'][f] = [ c ]
+    with STATS.timer('quilt_index'):
+        matcher = QuiltMatcher(ref_b)
     # compare commit a with quilt b one by one
     ref_a = ref_dict['a']
     # a = b
@@ -1187,7 +2304,9 @@ def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
     new = []
     removed = []
     found = {}
+    PROGRESS.stage('quiltdiff', len(ref_a['quilt']) + len(ref_b['quilt']))
     for seq, gitc in enumerate(ref_a['quilt']):
+        PROGRESS.step()
         c = gitc.hexsha
         pid = ref_a['pids'][c]
         logger.info("commit(from quilt a): %s" % c)
@@ -1195,10 +2314,10 @@ def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
             same.append((seq, c, c, gitc.summary,))
             found[c] = True
             logger.info("    added in same")
-        elif pid and pid in ref_b['pids']:
-            cb = ref_b['pid2c'][pid][0]
+        elif pid and pid in matcher.pid2c:
+            cb = matcher.pid2c[pid][0]
             gitcb = ref_b['gitcs'][cb]
-            for cb_ in ref_b['pid2c'][pid]:
+            for cb_ in matcher.pid2c[pid]:
                 found[cb_] = True
             if gitc.message == gitcb.message:
                 same.append((seq, c, cb, gitc.summary,))
@@ -1207,23 +2326,13 @@ def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
                 cmco.append((seq, c, cb, gitcb.summary,))
                 logger.info("    added in cmco")
         else:
-            gitcb = None
-            # search by files
-            revs = [ cmt for f in gitc.stats.files.keys() \
-                           for cmt in ref_b['file2c'].get(f, []) ]
-            if revs:
-                gitcb, _ = find_similar_patch(gitc, ref_b['repo'], revs)
-            # search by author
-            if not gitcb:
-                ae = gitc.author.email.lower()
-                revs = ref_b['author2c'].get(ae)
-                if revs:
-                    gitcb, _ = find_similar_patch(gitc, ref_b['repo'], revs)
-            # search by subject
+            # search by the ranked candidates sharing files or author
+            with STATS.timer('quilt_match'):
+                gitcb, _ = matcher.match(gitc, ref_a['files'][c])
+            # search by subject in quilt b
             if not gitcb:
-                gitcb, _ = find_similar_patch_by_sub(gitc,
-                                                     ref_b['repo'],
-                                                     ref_b['range'])
+                with STATS.timer('quilt_match_sub'):
+                    gitcb, _ = matcher.match_by_subject(gitc, fuzzy_sub)
             if gitcb:
                 found[gitcb.hexsha] = True
                 updated.append((seq, c, gitcb.hexsha, gitcb.summary,))
@@ -1233,6 +2342,7 @@ def gen_quiltdiff(url_a, url_b, ref_a, ref_b, base_a=None, base_b=None,
                 logger.info("    added in removed")
 
     for gitc in ref_b['quilt']:
+        PROGRESS.step()
         c = gitc.hexsha
         logger.info("commit(from quilt b): %s" % c)
         if c not in found:
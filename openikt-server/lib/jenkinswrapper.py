@@ -6,13 +6,43 @@ import json
 import time
 import socket
 import logging
-import requests
-from lib.utils import requests_get, requests_post
-from lib.jobwrapper import BUILD_SERVERS, JobWrapper, ServerNotFound
+import threading
+from lib.utils import requests_get, requests_post, shared_session
+from lib.jobwrapper import BUILD_SERVERS, JobWrapper, ServerNotFound, Backoff
 
 
 logger = logging.getLogger(__name__)
 
+# crumbs are refreshed after the ttl or a 403 response
+CRUMB_TTL = 3600
+# dict: mapping server url to (crumb header dict, expire time)
+_CRUMBS = {}
+_CRUMB_LOCK = threading.Lock()
+
+def get_crumb(server_url, auth, refresh=False):
+    '''
+       the csrf crumb header of the server, cached by the process
+       return {} if the crumb issuer is disabled
+    '''
+    with _CRUMB_LOCK:
+        crumb = _CRUMBS.get(server_url)
+        if crumb and not refresh and crumb[1] > time.time():
+            return crumb[0]
+
+    result = shared_session().get('/'.join((
+        server_url,
+        'crumbIssuer/api/xml?xpath=concat(//crumbRequestField,":",//crumb)'
+    )), auth=auth, verify=False)
+    header = {}
+    if result.status_code == 200 and ':' in result.text:
+        field, value = result.text.split(':', 1)
+        header = { field: value }
+    else:
+        logger.warning("No crumb of %s: %s" % (server_url, result.reason))
+    with _CRUMB_LOCK:
+        _CRUMBS[server_url] = (header, time.time() + CRUMB_TTL,)
+    return header
+
 class JenkinsWrapper(JobWrapper):
     # set job_name, group and url related vars
     # either 'name' or 'url' has to be specified
@@ -65,17 +95,9 @@ class JenkinsWrapper(JobWrapper):
         self.server_url = self.server_info['url']
         self.auth = (self.server_info['user'], self.server_info['pass'],)
 
-        # retrieve the crubm token
-        result = requests.request("GET", '/'.join((
-            self.server_url,
-            'crumbIssuer/api/xml?xpath=concat(//crumbRequestField,":",//crumb)'
-        )), auth=self.auth)
-
-        result_text = result.text
-        csrf_token_list = result_text.split(':')
+        # the crumb token is added by post(), see get_crumb()
         self.post_headers = {'cache-control': 'no-cache',
-                             'content-type': 'application/x-www-form-urlencoded',
-                             csrf_token_list[0]: csrf_token_list[1]}
+                             'content-type': 'application/x-www-form-urlencoded'}
 
         # set job_name, group and url related vars
         self.__reload_job(kwargs.get('job_name'), kwargs.get('group'))
@@ -87,6 +109,10 @@ class JenkinsWrapper(JobWrapper):
         self.param_file = kwargs.get('param_file')
         self.query_label_url_base = '{u}/label/%s/api/json%s'.format(
                                       u=self.server_url)
+        # job specific retry exceptions, see JobWrapper.retry_check()
+        self.retry_excepts = kwargs.get('retry_excepts')
+        # dict: mapping (job url, build number) to the log follower
+        self.log_followers = {}
 
         self.queue_id = None
 
@@ -104,6 +130,25 @@ class JenkinsWrapper(JobWrapper):
         return ','.join(pids)
 
 
+    def post(self, url, data=None):
+        '''
+           post with the cached crumb, refresh it if it's rejected, e.g.
+           expired or issued to another session
+        '''
+        for refresh in (False, True,):
+            headers = { **self.post_headers,
+                        **get_crumb(self.server_url, self.auth, refresh) }
+            resp = requests_post(url,
+                                 data=data,
+                                 headers=headers,
+                                 auth=self.auth,
+                                 verify=False)
+            if resp.status_code != 403:
+                break
+            logger.info("Crumb rejected, refresh it")
+        return resp
+
+
     def trigger_job(self, name=None, group=None, data=None, job_url=None):
         '''
            trigger job
@@ -114,11 +159,7 @@ class JenkinsWrapper(JobWrapper):
             has_parms = True
             self.job_data = data
         self.__reload_job(name, group, has_parms, job_url)
-        resp = requests_post(self.trigger_job_url,
-                             data=self.job_data,
-                             headers=self.post_headers,
-                             auth=self.auth,
-                             verify=False)
+        resp = self.post(self.trigger_job_url, data=self.job_data)
         #resp.raise_for_status()
         logger.debug(self.job_data)
         logger.debug(resp.reason)
@@ -163,21 +204,23 @@ class JenkinsWrapper(JobWrapper):
 
 
     def get_job_no(self):
-        # retrieve job no interval
-        retr_jno_interval = 30
+        # the build usually starts in seconds, the poll interval grows
+        # while it waits in the queue
+        backoff = Backoff(5, 60)
         while not self.build_number:
             resp = self.get_builds()
-            qitem = resp['queueItem']
+            qitem = resp.get('queueItem')
+            interval = backoff.next()
             if qitem and qitem.get('id') == self.queue_id:
                 logger.info("%s, polling again in %d seconds" % \
-                              (qitem['why'], retr_jno_interval))
+                              (qitem['why'], interval))
             else:
-                for b in resp['builds']:
+                for b in resp.get('builds') or []:
                     if b['queueId'] == self.queue_id:
                         self.build_number = str(b['number'])
                         break
             if not self.build_number:
-                time.sleep(retr_jno_interval)
+                time.sleep(interval)
 
         build_url = self.view_job_url_base % self.build_number
         logger.info("Build URL: %s" % build_url)
@@ -191,6 +234,8 @@ class JenkinsWrapper(JobWrapper):
         jinfo = requests_get(self.query_job_url_base % (self.build_number, ''),
                              auth=self.auth)
         jinfo = json.loads(jinfo)
+        # scan the log as it grows, retry_check() only fetches the rest
+        self.follow_log().fetch()
         if jinfo['result']:
             self.handle_result(jinfo)
 
@@ -199,10 +244,29 @@ class JenkinsWrapper(JobWrapper):
                       self.sta_chk_interval)
 
 
+    def follow_log(self, excepts=None, sink=None):
+        '''
+           the follower of the build log, reused by the polls of the build
+           the log is rescanned from the start if excepts changes
+        '''
+        excepts = excepts or self.retry_excepts
+        key = (self.job_url_base, self.build_number)
+        follower = self.log_followers.get(key)
+        if not follower or follower.excepts != excepts or sink:
+            follower = LogFollower(
+                         '%s/logText/progressiveText?start=%%i' % \
+                           (self.view_job_url_base % self.build_number),
+                         self.auth, excepts, sink)
+            if not sink:
+                self.log_followers[key] = follower
+        return follower
+
+
     def retry_check(self, job_info, excepts=None):
-        q_con_url = self.log_url_base % (self.build_number, 0)
-        con_log = requests_get(q_con_url, auth=self.auth)
-        JobWrapper.retry_check(self, con_log, excepts)
+        follower = self.follow_log(excepts)
+        follower.follow()
+        if follower.match:
+            self.raise_retry(follower.match)
 
 
     def download_log(self, name=None, group=None, bno=None, job_url=None):
@@ -216,11 +280,9 @@ class JenkinsWrapper(JobWrapper):
             logger.error("No build number specified")
             return
 
-        q_con_url = self.log_url_base % (self.build_number, 0)
-        con_log = requests_get(q_con_url, auth=self.auth)
         logfl = "/tmp/%s-b%s.log" % (self.job_name, self.build_number)
         with open(logfl, 'w') as l:
-            l.write(con_log)
+            self.follow_log(sink=l).follow()
 
 
     def stop(self, name=None, group=None, bno=None, job_url=None):
@@ -235,11 +297,7 @@ class JenkinsWrapper(JobWrapper):
             logger.error("No build number specified")
             return
 
-        resp = requests_post(self.stop_job_url_base % self.build_number,
-                             headers=self.post_headers,
-                             data=None,
-                             auth=self.auth,
-                             verify=False)
+        resp = self.post(self.stop_job_url_base % self.build_number)
         # resp.raise_for_status()
         logger.debug(resp.reason)
         logger.debug(resp.text)
@@ -318,3 +376,163 @@ class JenkinsWrapper(JobWrapper):
             raise e
         else:
             return data
+
+
+class LogFollower:
+    """
+    Follower of a build log by the progressive text api. Each fetch() only
+    gets the bytes after the X-Text-Size of the previous one, and the
+    retry patterns are run on the new text plus the tail of the scanned
+    one, for the matches across the fetches.
+    """
+    # chars of the scanned text rescanned with the next fetch
+    OVERLAP = 4096
+
+    def __init__(self, url_base, auth, excepts=None, sink=None):
+        """
+        url_base: progressiveText url, %i for the start offset
+        excepts: specific retry exceptions, see JobWrapper.retry_check()
+        sink: file object the fetched text is written to
+        """
+        self.url_base = url_base
+        self.auth = auth
+        self.excepts = excepts
+        self.patterns = JobWrapper.retry_patterns(excepts)
+        self.sink = sink
+        self.offset = 0
+        # the build is running and the log is growing
+        self.more = True
+        self.tail = ''
+        # (exception name, message) of the first matched retry pattern
+        self.match = None
+
+    def fetch(self):
+        """returns the new text, '' if nothing new"""
+        try:
+            resp = shared_session().get(self.url_base % self.offset,
+                                        auth=self.auth, verify=False)
+            resp.raise_for_status()
+        except Exception as e:
+            logger.error(e)
+            return ''
+        text = resp.text
+        size = resp.headers.get('X-Text-Size')
+        self.offset = int(size) if size else self.offset + len(resp.content)
+        self.more = resp.headers.get('X-More-Data') == 'true'
+        if not text:
+            return ''
+        if self.sink:
+            self.sink.write(text)
+        if not self.match:
+            buf = self.tail + text
+            self.match = JobWrapper.match_retry(buf, self.patterns)
+            self.tail = buf[-self.OVERLAP:]
+        return text
+
+    def follow(self):
+        """fetch the rest of the log"""
+        while self.fetch():
+            pass
+
+
+class BuildMonitor:
+    """
+    Status of many builds of a jenkins server, e.g. the diff jobs triggered
+    by web. One poll costs one request per job group(folder) however many
+    builds are tracked, all the jobs of the group are fetched by one tree
+    query on the shared session. The poll interval backs off while no
+    build changes.
+
+    Usage:
+        monitor = BuildMonitor('cje_jenkins')
+        monitor.track('OpenIKT', 'create-diff', queue_id, data=task_id)
+        while monitor.builds:
+            if monitor.due():
+                for key, build in monitor.poll():
+                    ...
+    """
+    # builds of each job fetched per poll, the newer builds are listed first
+    BUILDS_DEPTH = 50
+
+    def __init__(self, server_name, min_interval=5, max_interval=120,
+                 max_age=None):
+        """max_age: seconds to give up the builds never finished"""
+        if server_name not in BUILD_SERVERS:
+            raise ServerNotFound("Build server %s not found" % server_name)
+        self.server_info = BUILD_SERVERS[server_name]
+        self.server_url = self.server_info['url']
+        self.auth = (self.server_info['user'], self.server_info['pass'],)
+        self.session = shared_session()
+        # dict: mapping (group, job name, queue id) to
+        #       {'number', 'result', 'url', 'data'}
+        self.builds = {}
+        self.backoff = Backoff(min_interval, max_interval)
+        self.next_poll = 0
+        self.max_age = max_age
+
+    def track(self, group, name, queue_id, data=None):
+        """data: passed back with the build changes"""
+        group = group or self.server_info.get('def_group')
+        self.builds[(group, name, queue_id)] = {
+            'number': None,
+            'result': None,
+            'url': None,
+            'data': data,
+            'since': time.time(),
+        }
+        # poll soon for the new build
+        self.backoff.interval = self.backoff.min_interval
+        self.next_poll = min(self.next_poll,
+                             time.time() + self.backoff.min_interval)
+
+    def untrack(self, key):
+        self.builds.pop(key, None)
+
+    def due(self):
+        return bool(self.builds) and time.time() >= self.next_poll
+
+    def group_url(self, group):
+        if group:
+            return '/'.join((self.server_url, 'job', group))
+        return self.server_url
+
+    def poll(self):
+        """
+        returns: list of (key, build) changed since the last poll, the
+                 finished builds are untracked
+        """
+        changed = []
+        for group in set(k[0] for k in self.builds):
+            url = "%s/api/json?tree=jobs[name,url,builds[number,queueId,result]{0,%i}]" % \
+                    (self.group_url(group), self.BUILDS_DEPTH)
+            try:
+                resp = self.session.get(url, auth=self.auth, verify=False)
+                resp.raise_for_status()
+                jobs = resp.json().get('jobs') or []
+            except Exception as e:
+                logger.error(e)
+                continue
+            for job in jobs:
+                for b in job.get('builds') or []:
+                    key = (group, job['name'], b.get('queueId'))
+                    build = self.builds.get(key)
+                    if not build or (build['number'] == b['number'] and
+                                     build['result'] == b['result']):
+                        continue
+                    build.update(number=b['number'], result=b['result'],
+                                 url="%s%i/" % (job['url'], b['number']))
+                    changed.append((key, build,))
+        for key, build in changed:
+            logger.info("Build %s: %s" % (build['url'],
+                                          build['result'] or 'started'))
+            if build['result']:
+                self.untrack(key)
+        if self.max_age:
+            # e.g. the queue item is cancelled
+            now = time.time()
+            for key, build in list(self.builds.items()):
+                if now - build['since'] > self.max_age:
+                    logger.warning("Give up the build %s/%s of queue item %s" % key)
+                    self.untrack(key)
+        self.next_poll = time.time() + self.backoff.next(bool(changed))
+        return changed
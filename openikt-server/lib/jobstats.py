@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Stage timers and counters of a job
+
+Usage:
+    from lib.jobstats import STATS
+
+    with STATS.timer('range_diff'):
+        ...
+
+    @STATS.timed()
+    def get_baseline(...):
+        ...
+
+    STATS.incr('db.rows', len(rows))
+    logger.info(STATS.dumps())
+
+The progress of the current stage is reported by PROGRESS to its sink,
+e.g. the DB table polled by web, see app_diff/rangediff_gen.py:
+    PROGRESS.stage('import', len(patches))
+    for p in patches:
+        ...
+        PROGRESS.step()
+
+The external commands(git, shell) are accounted by PROFILER. Set the env
+var OPENIKT_CMD_PROFILE=<file> to dump the aggregated call stacks of the
+commands in the collapsed format of flamegraph.pl at exit, e.g.:
+    OPENIKT_CMD_PROFILE=/tmp/cmd.folded ./rangediff_gen.py ...
+    flamegraph.pl /tmp/cmd.folded > cmd.svg
+"""
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import traceback
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class JobStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # dict: mapping stage to {'count': N, 'seconds': S}
+        self.stages = {}
+        # dict: mapping counter name to value
+        self.counters = {}
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.stages = {}
+            self.counters = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """time a stage, the nested and repeated stages are all counted"""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - t0)
+
+    def timed(self, stage=None):
+        """decorator to time a function, stage defaults to function name"""
+        def decorator(func):
+            name = stage or func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_time(self, stage, seconds, count=1):
+        with self.lock:
+            st = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+            st['count'] += count
+            st['seconds'] += seconds
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        with self.lock:
+            return {
+                'elapsed': round(time.time() - self.start, 3),
+                'stages': {
+                    k: {'count': v['count'], 'seconds': round(v['seconds'], 3)}
+                      for k, v in self.stages.items()
+                },
+                'counters': dict(self.counters),
+            }
+
+    def dumps(self, **kwargs):
+        return json.dumps(self.summary(), **kwargs)
+
+
+class CmdProfiler:
+    # root of the source tree, only the frames in it are kept in the stacks
+    SRC_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def __init__(self, stats, profile_fl=None):
+        self.lock = threading.Lock()
+        self.stats = stats
+        # dict: mapping command name to {'count', 'seconds', 'bytes', 'errors'}
+        self.cmds = {}
+        # dict: mapping collapsed stack to microseconds
+        self.stacks = {}
+        self.profile_fl = profile_fl
+        if profile_fl:
+            atexit.register(self.dump)
+
+    def _stack(self, name):
+        frames = []
+        for fs in traceback.extract_stack()[:-3]:
+            if not fs.filename.startswith(self.SRC_ROOT) or \
+               fs.filename == __file__:
+                continue
+            mod = os.path.splitext(os.path.basename(fs.filename))[0]
+            frames.append("%s.%s" % (mod, fs.name))
+        frames.append(name)
+        return ';'.join(frames)
+
+    def record(self, name, seconds, nbytes=0, error=False):
+        """account one command call"""
+        stack = self._stack(name) if self.profile_fl else None
+        with self.lock:
+            cmd = self.cmds.setdefault(name, {'count': 0, 'seconds': 0.0,
+                                              'bytes': 0, 'errors': 0})
+            cmd['count'] += 1
+            cmd['seconds'] += seconds
+            cmd['bytes'] += nbytes
+            if error:
+                cmd['errors'] += 1
+            if stack:
+                self.stacks[stack] = self.stacks.get(stack, 0) + \
+                                       int(seconds * 1000000)
+        self.stats.add_time('cmd.' + name, seconds)
+
+    def report(self, top=20):
+        """the most time consuming commands"""
+        with self.lock:
+            cmds = sorted(self.cmds.items(),
+                          key=lambda c: c[1]['seconds'], reverse=True)
+        lines = [ "%-32s %8s %10s %12s %6s" % \
+                    ('command', 'count', 'seconds', 'bytes', 'errors') ]
+        for name, cmd in cmds[:top]:
+            lines.append("%-32s %8i %10.3f %12i %6i" % \
+                           (name, cmd['count'], cmd['seconds'],
+                            cmd['bytes'], cmd['errors']))
+        return '\n'.join(lines)
+
+    def dump(self):
+        with self.lock:
+            stacks = dict(self.stacks)
+        with open(self.profile_fl, 'w') as f:
+            for stack, us in sorted(stacks.items()):
+                f.write("%s %i\n" % (stack, us))
+        logger.info("Command profile dumped to %s\n%s" % \
+                      (self.profile_fl, self.report()))
+
+
+class ProgressReporter:
+    """
+    Progress of the current stage of a job, reported to the sink at most
+    every interval seconds and at the start of each stage
+    """
+    def __init__(self, interval=2):
+        self.lock = threading.Lock()
+        self.interval = interval
+        # callable with the state dict, e.g. writing it into the DB
+        self.sink = None
+        # dict: {'stage', 'done', 'total', 'started'}, total is 0 if unknown
+        self.state = {'stage': None, 'done': 0, 'total': 0, 'started': None}
+        self.last_report = 0
+
+    def stage(self, name, total=0):
+        with self.lock:
+            self.state = {'stage': name, 'done': 0, 'total': total,
+                          'started': time.time()}
+        self.report(force=True)
+
+    def add_total(self, n):
+        with self.lock:
+            self.state['total'] += n
+        self.report()
+
+    def step(self, n=1):
+        with self.lock:
+            self.state['done'] += n
+        self.report()
+
+    def report(self, force=False):
+        if not self.sink:
+            return
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            state = dict(self.state)
+        try:
+            self.sink(state)
+        except Exception as e:
+            # the job goes on without the progress
+            logger.warning("Progress not reported: %s" % e)
+
+
+# process-wide stats
+STATS = JobStats()
+# process-wide external command profiler
+PROFILER = CmdProfiler(STATS, os.environ.get('OPENIKT_CMD_PROFILE'))
+# process-wide progress of the job
+PROGRESS = ProgressReporter()
@@ -17,7 +17,20 @@ BUILD_SERVERS = {
         'user': FACELESS_USER_TEST,
         'pass': os.environ.get('SYS_TESTING_CRED_CJE_API'),
     },
+    # the jobs are run by the process pool of app_diff/task_worker.py on
+    # the app host, see lib/localwrapper.py
+    'local': {
+        'url': os.environ.get('LOCAL_JOB_URL', 'local'),
+        'def_group': None,
+        'type': 'local',
+        # size of the process pool
+        'workers': int(os.environ.get('LOCAL_JOB_WORKERS', 2)),
+        # logs and workspaces of the jobs
+        'root': os.environ.get('LOCAL_JOB_ROOT', '/tmp/openikt-jobs'),
+    },
 }
+# build server of the jobs triggered by web
+JOB_SERVER = os.environ.get('OPENIKT_JOB_SERVER', 'cje_jenkins')
 
 COMMON_RETRY_EXCEPTIONS = {
     'TFConnectionError': [
@@ -38,6 +51,10 @@ class JobWrapperRetryException(Exception):
 class TFConnectionTimeout(JobWrapperRetryException):
     pass
 
+
+class TFConnectionError(JobWrapperRetryException):
+    pass
+
 class ArtifactoryAuthError(JobWrapperRetryException):
     pass
 
@@ -50,9 +67,38 @@ class ServerNotFound(JobWrapperRetryException):
     pass
 
 
+def new_job_wrapper(server_name=JOB_SERVER, **kwargs):
+    """create the job wrapper of the build server type"""
+    if server_name not in BUILD_SERVERS:
+        raise ServerNotFound("Build server %s not found" % server_name)
+    if BUILD_SERVERS[server_name]['type'] == 'local':
+        from lib.localwrapper import LocalWrapper
+        return LocalWrapper(server_name=server_name, **kwargs)
+    from lib.jenkinswrapper import JenkinsWrapper
+    return JenkinsWrapper(server_name=server_name, **kwargs)
+
+
+class Backoff:
+    """poll interval growing while nothing changes"""
+    def __init__(self, min_interval, max_interval, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def next(self, changed=False):
+        """returns: seconds to wait before the next poll"""
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+        return self.interval
+
+
 class JobWrapper:
     def __init__(self, **kwargs):
-        sta_chk_interval = None
+        # seconds between the status polls of a build
+        self.sta_chk_interval = kwargs.get('sta_chk_interval', 60)
 
 
     def trigger_job(self):
@@ -75,17 +121,38 @@ class JobWrapper:
         pass
 
 
-    def retry_check(self, log, specific_excepts=None):
+    @staticmethod
+    def retry_patterns(specific_excepts=None):
+        '''
+           return list of (exception name, message, compiled pattern)
+        '''
         # merge common retry exceptions and specific ones
         retry_excepts = { **COMMON_RETRY_EXCEPTIONS, **specific_excepts } \
                           if specific_excepts else COMMON_RETRY_EXCEPTIONS
-        for e, errors in retry_excepts.items():
-            for err in errors:
-                match = re.search(err['rep'], log, re.M|re.S)
-                if match:
-                    exc_class = globals()[e]
-                    exc = exc_class(err['msg'])
-                    raise exc
+        return [ (e, err['msg'], re.compile(err['rep'], re.M|re.S)) \
+                   for e, errors in retry_excepts.items() for err in errors ]
+
+
+    @staticmethod
+    def match_retry(log, patterns):
+        '''
+           return (exception name, message) of the first matched pattern
+        '''
+        for e, msg, rep in patterns:
+            if rep.search(log):
+                return (e, msg)
+        return None
+
+
+    def raise_retry(self, match):
+        exc_class = globals()[match[0]]
+        raise exc_class(match[1])
+
+
+    def retry_check(self, log, specific_excepts=None):
+        match = self.match_retry(log, self.retry_patterns(specific_excepts))
+        if match:
+            self.raise_retry(match)
 
 
     def _do(self):
@@ -93,8 +160,7 @@ class JobWrapper:
         if not trigger_result:
             logger.error("Triggered job failed, quit")
             sys.exit(14)
-    
-        time.sleep(10)
+
         self.get_job_no()
         while True:
             self.poll_status()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Local executor of the jobs, an alternative to jenkins
+
+The jobs are queued as LocalJob rows by LocalWrapper.trigger_job() and run
+by LocalExecutor in a bounded process pool hosted by app_diff/task_worker.py,
+so there is no jenkins queue latency and the build number is known as soon
+as the job is triggered. A job runs the main() of the diff scripts in a
+pool process:
+    log: <root>/logs/<build number>.log
+    WORKSPACE: <root>/ws<slot>, the repos cloned there are reused by the
+               later jobs of the same pool slot, like the workspace@N of
+               the concurrent jenkins builds
+
+Set OPENIKT_JOB_SERVER=local to run the jobs triggered by web locally, see
+BUILD_SERVERS['local'] for the settings. The running jobs could only be
+stopped on the host of the executor.
+"""
+import os
+import signal
+import shutil
+import logging
+import importlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from lib.jobwrapper import BUILD_SERVERS, JobWrapper, ServerNotFound
+
+logger = logging.getLogger(__name__)
+
+
+def create_diff_steps(data):
+    """the parameters are the same as the jenkins job, see TriggerDiffJob"""
+    from app_diff.models import RangeDiff
+    dtypes = {
+        RangeDiff.TYPE_GITDIFF: 'rangediff',
+        RangeDiff.TYPE_QUILTDIFF: 'quiltdiff',
+        RangeDiff.TYPE_QUILT: 'quilt',
+    }
+    argv = ['-t', data['repo_to'], '-e', data['ref_to'],
+            '-T', dtypes[int(data['diff_type'])]]
+    for opt, key in (('-f', 'repo_from'), ('-s', 'ref_from'),
+                     ('-S', 'base_from'), ('-E', 'base_to')):
+        if data.get(key):
+            argv += [opt, data[key]]
+    return [ ('app_diff.rangediff_gen', argv, 'fail_diff_job') ]
+
+def image_inspector_steps(data):
+    """same stages as app_ii/jenkinsfile"""
+    return [
+        ('app_ii.image_import', ['-i', data['img_a']], None),
+        ('app_ii.image_import', ['-i', data['img_b']], None),
+        ('app_ii.image_diff', ['-a', data['img_a'], '-b', data['img_b']], None),
+    ]
+
+# dict: mapping job name to the function returning the steps of the job
+#   step: (module, argv, name of the module function called with the args
+#          if the step fails), run as module.main(module.get_parser()
+#          .parse_args(argv))
+JOBS = {
+    'create-diff': create_diff_steps,
+    'image-inspector': image_inspector_steps,
+}
+
+
+class LocalJobAborted(Exception):
+    pass
+
+
+# id of the job running in this pool process
+_job_id = None
+
+def _abort(signum, frame):
+    """
+    stop() marks the job aborted before the signal, the pid may run the
+    next job or be idle by the time the signal arrives, so the signal is
+    ignored unless the running job is the aborted one
+    """
+    if _job_id:
+        from app_diff.models import LocalJob
+        if LocalJob.objects.filter(id=_job_id,
+                                   status=LocalJob.STATUS_ABORTED).exists():
+            raise LocalJobAborted("Aborted by signal %i" % signum)
+    logger.warning("Ignored signal %i, job #%s isn't aborted" % \
+                     (signum, _job_id))
+
+def init_pool_process():
+    # SIGUSR1 aborts the job, SIGTERM is left to the pool for terminating
+    # the processes
+    signal.signal(signal.SIGUSR1, _abort)
+
+def job_log_path(root, job_id):
+    return os.path.join(root, 'logs', "%s.log" % job_id)
+
+def run_step(modname, argv, on_failure):
+    logger.info("Run %s %s" % (modname, ' '.join(argv)))
+    mod = importlib.import_module(modname)
+    args = mod.get_parser().parse_args(argv)
+    try:
+        mod.main(args)
+    except BaseException as e:
+        # the scripts exit 0 to skip, e.g. the diff already exists
+        if isinstance(e, SystemExit) and not e.code:
+            return
+        if on_failure:
+            getattr(mod, on_failure)(args)
+        raise
+
+def run_job(job_id, root, slot):
+    """run a local job in a pool process"""
+    global _job_id
+    import django
+    django.setup()
+    from django.db import connections
+    from django.utils import timezone
+    from app_diff.models import LocalJob
+    from lib.jobstats import STATS, PROGRESS
+    from lib.gitutils import close_object_readers
+
+    LocalJob.objects.filter(id=job_id).update(pid=os.getpid())
+    job = LocalJob.objects.get(id=job_id)
+    os.environ['WORKSPACE'] = os.path.join(root, "ws%i" % slot)
+    os.makedirs(os.environ['WORKSPACE'], exist_ok=True)
+    handler = logging.FileHandler(job_log_path(root, job_id))
+    handler.setFormatter(logging.Formatter('%(levelname)-5s: %(message)s'))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(os.environ.get('LOGLEVEL', 'INFO'))
+    STATS.reset()
+    PROGRESS.sink = None
+    _job_id = job_id
+    status = LocalJob.STATUS_SUCCESS
+    try:
+        for step in JOBS[job.name](job.params):
+            run_step(*step)
+    except LocalJobAborted as e:
+        logger.error(e)
+        status = LocalJob.STATUS_ABORTED
+    except BaseException:
+        logger.error(traceback.format_exc())
+        status = LocalJob.STATUS_FAILURE
+    finally:
+        _job_id = None
+        logger.info("Finished: %s" % dict(LocalJob.STATUS_CHOICES)[status])
+        root_logger.removeHandler(handler)
+        handler.close()
+        # the pool process runs the later jobs, which may re-clone the repos
+        # of the workspace
+        close_object_readers()
+        STATS.reset()
+        PROGRESS.sink = None
+        # the job aborted by stop() keeps its status
+        LocalJob.objects.filter(id=job_id,
+                                status=LocalJob.STATUS_RUNNING).update(
+          status=status, finished_date=timezone.now())
+        connections.close_all()
+
+
+class LocalExecutor:
+    """bounded process pool running the queued local jobs"""
+    def __init__(self, server_name='local', workers=None):
+        server_info = BUILD_SERVERS[server_name]
+        self.root = server_info['root']
+        self.workers = workers or server_info['workers']
+        os.makedirs(os.path.join(self.root, 'logs'), exist_ok=True)
+        self.pool = None
+        # dict: mapping job id to (slot, future)
+        self.running = {}
+
+    def new_pool(self):
+        # the pool processes are spawned, the forked ones would share the
+        # db connections of the parent
+        return ProcessPoolExecutor(
+                 max_workers=self.workers,
+                 mp_context=multiprocessing.get_context('spawn'),
+                 initializer=init_pool_process)
+
+    def claim(self):
+        from django.db import transaction
+        from django.utils import timezone
+        from app_diff.models import LocalJob
+        with transaction.atomic():
+            job = LocalJob.objects.select_for_update(skip_locked=True).filter(
+                    status=LocalJob.STATUS_QUEUED).order_by('id').first()
+            if job:
+                job.status = LocalJob.STATUS_RUNNING
+                job.started_date = timezone.now()
+                job.save(update_fields=['status', 'started_date'])
+        return job
+
+    def poll(self):
+        """
+        reap the finished jobs and start the queued ones
+        returns: number of the running jobs
+        """
+        from django.utils import timezone
+        from app_diff.models import LocalJob
+        for job_id, (slot, future) in list(self.running.items()):
+            if not future.done():
+                continue
+            del self.running[job_id]
+            exc = future.exception()
+            if exc:
+                # the pool process died, e.g. killed by oom
+                logger.error("Local job #%i: %s" % (job_id, repr(exc)))
+                LocalJob.objects.filter(id=job_id,
+                                        status=LocalJob.STATUS_RUNNING).update(
+                  status=LocalJob.STATUS_FAILURE, finished_date=timezone.now())
+                if isinstance(exc, BrokenProcessPool) and self.pool:
+                    self.pool.shutdown(wait=False)
+                    self.pool = None
+
+        while len(self.running) < self.workers:
+            job = self.claim()
+            if not job:
+                break
+            if not self.pool:
+                self.pool = self.new_pool()
+            slots = set(range(self.workers)) - \
+                      set(s for s, _ in self.running.values())
+            slot = min(slots)
+            self.running[job.id] = (slot, self.pool.submit(run_job, job.id,
+                                                           self.root, slot))
+            logger.info("Local job %s started in slot %i" % (job, slot))
+        return len(self.running)
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+
+class LocalWrapper(JobWrapper):
+    def __reload_job(self, name=None, job_url=None):
+        if job_url:
+            name = job_url.rstrip('/').split('/')[-1]
+        if not name:
+            return
+        self.job_name = name
+        self.job_url_base = '/'.join((self.server_url, 'job', name))
+        self.view_job_url_base = '{u}/%s'.format(u=self.job_url_base)
+
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        server_name = kwargs.get('server_name', 'local')
+        if server_name not in BUILD_SERVERS:
+            raise ServerNotFound("Build server %s not found" % server_name)
+        self.server_info = BUILD_SERVERS[server_name]
+        self.job_type = self.server_info['type']
+        self.server_url = self.server_info['url']
+        self.root = self.server_info['root']
+        self.sta_chk_interval = kwargs.get('sta_chk_interval', 5)
+
+        self.job_name = None
+        self.__reload_job(kwargs.get('job_name'))
+        self.build_number = kwargs.get('build_number')
+        if self.build_number and (not isinstance(self.build_number, str)):
+            self.build_number = str(self.build_number)
+        self.job_data = kwargs.get('job_data')
+        self.queue_id = None
+
+
+    def _get_job(self, name=None, bno=None, job_url=None):
+        from app_diff.models import LocalJob
+        self.__reload_job(name, job_url)
+        if bno:
+            self.build_number = str(bno)
+        if not self.build_number:
+            logger.error("No build number specified")
+            return None
+        return LocalJob.objects.filter(id=int(self.build_number)).first()
+
+
+    def trigger_job(self, name=None, group=None, data=None, job_url=None):
+        '''
+           queue the job for the local executor, group is ignored
+           return True or False
+        '''
+        from app_diff.models import LocalJob
+        self.__reload_job(name, job_url)
+        if data:
+            self.job_data = data
+        if self.job_name not in JOBS:
+            logger.error("Local job %s not found" % self.job_name)
+            return False
+        job = LocalJob.objects.create(name=self.job_name,
+                                      params=self.job_data or {})
+        # the queue item is the build
+        self.queue_id = job.id
+        self.build_number = str(job.id)
+        logger.debug("Queue ID: %d" % self.queue_id)
+        return True
+
+
+    def get_job_no(self):
+        build_url = self.view_job_url_base % self.build_number
+        logger.info("Build URL: %s" % build_url)
+        return build_url
+
+
+    def poll_status(self):
+        jinfo = self.get_build_info()
+        if jinfo.get('result'):
+            self.handle_result(jinfo)
+
+        logger.debug("Build info.: %s" % str(jinfo))
+        logger.info("Status: ongoing, polling again in %d seconds" % \
+                      self.sta_chk_interval)
+
+
+    def retry_check(self, job_info, excepts=None):
+        JobWrapper.retry_check(self, self.get_build_log(start=0) or '',
+                               excepts)
+
+
+    def get_status(self, name=None, group=None, bno=None, job_url=None):
+        job = self._get_job(name, bno, job_url)
+        return job.result() if job else 'Not Found'
+
+
+    def get_build_info(self, name=None, group=None, bno=None, job_url=None):
+        job = self._get_job(name, bno, job_url)
+        if not job:
+            return {}
+        return {
+            'id': str(job.id),
+            'number': job.id,
+            'queueId': job.id,
+            'building': job.status == job.STATUS_RUNNING,
+            'result': job.result(),
+            'url': self.view_job_url_base % job.id,
+        }
+
+
+    def get_build_log(self, name=None, group=None,
+                      bno=None, start=0, job_url=None):
+        job = self._get_job(name, bno, job_url)
+        if not job:
+            return None
+        try:
+            with open(job_log_path(self.root, job.id), 'rb') as f:
+                f.seek(start)
+                return f.read().decode(errors='replace')
+        except OSError as e:
+            # not started yet
+            logger.debug(e)
+            return ''
+
+
+    def download_log(self, name=None, group=None, bno=None, job_url=None):
+        '''
+           download build log at /tmp/<job_name>-b<build_number>.log
+        '''
+        job = self._get_job(name, bno, job_url)
+        if not job:
+            return
+        logfl = "/tmp/%s-b%s.log" % (job.name, job.id)
+        shutil.copyfile(job_log_path(self.root, job.id), logfl)
+
+
+    def stop(self, name=None, group=None, bno=None, job_url=None):
+        '''
+           stop job
+           return True or False
+        '''
+        from django.utils import timezone
+        job = self._get_job(name, bno, job_url)
+        if not job:
+            return False
+        if type(job).objects.filter(id=job.id, status=job.STATUS_QUEUED).update(
+             status=job.STATUS_ABORTED, finished_date=timezone.now()):
+            return True
+        # the abort flag of the job, checked by the pool process on the
+        # signal, see _abort()
+        if not job.pid or not type(job).objects.filter(
+             id=job.id, status=job.STATUS_RUNNING, pid=job.pid).update(
+             status=job.STATUS_ABORTED, finished_date=timezone.now()):
+            logger.error("Job %s isn't running" % job)
+            return False
+        try:
+            os.kill(job.pid, signal.SIGUSR1)
+        except OSError as e:
+            logger.error(e)
+            return False
+        return True
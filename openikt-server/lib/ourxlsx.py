@@ -119,6 +119,28 @@ class NewXlsx(xlsxwriter.Workbook):
                 sheet_obj.set_column(col, col, width=node.data.get('width'))
 
 
+    def write_table(self, sheet_obj, columns, rows, style=None):
+        """ Write a title row and the data rows of the sheet in row order
+
+        Unlike write_worksheet(), the rows aren't kept in the title tree,
+        so it works in the constant_memory mode and the rows could be
+        a generator.
+
+        :param columns: A list of (title, width) of the columns.
+        :param rows: An iterable of the lists of the row values.
+        :param style: Title cell style.
+        :return: Number of the data rows written.
+        """
+        for col, (title, width) in enumerate(columns):
+            sheet_obj.set_column(col, col, width=width)
+            sheet_obj.write(0, col, title, style)
+        count = 0
+        for count, values in enumerate(rows, 1):
+            sheet_obj.write_row(count, 0, values)
+        sheet_obj.row_count = count
+        return count
+
+
     def get_tree_node_format_data(self, width: int = 0,
                                   row: int = 0,
                                   column_cells_list: list = [],
@@ -15,14 +15,17 @@ import select
 import math
 import tarfile
 import tempfile
+import time
 import logging
 import hashlib
+import threading
 from functools import wraps
 from time import sleep
 from subprocess import PIPE
 from datetime import datetime
 from difflib import SequenceMatcher
 import requests
+from lib.jobstats import PROFILER
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
@@ -63,6 +66,7 @@ class ShCmdError(Exception):
 
 def cmd_pipe(command):
     logger.debug("Run shell cmd: %s", command)
+    t0 = time.time()
     returncode = 1
     output = None
     error = None
@@ -80,6 +84,8 @@ def cmd_pipe(command):
         returncode = 2
         error = str(e)
     finally:
+        PROFILER.record("sh", time.time() - t0,
+                        len(output or ''), returncode != 0)
         if output:
             logger.info(output)
         if error:
@@ -105,11 +111,28 @@ def requests_retry_session(retries=10,
     session.mount('https://', adapter)
     return session
 
+# process-wide session, see shared_session()
+_SESSION = { 'pid': None, 'session': None }
+_SESSION_LOCK = threading.Lock()
+
+def shared_session():
+    '''
+    the session with the retry adapter shared by the calls of the process,
+    the connections are kept alive and reused, a forked process(e.g. an
+    uwsgi worker) creates its own one
+    '''
+    pid = os.getpid()
+    with _SESSION_LOCK:
+        if _SESSION['pid'] != pid:
+            _SESSION['session'] = requests_retry_session()
+            _SESSION['pid'] = pid
+        return _SESSION['session']
+
 def requests_get(url, q_data=None, auth=None):
     resp = None
     logger.debug("Query URL: %s" % url)
     try:
-        resp = requests_retry_session().get(url, auth=auth, verify=False)
+        resp = shared_session().get(url, auth=auth, verify=False)
         logger.debug(resp.text)
         if resp.status_code != requests.codes.ok:
             logger.error(resp.reason)
@@ -128,11 +151,11 @@ def requests_post(url, data, headers, auth, verify=False):
     resp = None
     logger.debug("Post URL: %s" % url)
     try:
-        resp = requests_retry_session().post(url,
-                                             data=data,
-                                             headers=headers,
-                                             auth=auth,
-                                             verify=verify)
+        resp = shared_session().post(url,
+                                     data=data,
+                                     headers=headers,
+                                     auth=auth,
+                                     verify=verify)
     except Exception as e:
         logger.error(e)
         logger.error("requests.post() failed: %s, terminated" % \